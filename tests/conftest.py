@@ -0,0 +1,6 @@
+from pathlib import Path
+import sys
+
+# The workflow scripts import each other as top-level modules, as when run from workflow/scripts
+SCRIPTS_DIR = Path(__file__).resolve().parents[1] / 'workflow' / 'scripts'
+sys.path.insert(0, str(SCRIPTS_DIR))
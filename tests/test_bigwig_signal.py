@@ -0,0 +1,80 @@
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import pyBigWig
+import pytest
+
+from bigwig_signal import SignalLookup, get_signal_tracks
+
+CHROM_SIZES = [('chr1', 30000), ('chr2', 12000)]
+
+
+@pytest.fixture
+def bigwigs(tmp_path):
+    rng = np.random.default_rng(0)
+    paths = {}
+    for name in ['DNase_var', 'CHIP_var']:
+        paths[name] = tmp_path / f'{name}.bw'
+        bw = pyBigWig.open(str(paths[name]), 'w')
+        bw.addHeader(CHROM_SIZES)
+        for chrom, size in CHROM_SIZES:
+            # varying steps, with gaps without data between the entries
+            starts = np.arange(0, size - 10, 7)
+            bw.addEntries([chrom] * len(starts), starts.tolist(), ends=(starts + 5).tolist(), values=rng.random(len(starts)).tolist())
+        bw.close()
+    return paths
+
+
+def per_position_values(path, chroms, ends):
+    '''Signal at each position as read one position at a time, NaN on chromosomes the bigWig does not have'''
+    bw = pyBigWig.open(str(path))
+    values = [np.round(bw.values(chrom, end - 1, end)[0], 4) if chrom in bw.chroms() else np.nan for chrom, end in zip(chroms, ends)]
+    bw.close()
+    return np.array(values)
+
+
+def positions():
+    rng = np.random.default_rng(1)
+    chroms = list(rng.choice(['chr1', 'chr2'], 300))
+    ends = list(rng.integers(1, 12000, 300))
+    # around block splits: gaps of exactly max_gap and max_gap + 1, a run spanning several max_span windows
+    chroms += ['chr1'] * 8 + ['chrUn', 'chrUn', 'chr2']
+    ends += [20000, 20100, 20201, 20301, 25000, 25050, 25100, 25150, 5, 9000, 12000]
+    order = rng.permutation(len(ends))
+    return [chroms[i] for i in order], np.array(ends)[order]
+
+
+@pytest.mark.parametrize('max_gap,max_span', [(100, 120), (2000, 500000), (0, 1)])
+def test_block_reads_match_per_position_reads(bigwigs, max_gap, max_span):
+    chroms, ends = positions()
+    lookup = SignalLookup(chroms, ends, max_gap, max_span)
+    if max_gap == 100:
+        blocks = [(chrom, start, stop) for chrom, start, stop, _, _ in lookup.blocks]
+        assert ('chr1', 19999, 20100) in blocks and ('chr1', 20200, 20301) in blocks
+        assert all(stop - start <= max_span + max_gap for _, start, stop in blocks)
+
+    for name, path in bigwigs.items():
+        bw = pyBigWig.open(str(path))
+        np.testing.assert_array_equal(lookup.values(bw), per_position_values(path, chroms, ends))
+        bw.close()
+    assert np.isnan(lookup.values(pyBigWig.open(str(bigwigs['DNase_var'])))[np.array(chroms) == 'chrUn']).all()
+
+
+@pytest.mark.parametrize('workers', [None, 2])
+def test_signal_tracks_match_per_position_reads(bigwigs, workers):
+    chroms, ends = positions()
+    lookup = SignalLookup(chroms, ends, max_gap=100, max_span=120)
+    pool = ProcessPoolExecutor(workers) if workers else None
+    try:
+        signals = get_signal_tracks(lookup, bigwigs, pool)
+    finally:
+        if pool is not None:
+            pool.shutdown()
+
+    assert list(signals) == list(bigwigs)
+    for name, path in bigwigs.items():
+        np.testing.assert_array_equal(signals[name], per_position_values(path, chroms, ends))
+
+
+def test_no_positions(bigwigs):
+    assert get_signal_tracks(SignalLookup([], []), bigwigs)['DNase_var'].shape == (0,)
@@ -0,0 +1,48 @@
+import numpy as np
+
+from chunk_checkpoint import ChunkCheckpoint, get_fingerprint
+
+
+def test_resumes_committed_chunks(tmp_path):
+    checkpoint = ChunkCheckpoint(tmp_path / 'checkpoint', {'chunk_rows': 2})
+    checkpoint.save_arrays(0, scores=np.array([1.0, 2.0]))
+    checkpoint.save_arrays(2, scores=np.array([3.0]))
+
+    resumed = ChunkCheckpoint(tmp_path / 'checkpoint', {'chunk_rows': 2})
+    assert resumed.resumed == 2
+    assert resumed.done(0) and resumed.done(2) and not resumed.done(4)
+    np.testing.assert_array_equal(resumed.load_arrays(2)['scores'], [3.0])
+
+
+def test_uncommitted_chunk_is_not_done(tmp_path):
+    checkpoint = ChunkCheckpoint(tmp_path / 'checkpoint', {})
+    checkpoint.path('a', '.parquet').write_text('partial')
+
+    assert not ChunkCheckpoint(tmp_path / 'checkpoint', {}).done('a')
+
+
+def test_changed_fingerprint_discards_chunks(tmp_path):
+    checkpoint = ChunkCheckpoint(tmp_path / 'checkpoint', {'chunk_rows': 2})
+    checkpoint.save_arrays(0, scores=np.zeros(2))
+
+    restarted = ChunkCheckpoint(tmp_path / 'checkpoint', {'chunk_rows': 3})
+    assert restarted.resumed == 0
+    assert not restarted.path(0, '.npz').exists()
+
+
+def test_fingerprint_follows_inputs(tmp_path):
+    input_file = tmp_path / 'input.txt'
+    input_file.write_text('a')
+    before = get_fingerprint([input_file], block_rows=10)
+    input_file.write_text('ab')
+
+    assert get_fingerprint([input_file], block_rows=10) != before
+    assert get_fingerprint([input_file], block_rows=10) == get_fingerprint([input_file], block_rows=10)
+
+
+def test_remove(tmp_path):
+    checkpoint = ChunkCheckpoint(tmp_path / 'checkpoint', {})
+    checkpoint.save_arrays(0, scores=np.zeros(1))
+    checkpoint.remove()
+
+    assert not (tmp_path / 'checkpoint').exists()
@@ -0,0 +1,52 @@
+import os
+import pickle
+
+import numpy as np
+import pandas as pd
+from mlxtend.feature_selection import ColumnSelector
+from sklearn.ensemble import StackingClassifier
+from sklearn.linear_model import LogisticRegression
+from sklearn.pipeline import Pipeline
+from sklearn.preprocessing import StandardScaler
+
+from convert_models import convert_model
+from predict import load_model
+from tland_utility import NearestCentroidWithProb
+
+
+def fitted_model():
+    rng = np.random.default_rng(0)
+    X = pd.DataFrame(rng.normal(size=(200, 4)), columns=['a', 'b', 'c', 'd'])
+    y = (X['a'] - X['c'] + rng.normal(scale=0.5, size=len(X))) > 0
+    model = StackingClassifier([('ac', Pipeline([('select', ColumnSelector(cols=['a', 'c'])), ('scale', StandardScaler()), ('lr', LogisticRegression())])),
+                                ('bd', Pipeline([('select', ColumnSelector(cols=['b', 'd'])), ('nc', NearestCentroidWithProb())]))],
+                               final_estimator=LogisticRegression())
+    return model.fit(X, y), X
+
+
+def test_converted_model_predicts_as_the_pickle(tmp_path):
+    model, X = fitted_model()
+    with open(tmp_path / 'TLand_organSp.pickle', 'wb') as f:
+        pickle.dump(model, f)
+
+    joblib_path = convert_model(tmp_path / 'TLand_organSp.pickle')
+    assert joblib_path == tmp_path / 'TLand_organSp.joblib'
+    assert not list(tmp_path.glob('.*.tmp'))
+    loaded = load_model(tmp_path / 'TLand_organSp.pickle')
+    assert isinstance(loaded.final_estimator_.coef_, np.memmap)
+    np.testing.assert_array_equal(loaded.predict_proba(X), model.predict_proba(X))
+
+
+def test_stale_conversion_is_not_loaded(tmp_path, capsys):
+    model, X = fitted_model()
+    pickle_path = tmp_path / 'TLand_organSp.pickle'
+    with open(pickle_path, 'wb') as f:
+        pickle.dump(model, f)
+    convert_model(pickle_path)
+    mtime = os.path.getmtime(pickle_path)
+    os.utime(tmp_path / 'TLand_organSp.joblib', (mtime - 10, mtime - 10)) # the pickle was updated after the conversion
+
+    loaded = load_model(pickle_path)
+    assert 'TLand_organSp.joblib is older than TLand_organSp.pickle' in capsys.readouterr().out
+    assert not isinstance(loaded.final_estimator_.coef_, np.memmap)
+    np.testing.assert_array_equal(loaded.predict_proba(X), model.predict_proba(X))
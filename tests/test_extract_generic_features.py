@@ -0,0 +1,99 @@
+import json
+import os
+import random
+import subprocess
+import sys
+
+import numpy as np
+import pandas as pd
+import pyarrow.parquet as pq
+import pyBigWig
+import pytest
+
+from extract_generic_features import CHIP_SIGNAL_FEATURES, DNASE_SIGNAL_FEATURES
+from regdb_store import GENERIC_FEATURES, write_store
+from variant_cache import VariantCache
+
+SCRIPT = os.path.join(os.path.dirname(__file__), '..', 'workflow', 'scripts', 'extract_generic_features.py')
+CHROM_SIZES = [('chr1', 100000), ('chr2', 80000), ('chr10', 50000)]
+
+
+@pytest.fixture
+def inputs(tmp_path):
+    rng = random.Random(0)
+    variants = []
+    for chrom, size in CHROM_SIZES:
+        for end in sorted(rng.sample(range(1, size), 60)):
+            variants.append((chrom, end, f'rs{len(variants)}', 'A', 'G'))
+            if rng.random() < 0.2:
+                variants.append((chrom, end, f'rs{len(variants)}', 'A', 'T')) # multi-allelic
+    pd.DataFrame(variants).to_csv(tmp_path / 'sorted.vcf', sep='\t', header=False, index=False)
+    shuffled = variants[:]
+    rng.shuffle(shuffled)
+    pd.DataFrame(shuffled).to_csv(tmp_path / 'shuffled.vcf', sep='\t', header=False, index=False)
+
+    positions = sorted({(chrom, end) for chrom, end, *_ in variants})
+    write_store([json.dumps({'chrom': chrom, 'end': end, 'peaks': [],
+                             'features': {feature: rng.random() < 0.5 for feature in GENERIC_FEATURES}})
+                 for chrom, end in positions if rng.random() < 0.8], tmp_path / 'regdb_store')
+
+    sei = pd.DataFrame(variants, columns=['chrom', 'pos', 'id', 'ref', 'alt'])
+    sei['strand'] = '+'
+    for label in ['seqclass_max_absdiff', 'ref_match', 'contains_unk']:
+        sei[label] = 0.0 if label == 'seqclass_max_absdiff' else True
+    for i in range(40):
+        sei[f'class{i}'] = np.array([rng.gauss(0, 1) for _ in variants], dtype=np.float32)
+    sei.sort_values(['chrom', 'pos']).to_parquet(tmp_path / 'sei.parquet', index=False)
+
+    for feature in DNASE_SIGNAL_FEATURES + CHIP_SIGNAL_FEATURES:
+        bw = pyBigWig.open(str(tmp_path / f'{feature}.bw'), 'w')
+        bw.addHeader(CHROM_SIZES)
+        for chrom, size in CHROM_SIZES:
+            bw.addEntries(chrom, 0, values=[rng.random() for _ in range(size // 100)], span=100, step=100)
+        bw.close()
+    return tmp_path
+
+
+def extract(inputs, vcf, out, *extra, sei='sei.parquet'):
+    subprocess.run([sys.executable, SCRIPT, '--input_vcf', str(inputs / vcf), '--regdb_store', str(inputs / 'regdb_store'),
+                    '--input_sei', str(inputs / sei), '--dnase_sig_path', str(inputs),
+                    '--chip_sig_path', str(inputs), '--out', str(inputs / out), *extra], check=True)
+    return pd.read_parquet(inputs / out)
+
+
+@pytest.mark.parametrize('checkpoint', [False, True])
+def test_unsorted_input_streams_in_sorted_blocks(inputs, checkpoint):
+    expected = extract(inputs, 'shuffled.vcf', 'all.parquet')
+    extra = ['--checkpoint_dir', str(inputs / 'checkpoint')] if checkpoint else []
+    streamed = extract(inputs, 'shuffled.vcf', 'streamed.parquet', '--block_rows', '50',
+                       '--metrics', str(inputs / 'metrics.json'), *extra)
+
+    pd.testing.assert_frame_equal(streamed, expected, check_categorical=False)
+    assert pq.ParquetFile(inputs / 'streamed.parquet').num_row_groups == -(-len(expected) // 50)
+    with open(inputs / 'metrics.json') as f:
+        assert json.load(f)['counters']['sorted_blocks'] == -(-len(expected) // 50)
+    assert not (inputs / 'checkpoint').exists()
+    assert not [name for name in os.listdir(inputs) if name.startswith('.generic_blocks.')]
+
+
+def test_sorted_input_is_streamed_in_file_order(inputs):
+    expected = extract(inputs, 'sorted.vcf', 'all.parquet')
+    streamed = extract(inputs, 'sorted.vcf', 'streamed.parquet', '--block_rows', '50',
+                       '--metrics', str(inputs / 'metrics.json'))
+
+    pd.testing.assert_frame_equal(streamed, expected, check_categorical=False)
+    with open(inputs / 'metrics.json') as f:
+        assert json.load(f)['counters']['sorted_blocks'] == 0
+
+
+@pytest.mark.parametrize('block_rows', ['0', '50'])
+def test_variants_without_sei_features_are_not_cached(inputs, block_rows):
+    sei = pd.read_parquet(inputs / 'sei.parquet')
+    sei.iloc[::10].to_parquet(inputs / 'sei_missing.parquet', index=False) # Sei features of every 10th variant only
+    features = extract(inputs, 'shuffled.vcf', 'features.parquet', '--block_rows', block_rows, '--cache_dir',
+                       str(inputs / 'cache'), '--feature_version', 'v1', sei='sei_missing.parquet')
+
+    cached = VariantCache(inputs / 'cache', 'v1').get_generic(features)
+    assert len(features) == len(sei)
+    assert sorted(cached['id']) == sorted(sei['id'].iloc[::10])
+    assert not cached['class0'].isna().any()
@@ -0,0 +1,42 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+from feature_schema import (ORGANSP_SIGNAL_FEATURES, PERC_FEATURES, chrom_code, has_sei_features, position_key,
+                            to_compact_ints, to_generic_schema, to_organsp_schema, with_position_key)
+from regdb_store import COUNT_FEATURES, GENERIC_COLUMNS
+
+
+def test_position_key_orders_by_chromosome_then_position():
+    keys = position_key(['chr1', '1', 'chr2', 'chrX', 'chrM', 'MT', 'chrUn_KI270302v1'], [5, 5, 1, 7, 3, 3, 2**32 - 1])
+    assert keys[0] == keys[1] == (1 << 32) | 5
+    assert keys[2] == (2 << 32) | 1 and keys[3] >> 32 == 23 and keys[4] == keys[5]
+    assert keys[6] >> 32 == chrom_code('chrUn_KI270302v1') >= 32 and keys[6] & 0xFFFFFFFF == 2**32 - 1
+    assert list(with_position_key(pd.DataFrame({'chrom': ['chr2'], 'end': [1]})).columns) == ['pos_key', 'chrom', 'end']
+
+
+def test_generic_schema_is_float32():
+    df = pd.DataFrame({'chrom': ['chr1', 'chr1'], 'end': [10, 20], 'ref': ['A', 'C'], 'alt': ['G', 'T'],
+                       'ref_match': [True, None], **{column: [1.0, np.nan] for column in GENERIC_COLUMNS},
+                       'DNase_var': [0.123456789, 2.5], 'class0': [1e-3, -4.0]})
+    converted = to_generic_schema(df)
+
+    assert converted['chrom'].dtype == 'category' and converted['end'].dtype == np.int64
+    assert all(converted[column].dtype == np.float32 for column in GENERIC_COLUMNS + ['DNase_var', 'class0'])
+    np.testing.assert_allclose(converted['DNase_var'], df['DNase_var'], rtol=1e-7)
+    assert converted['CHIP'].isna().tolist() == [False, True]
+    np.testing.assert_array_equal(has_sei_features(converted), [True, False])
+
+
+@pytest.mark.parametrize('largest,dtype', [(0, np.int16), (32767, np.int16), (32768, np.int32), (10**6, np.int32)])
+def test_organsp_counts_are_int16_unless_they_overflow(largest, dtype):
+    df = pd.DataFrame({'chrom': ['chr1', 'chr2'], 'end': [10, 20],
+                       **{column: [0, 3] for column in COUNT_FEATURES},
+                       **{column: [0.25, 1.0] for column in PERC_FEATURES + ORGANSP_SIGNAL_FEATURES}})
+    df['CHIP_organSp'] = [1, largest]
+    converted = to_organsp_schema(df)
+
+    assert converted['CHIP_organSp'].dtype == dtype and converted['CHIP_organSp'].tolist() == [1, largest]
+    assert all(converted[column].dtype == np.int16 for column in COUNT_FEATURES if column != 'CHIP_organSp')
+    assert all(converted[column].dtype == np.float32 for column in PERC_FEATURES + ORGANSP_SIGNAL_FEATURES)
+    assert to_compact_ints([]).dtype == np.int16
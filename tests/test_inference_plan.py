@@ -0,0 +1,98 @@
+import numpy as np
+import pandas as pd
+import pytest
+from mlxtend.feature_selection import ColumnSelector
+from sklearn.ensemble import RandomForestClassifier, StackingClassifier
+from sklearn.impute import SimpleImputer
+from sklearn.linear_model import LogisticRegression
+from sklearn.pipeline import Pipeline
+from sklearn.preprocessing import StandardScaler
+
+import inference_plan
+from inference_plan import get_inference_plan, predict_proba
+
+
+@pytest.fixture(autouse=True)
+def plans(monkeypatch):
+    monkeypatch.setattr(inference_plan, '_plans', {})
+
+
+def training_data(rows=200, seed=0):
+    rng = np.random.default_rng(seed)
+    X = pd.DataFrame(rng.normal(size=(rows, 4)), columns=['a', 'b', 'c', 'd'])
+    return X, (X['a'] - X['c'] + rng.normal(scale=0.5, size=rows)) > 0
+
+
+def selected_model(cols):
+    return Pipeline([('select', ColumnSelector(cols=cols)), ('scale', StandardScaler()), ('lr', LogisticRegression())])
+
+
+def test_compiled_plan_matches_sklearn():
+    X, y = training_data()
+    model = StackingClassifier([('ac', selected_model(['a', 'c'])), ('bd', selected_model(['b', 'd']))],
+                               final_estimator=LogisticRegression()).fit(X, y)
+    df = X[['d', 'c', 'b', 'a']].assign(extra=1.0) # other column order, and a column the model does not read
+
+    plan = get_inference_plan(model, df)
+    assert plan is not None
+    np.testing.assert_allclose(predict_proba(model, df), model.predict_proba(df), atol=1e-5)
+    assert get_inference_plan(model, df) is plan
+
+
+def test_unsupported_model_falls_back_to_sklearn(capsys):
+    X, y = training_data()
+    model = RandomForestClassifier(n_estimators=5, random_state=0).fit(X, y)
+
+    assert get_inference_plan(model, X) is None
+    assert 'Using sklearn inference for RandomForestClassifier' in capsys.readouterr().out
+    np.testing.assert_array_equal(predict_proba(model, X), model.predict_proba(X))
+
+
+def test_plan_differing_from_sklearn_falls_back(monkeypatch):
+    X, y = training_data()
+    model = selected_model(['a', 'b']).fit(X, y)
+    monkeypatch.setattr(inference_plan, 'CHECK_ATOL', -1.0)
+
+    assert get_inference_plan(model, X) is None
+    np.testing.assert_array_equal(predict_proba(model, X), model.predict_proba(X))
+
+
+def test_empty_input():
+    X, y = training_data()
+    model = selected_model(['a', 'b']).fit(X, y)
+
+    assert predict_proba(model, X.iloc[:0]).shape == (0, 2)
+
+
+@pytest.mark.filterwarnings('ignore:overflow encountered in cast')
+def test_batches_with_missing_or_infinite_values_run_through_sklearn():
+    X, y = training_data(rows=300)
+    model = selected_model(['a', 'b']).fit(X, y)
+    plan = get_inference_plan(model, X)
+    assert plan is not None
+
+    for value in [np.nan, np.inf]:
+        df = X.copy()
+        df.loc[250, 'a'] = value # after the rows checked when the plan was compiled
+        with pytest.raises(ValueError):
+            model.predict_proba(df)
+        with pytest.raises(ValueError):
+            plan.predict_proba(df, batch_rows=100)
+    # values outside float32 range are scored by sklearn in float64
+    df = X.copy()
+    df.loc[250, 'b'] = 1e300
+    proba = plan.predict_proba(df, batch_rows=100)
+    np.testing.assert_allclose(proba[200:], model.predict_proba(df.iloc[200:]), atol=1e-6)
+    np.testing.assert_allclose(proba[:200], model.predict_proba(df.iloc[:200]), atol=1e-5)
+
+
+def test_missing_values_imputed_by_the_model_stay_on_the_plan(monkeypatch):
+    X, y = training_data()
+    model = Pipeline([('impute', SimpleImputer()), ('lr', LogisticRegression())]).fit(X, y)
+    df = X.copy()
+    df.loc[150, 'c'] = np.nan
+    plan = get_inference_plan(model, df)
+    assert plan is not None
+
+    monkeypatch.setattr(model, 'predict_proba', lambda df: pytest.fail('scored by sklearn'))
+    assert np.isfinite(plan.predict_proba(df, batch_rows=100)).all()
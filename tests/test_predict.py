@@ -0,0 +1,97 @@
+import json
+import os
+import pickle
+import subprocess
+import sys
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+import pytest
+from mlxtend.feature_selection import ColumnSelector
+from sklearn.linear_model import LogisticRegression
+from sklearn.pipeline import Pipeline
+
+from feature_schema import with_position_key
+from predict import GT_100_TF_CHIP, predict_with_cache
+from variant_cache import VariantCache
+
+SCRIPT = os.path.join(os.path.dirname(__file__), '..', 'workflow', 'scripts', 'predict.py')
+VARIANTS = [('chr1', 10, 'A', 'G'), ('chr1', 10, 'A', 'T'), ('chr2', 20, 'C', 'G'), ('chrX', 30, 'G', 'A')]
+
+
+def model_ls(seed=0):
+    rng = np.random.default_rng(seed)
+    X = pd.DataFrame(rng.normal(size=(50, 2)), columns=['a', 'b'])
+    model = Pipeline([('select', ColumnSelector(cols=['a', 'b'])), ('lr', LogisticRegression())]).fit(X, X['a'] > X['b'])
+    return [['TLand', model], ['TLand_lightest', model]]
+
+
+def features(variants=VARIANTS):
+    keys_df = with_position_key(pd.DataFrame(variants, columns=['chrom', 'end', 'ref', 'alt']))
+    keys_df.insert(3, 'id', [f'rs{i}' for i in range(len(keys_df))])
+    generic = keys_df.assign(a=np.linspace(-1, 1, len(keys_df)), ref_match=[True, None, True, None][:len(keys_df)])
+    organsp = keys_df[['pos_key', 'chrom', 'end']].drop_duplicates().assign(b=0.5)
+    return keys_df, generic, organsp
+
+
+def test_only_scores_of_variants_with_sei_features_are_cached(tmp_path):
+    keys_df, generic, organsp = features()
+    cache = VariantCache(tmp_path, 'features', 'scores')
+    models = model_ls()
+
+    scores = predict_with_cache('liver', 'liver', keys_df, generic, organsp, cache, GT_100_TF_CHIP, models)
+    np.testing.assert_allclose(scores, models[0][1].predict_proba(generic.merge(organsp))[:, 1], rtol=1e-5)
+    cached = cache.get_scores('liver', keys_df)
+    assert sorted(zip(cached['chrom'], cached['alt'])) == [('chr1', 'G'), ('chr2', 'G')]
+
+    # Cached scores are read back, the others scored again from the features of the run
+    scores_again = predict_with_cache('liver', 'liver', keys_df, generic, organsp, cache, GT_100_TF_CHIP, models)
+    np.testing.assert_allclose(scores_again, scores)
+
+
+@pytest.fixture
+def run_inputs(tmp_path):
+    keys_df, generic, organsp = features()
+    models = {'TLand_organSp': model_ls(0)[0][1], 'TLand_organSp_lightest': model_ls(1)[0][1]}
+    for name, model in models.items():
+        with open(tmp_path / f'{name}.pickle', 'wb') as f:
+            pickle.dump(model, f)
+    generic.drop(columns='pos_key').to_parquet(tmp_path / 'generic.parquet', index=False)
+    (tmp_path / 'organsp').mkdir()
+    for organ_arg, b in [('liver', 0.5), ('heart', -0.5)]:
+        organsp.assign(b=b).drop(columns='pos_key').to_parquet(tmp_path / 'organsp' / f'{organ_arg}_features.parquet', index=False)
+    (tmp_path / 'organ_mapping.json').write_text(json.dumps({'liver': 'liver', 'heart': 'heart'}))
+    (tmp_path / 'organ_list.txt').write_text('liver\nheart\n')
+
+    # liver uses TLand (more than 100 TF ChIP-seq experiments), heart TLand lightest
+    expected = {organ_arg: models[name].predict_proba(generic.merge(organsp.assign(b=b)))[:, 1]
+                for organ_arg, name, b in [('liver', 'TLand_organSp', 0.5), ('heart', 'TLand_organSp_lightest', -0.5)]}
+    return tmp_path, keys_df, expected
+
+
+def run_predict(tmp_path, out_format):
+    subprocess.run([sys.executable, SCRIPT, '--generic_features', str(tmp_path / 'generic.parquet'), '--organsp_dir', str(tmp_path / 'organsp'),
+                    '--organs', 'liver', 'heart', '--organ_mapping_json', str(tmp_path / 'organ_mapping.json'),
+                    '--organ_list', str(tmp_path / 'organ_list.txt'), '--models_path', str(tmp_path), '--outdir', str(tmp_path / out_format),
+                    '--out_format', out_format], check=True)
+    return tmp_path / out_format
+
+
+def test_wide_output_matches_per_organ_output(run_inputs):
+    tmp_path, keys_df, expected = run_inputs
+    wide = pq.read_table(run_predict(tmp_path, 'parquet') / 'TLand_scores.parquet')
+    assert wide.schema.names == ['chrom', 'pos', 'ref', 'alt', 'liver', 'heart']
+    assert wide.schema.field('liver').type == pa.float32()
+    assert json.loads(wide.schema.metadata[b'tland_models']) == {'liver': 'TLand', 'heart': 'TLand_lightest'}
+    wide = wide.to_pandas()
+    assert wide[['chrom', 'pos', 'ref', 'alt']].values.tolist() == keys_df[['chrom', 'end', 'ref', 'alt']].values.tolist()
+
+    outdir = run_predict(tmp_path, 'tsv')
+    for organ_arg, column in [('liver', 'liver_TLand'), ('heart', 'heart_TLand_lightest')]:
+        per_organ = pd.read_csv(outdir / f'TLand_scores.{organ_arg}.tsv.gz', sep='\t')
+        assert list(per_organ.columns) == ['chrom', 'pos', 'ref', 'alt', column]
+        np.testing.assert_allclose(per_organ[column], expected[organ_arg], rtol=1e-5)
+        np.testing.assert_allclose(wide[organ_arg], per_organ[column], rtol=1e-6)
+    assert not np.allclose(wide['liver'], wide['heart'])
@@ -0,0 +1,52 @@
+import json
+import random
+
+import pytest
+
+from feature_schema import position_key
+from regdb_batch import merge_positions, read_bed_positions, record_keys, split_query_output
+
+
+def write_bed(path, positions):
+    '''BED file of positions, sorted and de-duplicated as written by prep_input_bed'''
+    path.write_text(''.join(sorted({f'{chrom}\t{end - 1}\t{end}\n' for chrom, end in positions})))
+    return str(path)
+
+
+def record(chrom, end):
+    return json.dumps({'chrom': chrom, 'end': end, 'features': {'DNase': end % 2 == 0}, 'peaks': []}) + '\n'
+
+
+def query(bed_file, jsonl_file):
+    '''Query output of a BED file, one record per position'''
+    positions = read_bed_positions(bed_file)
+    with open(jsonl_file, 'w') as f:
+        f.writelines(record(chrom, int(end)) for chrom, end in zip(positions['chrom'], positions['end']))
+
+
+@pytest.mark.parametrize('shards,block_lines', [(1, 100000), (3, 7)])
+def test_split_of_batched_query_matches_unit_queries(tmp_path, shards, block_lines):
+    rng = random.Random(0)
+    pool = [(rng.choice(['chr1', 'chr2', 'chr10', 'chrX']), rng.randint(1, 10**6)) for _ in range(120)]
+    units = [rng.sample(pool, 40) for _ in range(3)] + [[]]
+    beds = [write_bed(tmp_path / f'unit{i}.bed', positions) for i, positions in enumerate(units)]
+
+    total, unique = merge_positions(beds, tmp_path / 'batch', shards)
+    assert (total, unique) == (sum(len(set(positions)) for positions in units), len(set().union(*map(set, units))))
+    batched = []
+    for i in range(shards):
+        query(tmp_path / 'batch' / f'positions.{i}.bed', tmp_path / 'batch' / f'output.{i}.jsonl')
+        batched.append(str(tmp_path / 'batch' / f'output.{i}.jsonl'))
+
+    out_files = [str(tmp_path / f'unit{i}.jsonl') for i in range(len(units))]
+    records, written = split_query_output(batched, beds, out_files, block_lines)
+    assert (records, written) == (unique, total)
+    for bed, out_file in zip(beds, out_files):
+        query(bed, tmp_path / 'expected.jsonl')
+        with open(out_file) as f, open(tmp_path / 'expected.jsonl') as expected:
+            assert sorted(f) == sorted(expected)
+
+
+def test_record_keys_of_other_layouts():
+    lines = [record('chr1', 5).encode(), json.dumps({'peaks': [], 'end': 7, 'chrom': 'chrX'}).encode()]
+    assert list(record_keys(lines)) == list(position_key(['chr1', 'chrX'], [5, 7]))
@@ -0,0 +1,106 @@
+import json
+import random
+import subprocess
+import sys
+import threading
+
+import pytest
+
+import mock_regdb_server
+import regdb_server
+from regdb_client import RegDBClient, read_bed_positions, write_query_output
+
+# Stand-in for genomic-data-service's query module: the record of each BED line, in file order
+FAKE_SEARCH = '''import argparse, json
+parser = argparse.ArgumentParser()
+parser.add_argument('-f')
+parser.add_argument('--assembly')
+parser.add_argument('--peaks', action='store_true')
+args = parser.parse_args()
+records = {}
+with open('records.jsonl') as f:
+    for line in f:
+        record = json.loads(line)
+        records[(record['chrom'], record['end'])] = line
+with open(args.f) as f:
+    for line in f:
+        chrom, _, end = line.split('\\t')[:3]
+        print(records[(chrom, int(end))], end='')
+'''
+
+
+@pytest.fixture
+def gds_dir(tmp_path):
+    rng = random.Random(0)
+    gds_dir = tmp_path / 'genomic-data-service'
+    (gds_dir / 'utils').mkdir(parents=True)
+    (gds_dir / 'utils' / '__init__.py').write_text('')
+    (gds_dir / 'utils' / 'regulome_search_TLand.py').write_text(FAKE_SEARCH)
+    positions = [(f'chr{chrom}', end) for chrom in [1, 2, 10] for end in rng.sample(range(1, 10**6), 15)]
+    with open(gds_dir / 'records.jsonl', 'w') as f:
+        for chrom, end in positions:
+            f.write(json.dumps({'chrom': chrom, 'end': end, 'features': {}, 'peaks': [{'method': 'DNase-seq'}]}) + '\n')
+    # Lexicographically sorted and de-duplicated, as written by prep_input_bed
+    bed_lines = sorted({f'{chrom}\t{end - 1}\t{end}\n' for chrom, end in positions})
+    (tmp_path / 'reg_query_input.bed').write_text(''.join(bed_lines))
+    return gds_dir
+
+
+def gds_output(gds_dir, bed_file):
+    '''JSONL records written by the query run from gds_dir'''
+    return subprocess.run([sys.executable, '-m', 'utils.regulome_search_TLand', '-f', str(bed_file),
+                           '--assembly', 'GRCh38', '--peaks'], cwd=gds_dir, stdout=subprocess.PIPE, check=True).stdout
+
+
+def query_server(server, bed_file, out_file):
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    client = RegDBClient(f'http://127.0.0.1:{server.server_port}/', workers=4, batch_size=3, retries=30, backoff=0)
+    try:
+        write_query_output(client, read_bed_positions(bed_file), out_file)
+    finally:
+        client.close()
+        server.shutdown()
+        server.server_close()
+    return client
+
+
+def test_mock_server_output_matches_gds_query(gds_dir, tmp_path):
+    bed_file = tmp_path / 'reg_query_input.bed'
+    server = mock_regdb_server.make_server([str(gds_dir / 'records.jsonl')], fail_rate=0.5)
+    client = query_server(server, bed_file, tmp_path / 'regdb_query_output.jsonl')
+
+    assert client.retried > 0
+    assert (tmp_path / 'regdb_query_output.jsonl').read_bytes() == gds_output(gds_dir, bed_file)
+
+
+def test_server_runs_gds_query(gds_dir, tmp_path):
+    bed_file = tmp_path / 'reg_query_input.bed'
+    server = regdb_server.make_server(str(gds_dir), max_queries=2, fail_rate=0.3)
+    query_server(server, bed_file, tmp_path / 'regdb_query_output.jsonl')
+
+    assert (tmp_path / 'regdb_query_output.jsonl').read_bytes() == gds_output(gds_dir, bed_file)
+    # Batches of 3 positions are queried by the same worker processes, stopped with the server
+    assert server.query.started <= 2 < len(read_bed_positions(bed_file)) // 3
+    assert server.query.workers.empty()
+
+
+def test_failed_gds_query_is_a_server_error(gds_dir, tmp_path):
+    bed_file = tmp_path / 'unknown.bed'
+    bed_file.write_text('chr3\t99\t100\n')
+    server = regdb_server.make_server(str(gds_dir))
+    with pytest.raises(Exception, match='status 500'):
+        query_server(server, bed_file, tmp_path / 'regdb_query_output.jsonl')
+
+
+def test_query_errors_keep_the_worker(gds_dir):
+    search = regdb_server.RegulomeSearch(str(gds_dir), max_queries=1)
+    try:
+        with pytest.raises(RuntimeError, match='KeyError'):
+            search('chr3\t99\t100\n')
+        record = (gds_dir / 'records.jsonl').read_text().splitlines()[0]
+        chrom, end = json.loads(record)['chrom'], json.loads(record)['end']
+        assert search(f'{chrom}\t{end - 1}\t{end}\n') == (record + '\n').encode()
+        assert search.started == 1
+    finally:
+        search.close()
@@ -0,0 +1,131 @@
+from collections import defaultdict
+import json
+import random
+
+import numpy as np
+import pytest
+
+from regdb_store import (COUNT_FEATURES, GENERIC_FEATURES, PEAKS_FILE, PeakWriter, get_organ_sp_counts, read_peaks,
+                         read_variants, split_peaks_by_organ, write_store)
+
+ORGANS = ['brain', 'liver', 'blood', 'bodily fluid']
+HISTONES = ['H3K27ac', 'H3K36me3', 'H3K4me1', 'H3K4me3', 'H3K27me3', 'H3K9me3']
+
+
+# Reference counts, as computed from the query output JSON before the store was introduced
+def baseline_counts(var_json, organ):
+    results = defaultdict(int)
+    unique_targets = []
+    unique_biosamples = []
+    unique_biosamples_dnase = []
+    for exp in var_json['peaks']:
+        try:
+            if exp['method'] in ['DNase-seq', 'footprints', 'ChIP-seq']:
+                try:
+                    if exp['method'] == 'ChIP-seq' and exp['targets'][0].startswith('POLR'):
+                        continue
+                except IndexError:
+                    exp['targets'] = ['NA']
+                if organ in exp['organ_slims']:
+                    results[exp['method']] += 1
+                    if exp['method'] == 'ChIP-seq':
+                        unique_targets.append(exp['targets'][0])
+                        unique_biosamples.append(exp['biosample_term_name'])
+                    if exp['method'] == 'DNase-seq':
+                        unique_biosamples_dnase.append(exp['biosample_term_name'])
+        except KeyError:
+            continue
+    ctcf = 0
+    ctcf_biosamples = []
+    for exp in var_json['peaks']:
+        try:
+            if exp['method'] == 'ChIP-seq':
+                try:
+                    if exp['targets'][0].startswith('CTCF') and organ in exp['organ_slims']:
+                        ctcf += 1
+                        ctcf_biosamples.append(exp['biosample_term_name'])
+                except IndexError:
+                    continue
+        except KeyError:
+            continue
+    histones = defaultdict(int)
+    for exp in var_json['peaks']:
+        try:
+            if exp['method'] == 'Histone ChIP-seq' and organ in exp['organ_slims']:
+                histones[exp['target_label']] += 1
+        except KeyError:
+            continue
+    return ([results['DNase-seq'], results['footprints'], results['ChIP-seq'], len(set(unique_targets)),
+             len(set(unique_biosamples)), len(set(unique_biosamples_dnase)), ctcf, len(set(ctcf_biosamples))]
+            + [histones[histone] for histone in HISTONES[:5]])
+
+
+def random_peak(rng):
+    '''Function to draw a peak record, including the incomplete records found in query outputs'''
+    method = rng.choice(['DNase-seq', 'footprints', 'ChIP-seq', 'ChIP-seq', 'Histone ChIP-seq', 'FAIRE-seq', None])
+    exp = {'organ_slims': rng.sample(ORGANS, rng.randint(0, 3)) * rng.choice([1, 2]),
+           'biosample_term_name': rng.choice(['K562', 'HepG2', 'GM12878', 'liver', None])}
+    if method is not None:
+        exp['method'] = method
+    if exp['biosample_term_name'] is None:
+        del exp['biosample_term_name']
+    if method == 'ChIP-seq' and rng.random() < 0.9:
+        exp['targets'] = [] if rng.random() < 0.1 else [rng.choice(['CTCF', 'POLR2A', 'JUN', 'FOS', 'CTCFL'])]
+    if method == 'Histone ChIP-seq' and rng.random() < 0.9:
+        exp['target_label'] = rng.choice(HISTONES)
+    if rng.random() < 0.05:
+        del exp['organ_slims']
+    return exp
+
+
+def random_records(num_variants, seed=0):
+    rng = random.Random(seed)
+    records = []
+    for i in range(num_variants):
+        records.append({'chrom': f'chr{rng.randint(1, 3)}', 'end': 1000 + 10 * i,
+                        'features': {feature: rng.random() < 0.5 for feature in GENERIC_FEATURES},
+                        'peaks': [random_peak(rng) for _ in range(rng.randint(0, 12))]})
+    return records
+
+
+@pytest.mark.parametrize('batch_rows', [1_000_000, 7])
+def test_counts_match_query_output(tmp_path, monkeypatch, batch_rows):
+    monkeypatch.setattr(PeakWriter.__init__, '__defaults__', (batch_rows,))
+    records = random_records(300)
+    num_variants, num_peak_rows = write_store([json.dumps(record) + '\n' for record in records], tmp_path)
+
+    variants = read_variants(tmp_path)
+    peaks, vocab = read_peaks(tmp_path)
+    assert (num_variants, num_peak_rows) == (len(variants), len(peaks['var_idx']))
+    organ_rows = split_peaks_by_organ(peaks, vocab, ORGANS + ['heart'])
+    for organ in ORGANS + ['heart']:
+        counts = get_organ_sp_counts(peaks, vocab, organ_rows[organ], len(variants))
+        expected = [baseline_counts(json.loads(json.dumps(record)), organ) for record in records]
+        assert counts.shape == (len(records), len(COUNT_FEATURES))
+        np.testing.assert_array_equal(counts, expected, err_msg=organ)
+
+
+def test_first_record_of_a_position_is_kept(tmp_path):
+    records = random_records(2)
+    duplicate = dict(records[0], peaks=[])
+    write_store([json.dumps(record) for record in records + [duplicate]], tmp_path)
+
+    variants = read_variants(tmp_path)
+    assert list(zip(variants['chrom'], variants['end'])) == [(record['chrom'], record['end']) for record in records]
+
+
+def test_single_batch_peaks_are_memory_mapped(tmp_path):
+    write_store([json.dumps(record) for record in random_records(20)], tmp_path)
+
+    peaks, _ = read_peaks(tmp_path)
+    assert (tmp_path / PEAKS_FILE).exists()
+    assert all(not column.flags.owndata for column in peaks.values())
+
+
+def test_empty_store(tmp_path):
+    write_store([], tmp_path)
+
+    peaks, vocab = read_peaks(tmp_path)
+    assert all(len(column) == 0 for column in peaks.values())
+    counts = get_organ_sp_counts(peaks, vocab, split_peaks_by_organ(peaks, vocab, ['brain'])['brain'], 0)
+    assert counts.shape == (0, len(COUNT_FEATURES))
@@ -0,0 +1,70 @@
+import json
+import math
+import os
+
+import pytest
+
+from calibrate_resources import calibrate, read_records
+from resource_model import ResourceModel
+
+CALIBRATION = os.path.join(os.path.dirname(__file__), '..', 'resources', 'resource_model.json')
+
+
+def calibration():
+    with open(CALIBRATION) as f:
+        return json.load(f)
+
+
+def write_metrics(base_dir, unit, variants, organs=2):
+    '''Stage metrics of a unit whose jobs use 150 MB plus 2 KB per variant and 10 MB per organ, at 10000 variants per CPU second'''
+    metrics_dir = base_dir / unit / 'metrics'
+    metrics_dir.mkdir(parents=True)
+    records = {
+        'index_regdb_query': {'stage': 'index_regdb_query', 'peak_rss_mb': 100, 'cpu_s': 1.0,
+                              'counters': {'variants': variants, 'jsonl_bytes_read': variants * 3 * 1024}},
+        'predict': {'stage': 'predict', 'peak_rss_mb': 150 + 0.002 * variants + 10 * organs, 'cpu_s': variants / 10000,
+                    'counters': {'variants': variants, 'organs': organs}},
+        'extract_generic': {'stage': 'extract_generic', 'peak_rss_mb': 150 + 0.002 * variants, 'cpu_s': variants / 10000,
+                            'counters': {'variants': variants}},
+    }
+    for stage, record in records.items():
+        with open(metrics_dir / f'{stage}.json', 'w') as f:
+            json.dump(record, f)
+
+
+def test_fitted_model_predicts_the_memory_and_threads_of_the_jobs(tmp_path):
+    for i, (variants, organs) in enumerate([(10000, 1), (50000, 3), (200000, 2), (400000, 5)]):
+        write_metrics(tmp_path, f'unit{i}', variants, organs)
+    records = read_records([tmp_path])
+    assert {record['jsonl_mb'] for record in records if record['variants'] == 10000} == {10000 * 3 / 1024}
+
+    fitted, refitted = calibrate(calibration(), records)
+    assert sorted(refitted) == ['extract_generic', 'index_regdb_query', 'predict']
+    assert fitted['jsonl_mb_per_variant'] == pytest.approx(3 / 1024, rel=1e-3)
+    predict = fitted['stages']['predict']['mem_mb']
+    assert (predict['intercept'], predict['variants'], predict['organs']) == pytest.approx((150, 0.002, 10), rel=1e-3)
+    assert fitted['stages']['predict']['mem_mb']['threads'] == calibration()['stages']['predict']['mem_mb']['threads']
+    assert fitted['stages']['run_seq_class'] == calibration()['stages']['run_seq_class']
+
+    # as called by the mem_mb and threads of the rules
+    model = ResourceModel(fitted)
+    for attempt in [1, 2]:
+        expected = math.ceil((150 + 2000 + 40) * fitted['margin'] * attempt / 100) * 100
+        assert model.mem_mb('predict', 1000000, organs=4, attempt=attempt) == pytest.approx(expected, abs=100)
+    assert fitted['stages']['extract_generic']['variants_per_thread'] == 10000 * fitted['target_thread_seconds']
+    assert [model.threads('extract_generic', variants, 8) for variants in [0, 600000, 600001, 10**8]] == [1, 1, 2, 8]
+
+
+def test_memory_estimates_of_the_shipped_calibration():
+    model = ResourceModel.load(CALIBRATION)
+    stages = model.stages
+
+    assert model.mem_mb('predict', 0) == model.calibration['min_mem_mb']
+    one, four = model.mem_mb('run_seq_class', 10**6, threads=1), model.mem_mb('run_seq_class', 10**6, threads=4)
+    assert four - one == pytest.approx(3 * stages['run_seq_class']['mem_mb']['threads'] * model.calibration['margin'], abs=100)
+    # the query output size is estimated from the variants until it is known
+    assert model.mem_mb('index_regdb_query', 10**7) == model.mem_mb('index_regdb_query', 10**7, jsonl_mb=model.jsonl_mb(10**7))
+    assert model.mem_mb('index_regdb_query', 10**7, jsonl_mb=10**5) > model.mem_mb('index_regdb_query', 10**7)
+    assert model.threads('predict', 10**9, 3) == 3
+    for stage in stages:
+        assert model.mem_mb(stage, 10**6) % 100 == 0
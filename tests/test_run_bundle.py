@@ -0,0 +1,55 @@
+import json
+import os
+import subprocess
+import sys
+
+import pytest
+
+SCRIPTS_DIR = os.path.join(os.path.dirname(__file__), '..', 'workflow', 'scripts')
+
+# Job script: records whether its imports were preloaded, then prints, writes an output file and ends as asked
+JOB = '''import sys
+preloaded = 'stage_metrics' in sys.modules
+import os
+import stage_metrics
+print(f'preloaded={preloaded} args={sys.argv[1:]}')
+with open(sys.argv[1], 'w') as f:
+    f.write(str(os.getpid()))
+end = sys.argv[2]
+if end == 'exit':
+    sys.exit(3)
+elif end == 'raise':
+    raise RuntimeError('job failed')
+elif end == 'kill':
+    os.kill(os.getpid(), 9)
+'''
+
+
+def run_bundle(tmp_path, ends):
+    script = tmp_path / 'job.py'
+    script.write_text(JOB)
+    jobs = [{'script': str(script), 'args': [str(tmp_path / f'{i}.out'), end], 'log': str(tmp_path / f'{i}.log')} for i, end in enumerate(ends)]
+    env = dict(os.environ, PYTHONPATH=SCRIPTS_DIR)
+    return subprocess.run([sys.executable, os.path.join(SCRIPTS_DIR, 'run_bundle.py'), '--jobs', json.dumps(jobs)],
+                          env=env, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, text=True)
+
+
+def test_jobs_run_in_their_own_processes_with_preloaded_imports(tmp_path):
+    result = run_bundle(tmp_path, ['ok', 'ok'])
+    assert result.returncode == 0, result.stdout
+
+    pids = {(tmp_path / f'{i}.out').read_text() for i in range(2)}
+    assert len(pids) == 2
+    for i in range(2):
+        assert (tmp_path / f'{i}.log').read_text() == f"preloaded=True args=['{tmp_path / f'{i}.out'}', 'ok']\n"
+    assert 'Imported the modules of 2 jobs' in result.stdout
+
+
+@pytest.mark.parametrize('end,code,log', [('exit', 3, ''), ('raise', 1, 'RuntimeError: job failed'), ('kill', 128 + 9, '')])
+def test_failing_job_stops_the_bundle(tmp_path, end, code, log):
+    result = run_bundle(tmp_path, ['ok', end, 'ok'])
+
+    assert result.returncode == code
+    assert f'Job 2 failed with exit code {code}, see {tmp_path / "1.log"}' in result.stdout
+    assert (tmp_path / '1.out').exists() and not (tmp_path / '2.out').exists()
+    assert log in (tmp_path / '1.log').read_text()
@@ -0,0 +1,51 @@
+import json
+import os
+import subprocess
+import sys
+
+from run_report import read_metrics, summarize_stages
+
+SCRIPTS_DIR = os.path.join(os.path.dirname(__file__), '..', 'workflow', 'scripts')
+
+
+def write_record(path, stage, wall_s, peak_rss_mb, children_peak_rss_mb=0.0):
+    path.parent.mkdir(parents=True, exist_ok=True)
+    with open(path, 'w') as f:
+        json.dump({'stage': stage, 'wall_s': wall_s, 'cpu_s': wall_s, 'peak_rss_mb': peak_rss_mb,
+                   'children_peak_rss_mb': children_peak_rss_mb, 'phases': {}, 'counters': {'variants': 10}}, f)
+
+
+def test_stale_and_missing_files_are_not_counted(tmp_path):
+    metrics_dir = tmp_path / 'run' / 'metrics'
+    write_record(metrics_dir / 'extract_organsp.0.json', 'extract_organsp', 2.0, 100.0)
+    write_record(metrics_dir / 'extract_organsp.1.json', 'extract_organsp', 3.0, 50.0, 300.0)
+    write_record(metrics_dir / 'extract_organsp.2.json', 'extract_organsp', 50.0, 900.0) # left by a larger batching
+    metrics_files = [str(metrics_dir / f'extract_organsp.{i}.json') for i in range(2)] + [str(metrics_dir / 'predict.0.json')]
+
+    records = read_metrics(metrics_files)
+    stages = summarize_stages(records)
+    assert {record['unit_dir'] for record in records} == {str(tmp_path / 'run')}
+    assert list(stages) == ['extract_organsp']
+    stage = stages['extract_organsp']
+    assert (stage['jobs'], stage['wall_s'], stage['max_job_wall_s'], stage['peak_rss_mb']) == (2, 5.0, 3.0, 300.0)
+    assert stage['counters'] == {'variants': 20}
+
+
+def test_bundled_jobs_record_their_own_usage(tmp_path):
+    script = tmp_path / 'job.py'
+    script.write_text(
+        'import subprocess, sys\n'
+        'from stage_metrics import StageMetrics\n'
+        'metrics = StageMetrics("job", sys.argv[2])\n'
+        'with metrics.phase("work"):\n'
+        '    subprocess.run([sys.executable, "-c", f"b = bytearray({sys.argv[1]} * 2**20)"], check=True)\n'
+        'metrics.write()\n')
+    jobs = [{'script': str(script), 'args': [str(size), str(tmp_path / f'{i}.json')], 'log': str(tmp_path / f'{i}.log')}
+            for i, size in enumerate([300, 20])]
+    env = dict(os.environ, PYTHONPATH=SCRIPTS_DIR)
+    subprocess.run([sys.executable, os.path.join(SCRIPTS_DIR, 'run_bundle.py'), '--jobs', json.dumps(jobs)],
+                   check=True, env=env)
+
+    first, second = read_metrics([job['args'][1] for job in jobs])
+    assert first['children_peak_rss_mb'] > 300
+    assert second['children_peak_rss_mb'] < 200
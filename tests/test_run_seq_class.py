@@ -0,0 +1,123 @@
+import os
+import subprocess
+import sys
+
+import h5py
+import numpy as np
+import pandas as pd
+import pytest
+
+import run_seq_class
+from chunk_checkpoint import ChunkCheckpoint
+from run_seq_class import NUM_SEQCLASSES, get_projection, project_chunks
+
+SCRIPT = os.path.join(os.path.dirname(__file__), '..', 'workflow', 'scripts', 'run_seq_class.py')
+NUM_TARGETS = 60
+HISTONE_INDS = np.arange(5, NUM_TARGETS, 4)
+
+
+def baseline_proj(chromatin_profile_ref, chromatin_profile_alt, histone_inds, clustervfeat):
+    '''Sequence class score differences as computed before the projection was optimized'''
+    mean_histone = np.sum(chromatin_profile_ref[:, histone_inds], axis=1)*0.5 + np.sum(chromatin_profile_alt[:, histone_inds], axis=1)*0.5
+    ref_adjust = chromatin_profile_ref.copy()
+    ref_adjust[:, histone_inds] *= (mean_histone / np.sum(chromatin_profile_ref[:, histone_inds], axis=1))[:, None]
+    alt_adjust = chromatin_profile_alt.copy()
+    alt_adjust[:, histone_inds] *= (mean_histone / np.sum(chromatin_profile_alt[:, histone_inds], axis=1))[:, None]
+    refproj = np.dot(ref_adjust, clustervfeat.T) / np.linalg.norm(clustervfeat, axis=1)
+    altproj = np.dot(alt_adjust, clustervfeat.T) / np.linalg.norm(clustervfeat, axis=1)
+    diffproj = altproj[:, :40] - refproj[:, :40]
+    return diffproj, np.abs(diffproj).max(axis=1)
+
+
+@pytest.fixture
+def predictions(tmp_path):
+    rng = np.random.default_rng(0)
+    num_variants = 23
+    ref = rng.random((num_variants, NUM_TARGETS))
+    alt = ref * rng.uniform(0.5, 1.5, size=ref.shape)
+    for name, data in [('ref', ref), ('alt', alt)]:
+        with h5py.File(tmp_path / f'{name}.h5', 'w') as fh:
+            fh.create_dataset('data', data=data) # float64, as written by Sei
+    clustervfeat = rng.normal(size=(NUM_SEQCLASSES + 5, NUM_TARGETS))
+    return tmp_path, ref, alt, clustervfeat
+
+
+def project(tmp_path, clustervfeat, chunk_rows, threads=1, checkpoint=None):
+    with h5py.File(tmp_path / 'ref.h5', 'r') as ref_fh, h5py.File(tmp_path / 'alt.h5', 'r') as alt_fh:
+        return project_chunks(ref_fh['data'], alt_fh['data'], HISTONE_INDS, get_projection(clustervfeat),
+                              chunk_rows * 2 * NUM_TARGETS * 4, threads, checkpoint)
+
+
+@pytest.mark.parametrize('chunk_rows,threads', [(100, 1), (5, 1), (4, 3)])
+def test_projection_matches_baseline(predictions, chunk_rows, threads):
+    tmp_path, ref, alt, clustervfeat = predictions
+    expected_diffproj, expected_max_abs_diff = baseline_proj(ref, alt, HISTONE_INDS, clustervfeat)
+
+    diffproj, max_abs_diff = project(tmp_path, clustervfeat, chunk_rows, threads)
+    assert diffproj.dtype == np.float32
+    np.testing.assert_allclose(diffproj, expected_diffproj, rtol=1e-4, atol=1e-5)
+    np.testing.assert_allclose(max_abs_diff, expected_max_abs_diff, rtol=1e-4, atol=1e-5)
+
+
+def test_failed_run_resumes_from_checkpoint(predictions, monkeypatch):
+    tmp_path, ref, alt, clustervfeat = predictions
+    project_chunk = run_seq_class.project_chunk
+    projected = []
+
+    def failing_project_chunk(start, *args):
+        if start == 10:
+            raise RuntimeError('node lost')
+        projected.append(start)
+        project_chunk(start, *args)
+    monkeypatch.setattr(run_seq_class, 'project_chunk', failing_project_chunk)
+    with pytest.raises(RuntimeError, match='node lost'):
+        project(tmp_path, clustervfeat, 5, checkpoint=ChunkCheckpoint(tmp_path / 'checkpoint', {'chunk_rows': 5}))
+    done = sorted(projected)
+    assert 0 in done and 10 not in done
+
+    projected.clear()
+    monkeypatch.setattr(run_seq_class, 'project_chunk', lambda start, *args: (projected.append(start), project_chunk(start, *args)))
+    checkpoint = ChunkCheckpoint(tmp_path / 'checkpoint', {'chunk_rows': 5})
+    assert checkpoint.resumed == len(done)
+    diffproj, max_abs_diff = project(tmp_path, clustervfeat, 5, checkpoint=checkpoint)
+    assert sorted(projected) == sorted(set(range(0, 23, 5)) - set(done))
+
+    expected_diffproj, expected_max_abs_diff = baseline_proj(ref, alt, HISTONE_INDS, clustervfeat)
+    np.testing.assert_allclose(diffproj, expected_diffproj, rtol=1e-4, atol=1e-5)
+    np.testing.assert_allclose(max_abs_diff, expected_max_abs_diff, rtol=1e-4, atol=1e-5)
+
+
+def test_script_writes_sorted_unique_scores(predictions):
+    tmp_path, ref, alt, clustervfeat = predictions
+    sei_dir = tmp_path / 'sei'
+    sei_dir.mkdir()
+    (sei_dir / 'seqclass.names').write_text(''.join(f'class{i}\n' for i in range(len(clustervfeat))))
+    np.save(sei_dir / 'projvec_targets.npy', clustervfeat)
+    np.save(sei_dir / 'histone_inds.npy', HISTONE_INDS)
+
+    rng = np.random.default_rng(1)
+    labels = pd.DataFrame({'chrom': rng.choice(['chr1', 'chr2', 'chr10'], len(ref)), 'pos': rng.integers(1, 1000, len(ref))})
+    labels['id'] = [f'rs{i}' for i in range(len(ref))]
+    labels['ref'], labels['alt'], labels['strand'] = 'A', 'G', '+'
+    labels['ref_match'], labels['contains_unk'] = 'True', 'False'
+    labels.iloc[7] = labels.iloc[3] # duplicated variant, with the same predictions
+    ref[7], alt[7] = ref[3], alt[3]
+    profile_dir = tmp_path / 'results' / 'chromatin-profiles-hdf5'
+    profile_dir.mkdir(parents=True)
+    labels.to_csv(profile_dir / 'input_row_labels.txt', sep='\t', index=False)
+    for name, data in [('ref', ref), ('alt', alt)]:
+        with h5py.File(profile_dir / f'input.{name}_predictions.h5', 'w') as fh:
+            fh.create_dataset('data', data=data)
+
+    subprocess.run([sys.executable, SCRIPT, '-s', str(tmp_path / 'results'), '-i', str(tmp_path / 'input.vcf'), '-m', str(sei_dir),
+                    '-o', str(tmp_path / 'sei.parquet'), '--checkpoint_dir', str(tmp_path / 'checkpoint')], check=True)
+    output = pd.read_parquet(tmp_path / 'sei.parquet')
+
+    expected_diffproj, expected_max_abs_diff = baseline_proj(ref, alt, HISTONE_INDS, clustervfeat)
+    rows = labels.drop(index=7).sort_values(['chrom', 'pos'], kind='stable').index.to_numpy()
+    assert list(output['id']) == list(labels['id'].iloc[rows])
+    assert list(output.columns[:9]) == ['seqclass_max_absdiff', 'ref_match', 'contains_unk', 'chrom', 'pos', 'id', 'ref', 'alt', 'strand']
+    assert (output['strand'] == '.').all() and output['ref_match'].all() and not output['contains_unk'].any()
+    np.testing.assert_allclose(output[[f'class{i}' for i in range(NUM_SEQCLASSES)]].to_numpy(), expected_diffproj[rows], rtol=1e-4, atol=1e-5)
+    np.testing.assert_allclose(output['seqclass_max_absdiff'], expected_max_abs_diff[rows], rtol=1e-4, atol=1e-5)
+    assert not (tmp_path / 'checkpoint').exists()
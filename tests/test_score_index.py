@@ -0,0 +1,93 @@
+import json
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+import pytest
+
+from score_index import ScoreIndex, write_score_index
+
+
+def write_scores(path, rows):
+    '''Function to write a wide Parquet score file as predict.py --out_format parquet does'''
+    df = pd.DataFrame(rows, columns=['chrom', 'pos', 'ref', 'alt', 'liver', 'blood'])
+    df[['liver', 'blood']] = df[['liver', 'blood']].astype(np.float32)
+    pq.write_table(pa.Table.from_pandas(df, preserve_index=False), path)
+    return path
+
+
+def keys(rows):
+    return pd.DataFrame(rows, columns=['chrom', 'end', 'ref', 'alt'])
+
+
+@pytest.fixture
+def multiallelic_index(tmp_path):
+    '''Score index whose row groups of 2 rows split the alleles of chr1:200'''
+    score_file = write_scores(tmp_path / 'scores.parquet', [
+        ['chr1', 100, 'A', 'T', 0.1, 0.2],
+        ['chr1', 200, 'C', 'A', 0.3, 0.4],
+        ['chr1', 200, 'C', 'G', 0.5, 0.6],
+        ['chr1', 300, 'G', 'T', 0.7, 0.8],
+    ])
+    write_score_index([score_file], tmp_path / 'index', score_version='v1', chunk_rows=2)
+    return tmp_path / 'index'
+
+
+def test_allele_in_next_row_group(multiallelic_index):
+    scores = ScoreIndex(multiallelic_index).get_scores(keys([['chr1', 200, 'C', 'G']]), ['liver', 'blood'])
+
+    np.testing.assert_allclose(scores.to_numpy(), [[0.5, 0.6]], rtol=1e-6)
+
+
+def test_lookup_keeps_query_order_and_misses(multiallelic_index):
+    query = keys([['chr1', 300, 'G', 'T'], ['chr2', 100, 'A', 'T'], ['chr1', 200, 'C', 'A'], ['chr1', 150, 'A', 'T']])
+    scores = ScoreIndex(multiallelic_index).get_scores(query, ['liver', 'spleen'])
+
+    assert list(scores.columns) == ['liver', 'spleen']
+    np.testing.assert_allclose(scores['liver'].to_numpy(), [0.7, np.nan, 0.3, np.nan], rtol=1e-6)
+    assert scores['spleen'].isna().all()
+
+
+def test_chromosome_names_share_codes(multiallelic_index):
+    scores = ScoreIndex(multiallelic_index).get_scores(keys([['1', 100, 'A', 'T']]), ['liver'])
+
+    np.testing.assert_allclose(scores['liver'].to_numpy(), [0.1], rtol=1e-6)
+
+
+def test_last_file_wins(tmp_path):
+    first = write_scores(tmp_path / 'first.parquet', [['chr1', 100, 'A', 'T', 0.1, 0.2]])
+    second = write_scores(tmp_path / 'second.parquet', [['chr1', 100, 'A', 'T', 0.9, 0.8]])
+    write_score_index([first, second], tmp_path / 'index')
+
+    scores = ScoreIndex(tmp_path / 'index').get_scores(keys([['chr1', 100, 'A', 'T']]), ['liver'])
+    np.testing.assert_allclose(scores['liver'].to_numpy(), [0.9], rtol=1e-6)
+
+
+def test_score_version_mismatch(multiallelic_index):
+    with pytest.raises(ValueError):
+        ScoreIndex(multiallelic_index, score_version='v2')
+    ScoreIndex(multiallelic_index, score_version='v1')
+
+
+def test_chromosome_names_share_one_file(tmp_path):
+    first = write_scores(tmp_path / 'first.parquet', [['chr1', 100, 'A', 'T', 0.1, 0.2], ['chr1', 200, 'C', 'G', 0.3, 0.4]])
+    second = write_scores(tmp_path / 'second.parquet', [['1', 100, 'A', 'T', 0.9, 0.8], ['chrX', 5, 'G', 'A', 0.5, 0.5]])
+    index = write_score_index([first, second], tmp_path / 'index')
+
+    assert sorted(index['chroms']) == ['chr1', 'chrX']
+    assert index['chroms']['chr1']['rows'] == 2
+    scores = ScoreIndex(tmp_path / 'index').get_scores(keys([['1', 100, 'A', 'T'], ['chr1', 200, 'C', 'G']]), ['liver'])
+    np.testing.assert_allclose(scores['liver'].to_numpy(), [0.9, 0.3], rtol=1e-6)
+
+
+def test_index_with_a_file_per_chromosome_name_is_rejected(tmp_path):
+    write_scores(tmp_path / 'chr1.parquet', [['chr1', 100, 'A', 'T', 0.1, 0.2]])
+    write_scores(tmp_path / '1.parquet', [['1', 100, 'A', 'T', 0.9, 0.8]])
+    first = write_score_index([tmp_path / 'chr1.parquet'], tmp_path / 'index')
+    second = write_score_index([tmp_path / '1.parquet'], tmp_path / 'other')
+    first['chroms'].update(second['chroms']) # as built before chromosome names were merged
+    (tmp_path / 'index' / 'index.json').write_text(json.dumps(first))
+
+    with pytest.raises(ValueError, match='several files for chromosome'):
+        ScoreIndex(tmp_path / 'index')
@@ -0,0 +1,114 @@
+from concurrent.futures import ThreadPoolExecutor
+import json
+import os
+import pickle
+import threading
+import urllib.error
+import urllib.request
+
+import numpy as np
+import pandas as pd
+import pyBigWig
+import pytest
+from mlxtend.feature_selection import ColumnSelector
+from sklearn.linear_model import LogisticRegression
+from sklearn.pipeline import Pipeline
+
+import mock_regdb_server
+import tland_server
+from extract_organsp_features import ORGANSP_SIGNAL_FEATURES
+from feature_schema import with_position_key
+from regdb_store import GENERIC_FEATURES
+from variant_cache import VariantCache
+
+RESOURCES = os.path.join(os.path.dirname(__file__), '..', 'resources')
+MODEL_COLUMNS = ['DNase_var', 'DNASE_organSp', 'CHIP_organSp', 'DNase_var_organSp']
+CACHED = [('chr1', 1500, 'A', 'G'), ('chr1', 1500, 'A', 'T'), ('chr2', 2500, 'C', 'G')]
+UNCACHED = ('chr2', 7500, 'G', 'T')
+
+
+@pytest.fixture
+def scorer(tmp_path):
+    rng = np.random.default_rng(0)
+    X = pd.DataFrame(rng.normal(size=(50, len(MODEL_COLUMNS))), columns=MODEL_COLUMNS)
+    model = Pipeline([('select', ColumnSelector(cols=MODEL_COLUMNS)), ('lr', LogisticRegression())]).fit(X, X.sum(axis=1) > 0)
+    for name in ['TLand_organSp.pickle', 'TLand_organSp_lightest.pickle']:
+        with open(tmp_path / name, 'wb') as f:
+            pickle.dump(model, f)
+
+    for feature in ORGANSP_SIGNAL_FEATURES:
+        bw = pyBigWig.open(str(tmp_path / f'{feature}_liver.bw'), 'w')
+        bw.addHeader([('chr1', 10000), ('chr2', 10000)])
+        for chrom in ['chr1', 'chr2']:
+            bw.addEntries(chrom, 0, values=list(rng.random(100)), span=100, step=100)
+        bw.close()
+
+    with open(tmp_path / 'regdb.jsonl', 'w') as f:
+        for chrom, end in sorted({(chrom, end) for chrom, end, _, _ in CACHED + [UNCACHED]}):
+            peaks = [{'method': 'DNase-seq', 'organ_slims': ['liver'], 'biosample_term_name': 'HepG2'}] * (end // 1000)
+            peaks.append({'method': 'ChIP-seq', 'targets': ['JUN'], 'organ_slims': ['liver', 'blood'], 'biosample_term_name': 'HepG2'})
+            f.write(json.dumps({'chrom': chrom, 'end': end, 'features': {feature: True for feature in GENERIC_FEATURES}, 'peaks': peaks}) + '\n')
+    regdb = mock_regdb_server.make_server([str(tmp_path / 'regdb.jsonl')], fail_rate=0.3)
+    threading.Thread(target=regdb.serve_forever, daemon=True).start()
+
+    cache = VariantCache(tmp_path / 'cache', 'features', 'scores')
+    cache.put_generic(with_position_key(pd.DataFrame(CACHED, columns=['chrom', 'end', 'ref', 'alt']).assign(DNase_var=[0.5, -1.0, 2.0])))
+    scorer = tland_server.TLandScorer(tmp_path, {'liver': 'liver'}, os.path.join(RESOURCES, 'total_num'), tmp_path, cache,
+                                      f'http://127.0.0.1:{regdb.server_port}/', flush_seconds=3600)
+    scorer.regdb.retries, scorer.regdb.backoff = 20, 0
+    server = tland_server.make_server(scorer)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    yield scorer, f'http://127.0.0.1:{server.server_port}', model
+    server.shutdown()
+    regdb.shutdown()
+    scorer.close()
+
+
+def post(url, body):
+    request = urllib.request.Request(f'{url}/score', data=json.dumps(body).encode(), method='POST')
+    try:
+        with urllib.request.urlopen(request) as response:
+            return response.status, json.load(response)
+    except urllib.error.HTTPError as e:
+        return e.code, json.load(e)
+
+
+def test_scores_cached_variants_and_flags_the_others(scorer):
+    scorer, url, model = scorer
+    variants = [{'chrom': chrom, 'pos': end, 'ref': ref, 'alt': alt} for chrom, end, ref, alt in CACHED + [UNCACHED]]
+    with ThreadPoolExecutor(4) as pool:
+        answers = list(pool.map(lambda _: post(url, {'variants': variants, 'organs': ['liver']}), range(4)))
+
+    status, answer = answers[0]
+    assert status == 200
+    assert all(other_status == 200 and other['scores'] == answer['scores'] for other_status, other in answers)
+    assert answer['scores'][-1] == dict(variants[-1], liver=None, status=tland_server.NOT_IN_CACHE)
+    scores = pd.DataFrame(answer['scores'])
+    assert list(scores['status']) == [tland_server.SCORED] * len(CACHED) + [tland_server.NOT_IN_CACHE]
+
+    # New rows reach the variant cache when the writer flushes them, not while answering
+    keys_df = pd.DataFrame(CACHED, columns=['chrom', 'end', 'ref', 'alt'])
+    assert scorer.cache.get_scores('liver', keys_df).empty
+    scorer.writer.flush()
+    assert len(scorer.cache.get_scores('liver', keys_df)) == len(CACHED)
+
+    # Scores of the model on the cached generic features and the organ-specific features from the RegDB query
+    organsp = scorer.cache.get_organsp('liver', pd.DataFrame(CACHED, columns=['chrom', 'end', 'ref', 'alt'])[['chrom', 'end']])
+    assert sorted(organsp['DNASE_organSp']) == [1, 2]
+    features = scorer.cache.get_generic(scores.rename(columns={'pos': 'end'}).iloc[:len(CACHED)])
+    features = features.merge(organsp.drop(columns=['chrom', 'end']), on='pos_key')
+    expected = with_position_key(scores.rename(columns={'pos': 'end'})).merge(
+        features.assign(expected=model.predict_proba(features)[:, 1])[['pos_key', 'ref', 'alt', 'expected']], on=['pos_key', 'ref', 'alt'])
+    np.testing.assert_allclose(expected['liver'].astype(float), expected['expected'], atol=1e-4)
+
+
+def test_scoring_errors_are_server_errors(scorer, monkeypatch):
+    scorer, url, _ = scorer
+
+    def fail(keys_df, organ_args):
+        raise RuntimeError('RegulomeDB query failed')
+    monkeypatch.setattr(scorer, 'score', fail)
+
+    status, answer = post(url, {'variants': [{'chrom': 'chr1', 'pos': 1500, 'ref': 'A', 'alt': 'G'}]})
+    assert status == 500
+    assert answer == {'error': 'RuntimeError: RegulomeDB query failed'}
@@ -0,0 +1,123 @@
+import fcntl
+import os
+
+import numpy as np
+import pandas as pd
+import pyarrow.parquet as pq
+
+import variant_cache
+from cache_versions import get_feature_version
+from feature_schema import with_position_key
+from variant_cache import VariantCache, get_uncached_mask, read_vcf_keys
+
+
+def scores_df(variants, score):
+    return with_position_key(pd.DataFrame(variants, columns=['chrom', 'end', 'ref', 'alt']).assign(score=score, model='TLand'))
+
+
+def keys_df(variants):
+    return pd.DataFrame(variants, columns=['chrom', 'end', 'ref', 'alt'])
+
+
+def test_latest_row_of_each_key_is_read(tmp_path):
+    cache = VariantCache(tmp_path, 'features', 'scores')
+    cache.put_scores('liver', scores_df([('chr1', 10, 'A', 'G'), ('chr1', 10, 'A', 'T')], 0.1))
+    cache.put_scores('liver', scores_df([('chr1', 10, 'A', 'G')], 0.2))
+
+    cached = cache.get_scores('liver', keys_df([('chr1', 10, 'A', 'G'), ('chr1', 10, 'A', 'T'), ('chr2', 10, 'A', 'G')]))
+    assert sorted(zip(cached['alt'], cached['score'])) == [('G', 0.2), ('T', 0.1)]
+    assert cache.get_scores('blood', keys_df([('chr1', 10, 'A', 'G')])).empty
+
+
+def test_parts_are_merged_in_tiers(tmp_path, monkeypatch):
+    monkeypatch.setattr(variant_cache, 'COMPACT_PARTS', 2)
+    monkeypatch.setattr(variant_cache, 'COMPACT_ROW_GROUP_ROWS', 3)
+    cache = VariantCache(tmp_path, 'features', 'scores')
+    table_dir = tmp_path / 'scores' / 'scores' / 'liver'
+    rng = np.random.default_rng(0)
+    expected = {}
+    for i in range(9):
+        variants = [(chrom, int(end), 'A', 'G') for chrom, end in zip(rng.choice(['chr1', 'chr2', 'chrX'], 6), rng.integers(1, 20, 6))]
+        cache.put_scores('liver', scores_df(variants, float(i)))
+        expected.update({variant: float(i) for variant in variants})
+
+    # 9 writes: tier 0 runs merged after writes 3, 6 and 9, tier 1 runs after write 9
+    runs = {variant_cache.part_run(part) for part in table_dir.glob('part-*.parquet')}
+    assert sorted(tier for tier, _ in runs) == [2]
+    parts = sorted(table_dir.glob('part-*.parquet'))
+    chroms = [set(pd.read_parquet(part)['chrom'].astype(str)) for part in parts]
+    assert sorted(chrom for part_chroms in chroms for chrom in part_chroms) == sorted({chrom for chrom, *_ in expected})
+    for part in parts:
+        ends = pd.read_parquet(part)['end'].to_numpy()
+        assert np.all(ends[1:] >= ends[:-1])
+        assert pq.ParquetFile(part).metadata.row_group(0).num_rows <= 3
+
+    cached = cache.get_scores('liver', keys_df(list(expected)))
+    assert dict(zip(cached[['chrom', 'end', 'ref', 'alt']].itertuples(index=False, name=None), cached['score'])) == expected
+
+    # Writes only merge the runs of the lower tiers, and parts written after a merge take precedence over the merged ones
+    variant = next(iter(expected))
+    for score in [97.0, 98.0, 99.0]:
+        cache.put_scores('liver', scores_df([variant], score))
+    assert sorted(tier for tier, _ in {variant_cache.part_run(part) for part in table_dir.glob('part-*.parquet')}) == [1, 2]
+    assert set(parts) < set(table_dir.glob('part-*.parquet'))
+    assert list(cache.get_scores('liver', keys_df([variant]))['score']) == [99.0]
+
+
+def test_parts_of_earlier_versions_are_tier_0_runs(tmp_path, monkeypatch):
+    monkeypatch.setattr(variant_cache, 'COMPACT_PARTS', 2)
+    cache = VariantCache(tmp_path, 'features', 'scores')
+    table_dir = tmp_path / 'scores' / 'scores' / 'liver'
+    table_dir.mkdir(parents=True)
+    for i in range(2):
+        scores_df([('chr1', i, 'A', 'G')], float(i)).to_parquet(table_dir / f'part-{i:032x}.parquet', index=False)
+    cache.put_scores('liver', scores_df([('chr1', 0, 'A', 'G')], 5.0))
+    assert [variant_cache.part_run(part)[0] for part in table_dir.glob('part-*.parquet')] == [1]
+    assert list(cache.get_scores('liver', keys_df([('chr1', 0, 'A', 'G')]))['score']) == [5.0]
+
+
+def test_merge_is_skipped_while_another_process_merges(tmp_path, monkeypatch):
+    monkeypatch.setattr(variant_cache, 'COMPACT_PARTS', 2)
+    cache = VariantCache(tmp_path, 'features', 'scores')
+    table_dir = tmp_path / 'scores' / 'scores' / 'liver'
+    cache.put_scores('liver', scores_df([('chr1', 1, 'A', 'G')], 0.0))
+    with open(table_dir / '.compact.lock', 'w') as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        for i in range(1, 4):
+            cache.put_scores('liver', scores_df([('chr1', i, 'A', 'G')], float(i)))
+        assert len(list(table_dir.glob('part-*.parquet'))) == 4
+    cache.put_scores('liver', scores_df([('chr1', 1, 'A', 'G')], 5.0))
+    assert [variant_cache.part_run(part)[0] for part in table_dir.glob('part-*.parquet')] == [1]
+    assert list(cache.get_scores('liver', keys_df([('chr1', 1, 'A', 'G')]))['score']) == [5.0]
+
+
+def test_uncached_mask(tmp_path):
+    cache = VariantCache(tmp_path, 'features', 'scores')
+    variants = [('chr1', 10, 'A', 'G'), ('chr1', 20, 'A', 'G'), ('chr1', 30, 'A', 'G')]
+    cache.put_scores('liver', scores_df(variants[:1], 0.5))
+    cache.put_generic(with_position_key(keys_df(variants[1:])).assign(DNase_var=1.0))
+    cache.put_organsp('liver', with_position_key(keys_df(variants[1:2])[['chrom', 'end']]).assign(DNASE_organSp=1))
+
+    np.testing.assert_array_equal(get_uncached_mask(cache, keys_df(variants), ['liver']), [False, False, True])
+
+
+def test_feature_version_follows_regdb_version(tmp_path):
+    paths = []
+    for name in ['dnase', 'chip', 'organsp', 'total_num', 'sei']:
+        os.makedirs(tmp_path / name)
+        (tmp_path / name / 'file').write_text(name)
+        paths.append(str(tmp_path / name))
+
+    version = get_feature_version(*paths)
+    assert get_feature_version(*paths, '') == version
+    assert get_feature_version(*paths, '2024-01') not in (version, get_feature_version(*paths, '2024-06'))
+
+
+def test_vcf_alleles_are_read_as_written(tmp_path):
+    (tmp_path / 'input.vcf').write_text('chr1\t10\trs1\tNA\tN/A\nchr2\t20\t.\tA\tnan\n')
+    keys_df = read_vcf_keys(tmp_path / 'input.vcf')
+    assert keys_df[['chrom', 'end', 'id', 'ref', 'alt']].values.tolist() == [['chr1', 10, 'rs1', 'NA', 'N/A'], ['chr2', 20, '.', 'A', 'nan']]
+
+    cache = VariantCache(tmp_path, 'features', 'scores')
+    cache.put_scores('liver', scores_df([('chr1', 10, 'NA', 'N/A')], 0.5))
+    assert list(cache.get_scores('liver', keys_df)['score']) == [0.5]
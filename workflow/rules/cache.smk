@@ -0,0 +1,29 @@
+import os
+
+# 0) Split each unit's variants into those served by the score index or the variant cache and those that go
+# through the feature rules. A checkpoint, so that units whose variants are all served skip the feature rules.
+if SPLIT_VARIANTS:
+    checkpoint split_cached_variants:
+        input:
+            vcf=lambda wc: UNITS[wc.unit]["VCF"]
+        output:
+            vcf=os.path.join(
+                BASE, "{unit}", "work", "uncached.vcf"
+            )
+        params:
+            organs=lambda wc: " ".join(UNITS[wc.unit]["ORGANS"]),
+            cache_args=lambda wc: cache_args(wc.unit, scores=True)
+        log:
+            os.path.join(
+                BASE, "{unit}", "logs", "split_cached_variants.log"
+            )
+        conda:
+            "../envs/TLand.yml"
+        shell:
+            """
+            python workflow/scripts/variant_cache.py \
+                --input_vcf {input.vcf} \
+                --organs {params.organs} \
+                {params.cache_args} \
+                --out {output.vcf} &> {log}
+            """
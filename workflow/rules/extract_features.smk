@@ -4,54 +4,98 @@ from snakemake.io import directory
 # 1) Prep input bed file for RegulomeDB query from vcf-like file (chr, pos, id, ref, alt)
 rule prep_input_bed:
     input:
-        vcf=lambda wc: RUN_PARAMS[wc.run]["VCF"]
+        vcf=work_vcf
     output:
         bed=os.path.join(
-            BASE, "{run}", "work", "reg_query_input.bed"
+            BASE, "{unit}", "work", "reg_query_input.bed"
         )
     shell:
         """
         awk -F"\t" 'BEGIN{{OFS="\t"}} {{print $1, $2-1, $2}}' {input.vcf} | sort | uniq > {output.bed}
         """
 
-# 2a) Query variants from the database (requires running from specific directory)
-rule query_variants:
+# 2a) Query variants from the database (requires running from specific directory). With `batch_regdb_query`,
+# the positions of all units are queried together instead (see rules/regdb_batch.smk)
+if not BATCH_REGDB_QUERY:
+    rule query_variants:
+        input:
+            bed=os.path.join(
+                BASE, "{unit}", "work", "reg_query_input.bed"
+            )
+        output:
+            jsonl=os.path.join(
+                BASE, "{unit}", "work", "regdb_query_output.jsonl"
+            )
+        log:
+            os.path.join(
+                BASE, "{unit}", "logs", "reg_query.log"
+            )
+        conda:
+            "../envs/gds.yml"
+        resources:
+            queries=1,
+            mem_mb=lambda wc, attempt: job_mem_mb("query_variants", wc.unit, attempt=attempt)
+        params:
+            regdb_url=REGDB_URL,
+            workers=config.get("regdb_query_workers", 8),
+            metrics=lambda wc: metrics_path(wc.unit, "query_variants")
+        shell:
+            """
+            if [ -n "{params.regdb_url}" ]; then
+                python workflow/scripts/regdb_client.py \
+                    --bed {input.bed} \
+                    --url {params.regdb_url} \
+                    --workers {params.workers} \
+                    --metrics {params.metrics} \
+                    --out {output.jsonl} &> {log}
+            else
+                cd {config[gds_dir]}
+                python -m utils.regulome_search_TLand \
+                    -f {input.bed} \
+                    --assembly GRCh38 \
+                    --peaks 1> {output.jsonl} 2> {log}
+            fi
+            """
+
+# 2a') Flatten the query output into an integer-coded columnar store read by the feature extractors
+rule index_regdb_query:
     input:
-        bed=os.path.join(
-            BASE, "{run}", "work", "reg_query_input.bed"
-        )
-    output:
         jsonl=os.path.join(
-            BASE, "{run}", "work", "regdb_query_output.jsonl"
+            BASE, "{unit}", "work", "regdb_query_output.jsonl"
         )
+    output:
+        store=directory(os.path.join(
+            BASE, "{unit}", "work", "regdb_store"
+        ))
     log:
         os.path.join(
-            BASE, "{run}", "logs", "reg_query.log"
+            BASE, "{unit}", "logs", "index_regdb_query.log"
         )
     conda:
-        "../envs/gds.yml"
+        "../envs/TLand.yml"
+    params:
+        metrics=lambda wc: metrics_path(wc.unit, "index_regdb_query")
     resources:
-        queries=1
+        mem_mb=lambda wc, attempt: job_mem_mb("index_regdb_query", wc.unit, attempt=attempt)
     shell:
         """
-        cd {config[gds_dir]}
-        python -m utils.regulome_search_TLand \
-            -f {input.bed} \
-            --assembly GRCh38 \
-            --peaks 1> {output.jsonl} 2> {log}
+        python workflow/scripts/regdb_store.py \
+            --input_jsonl {input.jsonl} \
+            --outdir {output.store} \
+            --metrics {params.metrics} &> {log}
         """
 
 # 2b) Run Sei on input VCF
 rule run_sei_vep:
     input:
-        vcf=lambda wc: RUN_PARAMS[wc.run]["VCF"]
+        vcf=work_vcf
     output:
         outdir=temp(directory(os.path.join(
-            BASE, "{run}", "work", "sei", "sei_output"
+            BASE, "{unit}", "work", "sei", "sei_output"
         )))
     log:
         os.path.join(
-            BASE, "{run}", "logs", "run_sei_pipeline.log"
+            BASE, "{unit}", "logs", "run_sei_pipeline.log"
         )
     conda:
         "../envs/sei.yml"
@@ -65,84 +109,186 @@ rule run_sei_vep:
 
 rule run_sei_seq_class:
     input:
-        vcf=lambda wc: RUN_PARAMS[wc.run]["VCF"],
+        vcf=work_vcf,
         vep_outdir=os.path.join(
-            BASE, "{run}", "work", "sei", "sei_output"
+            BASE, "{unit}", "work", "sei", "sei_output"
         ),
         sei_model_dir=config["sei_dir"]+"/model"
     output:
         features=os.path.join(
-            BASE, "{run}", "work", "sei", "sei_final_output", "sei_features.tsv"
+            BASE, "{unit}", "work", "sei", "sei_final_output", "sei_features.parquet"
         )
     log:
         os.path.join(
-            BASE, "{run}", "logs", "run_seq_class.log"
+            BASE, "{unit}", "logs", "run_seq_class.log"
         )
     conda:
         "../envs/sei.yml"
+    params:
+        metrics=lambda wc: metrics_path(wc.unit, "run_seq_class"),
+        checkpoint_args=lambda wc: checkpoint_args(wc.unit, "run_seq_class")
+    threads: lambda wc: job_threads("run_seq_class", wc.unit, config["threads_seq_class"])
+    resources:
+        mem_mb=lambda wc, threads, attempt: job_mem_mb("run_seq_class", wc.unit, threads=threads, attempt=attempt)
     shell:
         """
-        python workflow/scripts/run_seq_class.py -s {input.vep_outdir} -i {input.vcf} -m {input.sei_model_dir} -o {output.features} &> {log}
+        python workflow/scripts/run_seq_class.py -s {input.vep_outdir} -i {input.vcf} -m {input.sei_model_dir} -o {output.features} --threads {threads} --metrics {params.metrics} {params.checkpoint_args} &> {log}
         """
 
 # 2) Extract generic features
 rule extract_generic:
     input:
-        vcf=lambda wc: RUN_PARAMS[wc.run]["VCF"],
-        jsonl=os.path.join(
-            BASE, "{run}", "work", "regdb_query_output.jsonl"
+        vcf=work_vcf,
+        regdb_store=os.path.join(
+            BASE, "{unit}", "work", "regdb_store"
         ),
         sei_features=os.path.join(
-            BASE, "{run}", "work", "sei", "sei_final_output", "sei_features.tsv"
+            BASE, "{unit}", "work", "sei", "sei_final_output", "sei_features.parquet"
         )
     output:
         parquet=os.path.join(
-            BASE, "{run}", "work", "generic_features.parquet"
+            BASE, "{unit}", "work", "generic_features.parquet"
         )
     log:
         os.path.join(
-            BASE, "{run}", "logs", "extract_generic_features.log"
+            BASE, "{unit}", "logs", "extract_generic_features.log"
         )
     conda:
         "../envs/TLand.yml"
+    params:
+        cache_args=lambda wc: cache_args(wc.unit),
+        metrics=lambda wc: metrics_path(wc.unit, "extract_generic"),
+        checkpoint_args=lambda wc: checkpoint_args(wc.unit, "extract_generic"),
+        block_rows=config.get("generic_block_rows", 0)
+    threads: lambda wc: job_threads("extract_generic", wc.unit, config["threads_extract_generic"])
     resources:
-        mem_mb=config["memory_extract_generic_mb"]
+        mem_mb=lambda wc, threads, attempt: job_mem_mb(
+            "extract_generic", wc.unit, threads=threads, attempt=attempt, fixed=config["memory_extract_generic_mb"],
+            max_variants=config.get("generic_block_rows", 0)
+        )
     shell:
         """
         python workflow/scripts/extract_generic_features.py \
             --input_vcf {input.vcf} \
-            --input_jsonl {input.jsonl} \
+            --regdb_store {input.regdb_store} \
             --input_sei {input.sei_features} \
             --dnase_sig_path {config[dnase_sig_path]} \
             --chip_sig_path {config[chip_sig_path]} \
-            --out {output.parquet} &> {log}
+            --threads {threads} \
+            --block_rows {params.block_rows} \
+            --metrics {params.metrics} \
+            --out {output.parquet} {params.cache_args} {params.checkpoint_args} &> {log}
         """
-# 3) Extract organ-specific features in parallel
-rule extract_organsp_features:
-    input:
-        jsonl=os.path.join(
-            BASE, "{run}", "work", "regdb_query_output.jsonl"
-        ),
-        total_num_path=config["total_num_path"]
-    output:
-        parquet=os.path.join(
-            BASE, "{run}", "work", "organsp_features", "{organ}_features.parquet"
-        )
-    log:
-        os.path.join(
-            BASE, "{run}", "logs", "extract_{organ}_features.log"
-        )
-    conda:
-        "../envs/TLand.yml"
-    resources:
-        mem_mb=config["memory_extract_organsp_mb"]
-    shell:
-        """
-        python workflow/scripts/extract_organsp_features.py \
-           --input_jsonl {input.jsonl} \
-           --organ {wildcards.organ} \
-           --organsp_dnase_sig_path {config[organsp_dnase_sig_path]} \
-           --total_num_path {input.total_num_path} \
-           --organ_mapping_json {config[organ_mapping_json]} \
-           --out {output.parquet} &> {log}
-        """
\ No newline at end of file
+# 3) Extract organ-specific features. The RegDB store is read once per job, so each job covers a batch
+# of organs (all of a unit's organs unless `organsp_organs_per_job` is set). With `bundle_jobs`, the jobs of
+# several units run together as one job.
+ORGANSP_JOBS = [
+    (unit, i, organs)
+    for unit in UNITS
+    for i, organs in enumerate(batch_organs(UNITS[unit]["ORGANS"], config.get("organsp_organs_per_job", 0)))
+]
+
+
+def organsp_log(unit, i):
+    return os.path.join(BASE, unit, "logs", f"extract_organsp_features.{i}.log")
+
+
+def organsp_job(unit, i, organs, threads):
+    """Script, command line arguments and log of an organ-specific feature job of a bundle, with at most `threads` threads."""
+    args = [
+        "--regdb_store", os.path.join(BASE, unit, "work", "regdb_store"),
+        "--organs", *organs,
+        "--organsp_dnase_sig_path", config["organsp_dnase_sig_path"],
+        "--total_num_path", config["total_num_path"],
+        "--organ_mapping_json", config["organ_mapping_json"],
+        "--threads", str(min(threads, job_threads("extract_organsp", unit, config["threads_extract_organsp"]))),
+        "--metrics", metrics_path(unit, "extract_organsp", i),
+        "--outdir", os.path.join(BASE, unit, "work", "organsp_features"),
+    ]
+    args += cache_args(unit).split() + checkpoint_args(unit, "extract_organsp", i).split()
+    return {"script": "workflow/scripts/extract_organsp_features.py", "args": args, "log": organsp_log(unit, i)}
+
+
+if BUNDLE_JOBS <= 1:
+    for unit, i, organs in ORGANSP_JOBS:
+        rule:
+            name: rule_name("extract_organsp_features", unit, i)
+            input:
+                regdb_store=os.path.join(
+                    BASE, unit, "work", "regdb_store"
+                ),
+                total_num_path=config["total_num_path"]
+            output:
+                parquets=[
+                    os.path.join(
+                        BASE, unit, "work", "organsp_features", f"{organ}_features.parquet"
+                    )
+                    for organ in organs
+                ]
+            params:
+                organs=" ".join(organs),
+                outdir=os.path.join(
+                    BASE, unit, "work", "organsp_features"
+                ),
+                cache_args=cache_args(unit),
+                metrics=metrics_path(unit, "extract_organsp", i),
+                checkpoint_args=checkpoint_args(unit, "extract_organsp", i)
+            log:
+                organsp_log(unit, i)
+            conda:
+                "../envs/TLand.yml"
+            threads: lambda wc, unit=unit: job_threads("extract_organsp", unit, config["threads_extract_organsp"])
+            resources:
+                mem_mb=lambda wc, threads, attempt, unit=unit, organs=organs: job_mem_mb(
+                    "extract_organsp", unit, len(organs), threads, attempt, config["memory_extract_organsp_mb"]
+                )
+            shell:
+                """
+                python workflow/scripts/extract_organsp_features.py \
+                   --regdb_store {input.regdb_store} \
+                   --organs {params.organs} \
+                   --organsp_dnase_sig_path {config[organsp_dnase_sig_path]} \
+                   --total_num_path {input.total_num_path} \
+                   --organ_mapping_json {config[organ_mapping_json]} \
+                   --threads {threads} \
+                   --metrics {params.metrics} \
+                   --outdir {params.outdir} {params.cache_args} {params.checkpoint_args} &> {log}
+                """
+else:
+    for k, jobs in enumerate(bundle(ORGANSP_JOBS)):
+        rule:
+            name: rule_name("extract_organsp_features", "bundle", k)
+            input:
+                regdb_stores=[
+                    os.path.join(
+                        BASE, unit, "work", "regdb_store"
+                    )
+                    for unit, _, _ in jobs
+                ],
+                total_num_path=config["total_num_path"]
+            output:
+                parquets=[
+                    os.path.join(
+                        BASE, unit, "work", "organsp_features", f"{organ}_features.parquet"
+                    )
+                    for unit, _, organs in jobs for organ in organs
+                ]
+            params:
+                jobs=lambda wc, threads, jobs=jobs: bundle_arg([organsp_job(unit, i, organs, threads) for unit, i, organs in jobs])
+            log:
+                bundle=os.path.join(
+                    BASE, "logs", f"extract_organsp_features.bundle.{k}.log"
+                ),
+                jobs=[organsp_log(unit, i) for unit, i, _ in jobs]
+            conda:
+                "../envs/TLand.yml"
+            threads: lambda wc, jobs=jobs: max(job_threads("extract_organsp", unit, config["threads_extract_organsp"]) for unit, _, _ in jobs)
+            resources:
+                mem_mb=lambda wc, threads, attempt, jobs=jobs: max(
+                    job_mem_mb("extract_organsp", unit, len(organs), threads, attempt, config["memory_extract_organsp_mb"])
+                    for unit, _, organs in jobs
+                )
+            shell:
+                """
+                python workflow/scripts/run_bundle.py --jobs {params.jobs} &> {log.bundle}
+                """
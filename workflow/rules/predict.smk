@@ -1,37 +1,135 @@
 import os
 
-# Predict per organs using joined features
-rule predict:
-    input:
-        generic_features = os.path.join(
-           BASE, "{run}", "work", "generic_features.parquet"
-        ),
-        organsp_features = os.path.join(
-            BASE, "{run}", "work", "organsp_features",
-            "{organ}_features.parquet"
-        )
-    output:
-        file = os.path.join(
-            BASE, "{run}", "predictions",
-            "TLand_scores.{organ}.tsv.gz"
-        )
-    log:
+
+def predict_inputs(unit, organs):
+    """Inputs of a predict job. With the variant cache or the score index, features are only needed if some variants
+    are not served by them."""
+    inputs = {"vcf": UNITS[unit]["VCF"]}
+    if SPLIT_VARIANTS:
+        uncached_vcf = checkpoints.split_cached_variants.get(unit=unit).output.vcf
+        if os.path.getsize(uncached_vcf) == 0:
+            return inputs
+    inputs["generic_features"] = os.path.join(
+        BASE, unit, "work", "generic_features.parquet"
+    )
+    inputs["organsp_features"] = [
         os.path.join(
-            BASE, "{run}", "logs",
-            "predict.{organ}.log"
+            BASE, unit, "work", "organsp_features",
+            f"{organ}_features.parquet"
         )
-    conda:
-        "../envs/TLand.yml"
-    resources:
-        mem_mb=config['memory_predict_organsp_mb']
-    shell:
-        """
-        python workflow/scripts/predict.py \
-           --generic_features {input.generic_features} \
-           --organsp_features {input.organsp_features} \
-           --organ {wildcards.organ} \
-           --organ_mapping_json {config[organ_mapping_json]} \
-           --organ_list {config[organ_list_path]} \
-           --models_path {config[models_path]} \
-           --out {output.file} &> {log}
-        """
\ No newline at end of file
+        for organ in organs
+    ]
+    return inputs
+
+
+def predict_log(unit, i):
+    return os.path.join(BASE, unit, "logs", f"predict.{i}.log")
+
+
+def predict_job(unit, i, organs):
+    """Script, command line arguments and log of a predict job of a bundle."""
+    inputs = predict_inputs(unit, organs)
+    args = ["--generic_features", inputs["generic_features"]] if "generic_features" in inputs else []
+    args += [
+        "--input_vcf", inputs["vcf"],
+        "--organsp_dir", os.path.join(BASE, unit, "work", "organsp_features"),
+        "--organs", *organs,
+        "--organ_mapping_json", config["organ_mapping_json"],
+        "--organ_list", config["organ_list_path"],
+        "--models_path", config["models_path"],
+        "--out_format", OUTPUT_FORMAT,
+        "--metrics", metrics_path(unit, "predict", i),
+        "--outdir", os.path.join(BASE, unit, "predictions"),
+    ]
+    args += cache_args(unit, scores=True).split()
+    return {"script": "workflow/scripts/predict.py", "args": args, "log": predict_log(unit, i)}
+
+
+def bundle_predict_inputs(jobs):
+    """Inputs of a bundle of predict jobs, named after the position of each job in the bundle."""
+    return {
+        f"{name}_{j}": value
+        for j, (unit, _, organs) in enumerate(jobs)
+        for name, value in predict_inputs(unit, organs).items()
+    }
+
+
+# Predict per organs using joined features. Each job loads the models and the generic features once
+# for a batch of organs (all of a unit's organs unless `predict_organs_per_job` is set). The wide
+# Parquet output holds every organ of a unit, so it is always written by a single job. With
+# `bundle_jobs`, the jobs of several units run together as one job.
+PREDICT_ORGANS_PER_JOB = 0 if OUTPUT_FORMAT == "parquet" else config.get("predict_organs_per_job", 0)
+PREDICT_JOBS = [
+    (unit, i, organs)
+    for unit in UNITS
+    for i, organs in enumerate(batch_organs(UNITS[unit]["ORGANS"], PREDICT_ORGANS_PER_JOB))
+]
+
+if BUNDLE_JOBS <= 1:
+    for unit, i, organs in PREDICT_JOBS:
+        rule:
+            name: rule_name("predict", unit, i)
+            input:
+                unpack(lambda wc, unit=unit, organs=organs: predict_inputs(unit, organs))
+            output:
+                files = prediction_outputs(unit, organs)
+            params:
+                organs = " ".join(organs),
+                out_format = OUTPUT_FORMAT,
+                feature_args = lambda wc, input: f"--generic_features {input.generic_features}" if hasattr(input, "generic_features") else "",
+                cache_args = cache_args(unit, scores=True),
+                metrics = metrics_path(unit, "predict", i),
+                organsp_dir = os.path.join(
+                    BASE, unit, "work", "organsp_features"
+                ),
+                outdir = os.path.join(
+                    BASE, unit, "predictions"
+                )
+            log:
+                predict_log(unit, i)
+            conda:
+                "../envs/TLand.yml"
+            resources:
+                mem_mb=lambda wc, attempt, unit=unit, organs=organs: job_mem_mb(
+                    "predict", unit, len(organs), attempt=attempt, fixed=config["memory_predict_organsp_mb"]
+                )
+            shell:
+                """
+                python workflow/scripts/predict.py \
+                   {params.feature_args} \
+                   --input_vcf {input.vcf} \
+                   --organsp_dir {params.organsp_dir} \
+                   --organs {params.organs} \
+                   --organ_mapping_json {config[organ_mapping_json]} \
+                   --organ_list {config[organ_list_path]} \
+                   --models_path {config[models_path]} \
+                   --out_format {params.out_format} \
+                   --metrics {params.metrics} \
+                   --outdir {params.outdir} {params.cache_args} &> {log}
+                """
+else:
+    for k, jobs in enumerate(bundle(PREDICT_JOBS)):
+        rule:
+            name: rule_name("predict", "bundle", k)
+            input:
+                unpack(lambda wc, jobs=jobs: bundle_predict_inputs(jobs))
+            output:
+                files = [file for unit, _, organs in jobs for file in prediction_outputs(unit, organs)]
+            params:
+                jobs = lambda wc, jobs=jobs: bundle_arg([predict_job(unit, i, organs) for unit, i, organs in jobs])
+            log:
+                bundle = os.path.join(
+                    BASE, "logs", f"predict.bundle.{k}.log"
+                ),
+                jobs = [predict_log(unit, i) for unit, i, _ in jobs]
+            conda:
+                "../envs/TLand.yml"
+            resources:
+                mem_mb=lambda wc, attempt, jobs=jobs: max(
+                    job_mem_mb("predict", unit, len(organs), attempt=attempt, fixed=config["memory_predict_organsp_mb"])
+                    for unit, _, organs in jobs
+                )
+            shell:
+                """
+                python workflow/scripts/run_bundle.py --jobs {params.jobs} &> {log.bundle}
+                """
@@ -0,0 +1,92 @@
+import os
+
+BATCH_DIR = os.path.join(BASE, "regdb_batch")
+
+
+def unit_query_beds():
+    """Query positions of every unit, in UNITS order."""
+    return [os.path.join(BASE, unit, "work", "reg_query_input.bed") for unit in UNITS]
+
+
+def batch_query_mem_mb(bed, attempt):
+    """Memory of a batched query, from its number of positions (or an even share of all variants before they are known)."""
+    variants = count_variants(bed) if os.path.exists(bed) else sum(unit["VARIANTS"] for unit in UNITS.values()) // REGDB_QUERY_SHARDS
+    return RESOURCE_MODEL.mem_mb("query_variants", variants, attempt=attempt)
+
+
+# Union the query positions of all units, de-duplicate them, and query them in position-sorted shards; the
+# query output of each unit is then split back out of the batched output.
+if BATCH_REGDB_QUERY:
+    rule merge_query_positions:
+        input:
+            beds=unit_query_beds()
+        output:
+            beds=[os.path.join(BATCH_DIR, f"positions.{i}.bed") for i in range(REGDB_QUERY_SHARDS)]
+        params:
+            outdir=BATCH_DIR,
+            shards=REGDB_QUERY_SHARDS
+        log:
+            os.path.join(BASE, "logs", "merge_query_positions.log")
+        conda:
+            "../envs/TLand.yml"
+        shell:
+            """
+            python workflow/scripts/regdb_batch.py merge \
+                --beds {input.beds} \
+                --outdir {params.outdir} \
+                --shards {params.shards} &> {log}
+            """
+
+    rule query_variants_batch:
+        input:
+            bed=os.path.join(BATCH_DIR, "positions.{shard}.bed")
+        output:
+            jsonl=temp(os.path.join(BATCH_DIR, "regdb_query_output.{shard}.jsonl"))
+        wildcard_constraints:
+            shard="[0-9]+"
+        log:
+            os.path.join(BASE, "logs", "reg_query.{shard}.log")
+        conda:
+            "../envs/gds.yml"
+        resources:
+            queries=1,
+            mem_mb=lambda wc, input, attempt: batch_query_mem_mb(input.bed, attempt)
+        params:
+            regdb_url=REGDB_URL,
+            workers=config.get("regdb_query_workers", 8),
+            metrics=lambda wc: os.path.join(BATCH_DIR, "metrics", f"query_variants.{wc.shard}.json")
+        shell:
+            """
+            if [ -n "{params.regdb_url}" ]; then
+                python workflow/scripts/regdb_client.py \
+                    --bed {input.bed} \
+                    --url {params.regdb_url} \
+                    --workers {params.workers} \
+                    --metrics {params.metrics} \
+                    --out {output.jsonl} &> {log}
+            else
+                cd {config[gds_dir]}
+                python -m utils.regulome_search_TLand \
+                    -f {input.bed} \
+                    --assembly GRCh38 \
+                    --peaks 1> {output.jsonl} 2> {log}
+            fi
+            """
+
+    rule split_regdb_query:
+        input:
+            jsonl=[os.path.join(BATCH_DIR, f"regdb_query_output.{i}.jsonl") for i in range(REGDB_QUERY_SHARDS)],
+            beds=unit_query_beds()
+        output:
+            jsonl=[os.path.join(BASE, unit, "work", "regdb_query_output.jsonl") for unit in UNITS]
+        log:
+            os.path.join(BASE, "logs", "split_regdb_query.log")
+        conda:
+            "../envs/TLand.yml"
+        shell:
+            """
+            python workflow/scripts/regdb_batch.py split \
+                --jsonl {input.jsonl} \
+                --beds {input.beds} \
+                --out {output.jsonl} &> {log}
+            """
@@ -0,0 +1,41 @@
+import os
+
+
+def unit_metrics(unit):
+    """Metrics files written by the jobs of a unit in the current job layout. Files left by an earlier layout (other
+    organ batches or shards) are not listed, so they are not counted in the report."""
+    stages = ["index_regdb_query", "run_seq_class", "extract_generic"]
+    if REGDB_URL and not BATCH_REGDB_QUERY:
+        stages.insert(0, "query_variants")
+    files = [metrics_path(unit, stage) for stage in stages]
+    files += [metrics_path(job_unit, "extract_organsp", i) for job_unit, i, _ in ORGANSP_JOBS if job_unit == unit]
+    files += [metrics_path(job_unit, "predict", i) for job_unit, i, _ in PREDICT_JOBS if job_unit == unit]
+    return files
+
+
+# Combine the stage metrics of every unit of a run into a run-level report, once its predictions are done
+for run in RUNS:
+    rule:
+        name: rule_name("run_report", run)
+        input:
+            files=prediction_outputs(run, RUN_PARAMS[run]["ORGANS"])
+        output:
+            report=os.path.join(BASE, run, "report", "run_report.json")
+        params:
+            metrics_files=" ".join(
+                path for unit in RUN_PARAMS[run]["UNITS"] for path in unit_metrics(unit)
+            ),
+            run=run
+        log:
+            os.path.join(
+                BASE, run, "logs", "run_report.log"
+            )
+        conda:
+            "../envs/TLand.yml"
+        shell:
+            """
+            python workflow/scripts/run_report.py \
+                --run {params.run} \
+                --metrics_files {params.metrics_files} \
+                --out {output.report} &> {log}
+            """
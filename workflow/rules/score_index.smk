@@ -0,0 +1,26 @@
+import os
+
+# Build a score index from the wide Parquet scores of every run, for runs of a reference variant set
+if BUILD_SCORE_INDEX:
+    rule build_score_index:
+        input:
+            files=[
+                os.path.join(BASE, run, "predictions", "TLand_scores.parquet")
+                for run in RUNS
+            ]
+        output:
+            index=os.path.join(BUILD_SCORE_INDEX, "index.json")
+        params:
+            outdir=BUILD_SCORE_INDEX,
+            score_version=SCORE_VERSION
+        log:
+            os.path.join(BASE, "logs", "build_score_index.log")
+        conda:
+            "../envs/TLand.yml"
+        shell:
+            """
+            python workflow/scripts/score_index.py build \
+                --score_files {input.files} \
+                --outdir {params.outdir} \
+                --score_version {params.score_version} &> {log}
+            """
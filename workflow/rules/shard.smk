@@ -0,0 +1,54 @@
+import os
+
+# Scatter: cut a run's input VCF into shards of at most `shard_size` variants, each going through the
+# feature and predict rules on its own. Gather: concatenate the shard predictions, in shard order, into
+# the run's predictions.
+if SHARD_SIZE:
+    rule shard_input_vcf:
+        input:
+            vcf=lambda wc: RUN_PARAMS[wc.run]["VCF"]
+        output:
+            vcf=os.path.join(
+                BASE, "{run}", "shards", "{shard}", "input.vcf"
+            )
+        wildcard_constraints:
+            run="[^/]+",
+            shard="[0-9]+"
+        params:
+            first=lambda wc: int(wc.shard) * SHARD_SIZE + 1,
+            last=lambda wc: (int(wc.shard) + 1) * SHARD_SIZE
+        shell:
+            """
+            awk 'NR >= {params.first} && NR <= {params.last}' {input.vcf} > {output.vcf}
+            """
+
+    for run in RUNS:
+        rule:
+            name: rule_name("gather_predictions", run)
+            input:
+                files=[
+                    path
+                    for unit in RUN_PARAMS[run]["UNITS"]
+                    for path in prediction_outputs(unit, RUN_PARAMS[run]["ORGANS"])
+                ]
+            output:
+                files=prediction_outputs(run, RUN_PARAMS[run]["ORGANS"])
+            params:
+                shard_dirs=" ".join(
+                    os.path.join(BASE, unit, "predictions") for unit in RUN_PARAMS[run]["UNITS"]
+                ),
+                outdir=os.path.join(BASE, run, "predictions"),
+                out_format=OUTPUT_FORMAT
+            log:
+                os.path.join(
+                    BASE, run, "logs", "gather_predictions.log"
+                )
+            conda:
+                "../envs/TLand.yml"
+            shell:
+                """
+                python workflow/scripts/gather_predictions.py \
+                    --shard_dirs {params.shard_dirs} \
+                    --outdir {params.outdir} \
+                    --out_format {params.out_format} &> {log}
+                """
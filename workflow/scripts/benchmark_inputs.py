@@ -0,0 +1,249 @@
+from pathlib import Path
+import argparse
+import json
+import pickle
+
+import h5py
+import numpy as np
+import pandas as pd
+import pyBigWig
+from sklearn.ensemble import StackingClassifier
+from sklearn.impute import SimpleImputer
+from sklearn.linear_model import LogisticRegression
+from sklearn.pipeline import Pipeline
+from sklearn.preprocessing import StandardScaler
+from mlxtend.feature_selection import ColumnSelector
+
+from extract_generic_features import DNASE_SIGNAL_FEATURES, CHIP_SIGNAL_FEATURES
+from extract_organsp_features import ORGANSP_SIGNAL_FEATURES, TOTAL_NUM_FEATURES, get_organ_sp_table
+from regdb_store import COUNT_FEATURES, GENERIC_COLUMNS, GENERIC_FEATURES, HISTONE_LIST
+from run_seq_class import LABEL_COLUMNS, NUM_SEQCLASSES
+from tland_utility import NearestCentroidWithProb
+
+# Synthetic genome: variants are spread over NUM_CHROMS chromosomes, SPACING bp apart on average
+NUM_CHROMS = 22
+SPACING = 3000
+
+# Sei predicts 21907 chromatin profiles; synthetic predictions have fewer so that large scales fit on a plain disk
+SEI_TARGETS = 1000
+SEI_SEQCLASSES = 61
+
+# Peaks of a synthetic RegDB record: share of each method, and the values drawn for the other fields
+PEAK_METHODS = {'ChIP-seq': 0.5, 'DNase-seq': 0.2, 'Histone ChIP-seq': 0.2, 'footprints': 0.1}
+TF_TARGETS = ['CTCF', 'POLR2A', 'EP300', 'RAD21', 'YY1', 'MAX', 'REST', 'JUND', 'FOXA1', 'GATA1']
+NUM_BIOSAMPLES = 200
+
+# Rows of the Sei predictions written per HDF5 write
+HDF5_CHUNK_ROWS = 50000
+
+def make_variants(num_variants, seed=0, num_chroms=NUM_CHROMS, spacing=SPACING):
+    '''Function to draw sorted SNVs on a synthetic genome, with a few multi-allelic positions
+    Returns:
+        variants (pd.DataFrame): 'chrom', 'end', 'id', 'ref', 'alt'
+        chrom_sizes (dict): chromosome -> length
+    '''
+    rng = np.random.default_rng(seed)
+    per_chrom = np.full(num_chroms, num_variants // num_chroms)
+    per_chrom[:num_variants % num_chroms] += 1
+    frames = []
+    chrom_sizes = {}
+    for i, n in enumerate(per_chrom):
+        chrom = f'chr{i + 1}'
+        chrom_sizes[chrom] = int(n * spacing + spacing)
+        if n == 0:
+            continue
+        ends = np.sort(rng.choice(np.arange(1, chrom_sizes[chrom]), size=n, replace=False))
+        repeated = np.flatnonzero(rng.random(n) < 0.02)
+        ends[repeated[repeated > 0]] = ends[repeated[repeated > 0] - 1] # multi-allelic positions
+        frames.append(pd.DataFrame({'chrom': chrom, 'end': ends}))
+    variants = pd.concat(frames, ignore_index=True)
+    bases = np.array(list('ACGT'))
+    ref = rng.integers(0, 4, len(variants))
+    variants['id'] = '.'
+    variants['ref'] = bases[ref]
+    variants['alt'] = bases[(ref + rng.integers(1, 4, len(variants))) % 4]
+    return variants.drop_duplicates(['chrom', 'end', 'ref', 'alt']).reset_index(drop=True), chrom_sizes
+
+def write_vcf(variants, path):
+    variants[['chrom', 'end', 'id', 'ref', 'alt']].to_csv(path, sep='\t', header=False, index=False)
+
+def get_peaks(rng, num_peaks, organs):
+    '''Returns: peaks (list of dict): RegDB peaks of one variant'''
+    methods = rng.choice(list(PEAK_METHODS), size=num_peaks, p=list(PEAK_METHODS.values()))
+    peaks = []
+    for method in methods:
+        peak = {'method': method, 'biosample_term_name': f'biosample_{rng.integers(NUM_BIOSAMPLES)}',
+                'organ_slims': list(rng.choice(organs, size=rng.integers(1, 4)))}
+        if method == 'ChIP-seq':
+            peak['targets'] = [TF_TARGETS[rng.integers(len(TF_TARGETS))]]
+        elif method == 'Histone ChIP-seq':
+            peak['target_label'] = HISTONE_LIST[rng.integers(len(HISTONE_LIST))]
+            peak['targets'] = [peak['target_label']]
+        peaks.append(peak)
+    return peaks
+
+def write_regdb_jsonl(variants, path, organs, peaks_per_variant, seed=0):
+    '''Function to write a RegDB query output with one record per variant position
+    Args:
+        organs (list of str): organ names with spaces the peaks are annotated with
+        peaks_per_variant (float): mean number of peaks of a record (Poisson distributed)
+    '''
+    rng = np.random.default_rng(seed)
+    positions = variants[['chrom', 'end']].drop_duplicates()
+    num_peaks = rng.poisson(peaks_per_variant, len(positions))
+    features = rng.random((len(positions), len(GENERIC_FEATURES))) < 0.3
+    with open(path, 'w') as f:
+        for i, (chrom, end) in enumerate(positions.itertuples(index=False)):
+            record = {'chrom': chrom, 'end': int(end),
+                      'features': dict(zip(GENERIC_FEATURES, features[i].tolist())),
+                      'peaks': get_peaks(rng, num_peaks[i], organs)}
+            f.write(json.dumps(record) + '\n')
+
+def write_bigwig(path, chrom_sizes, step, rng):
+    '''Function to write a bigWig with a random value every `step` bp of each chromosome'''
+    bw = pyBigWig.open(str(path), 'w')
+    bw.addHeader(list(chrom_sizes.items()))
+    for chrom, size in chrom_sizes.items():
+        num_steps = size // step
+        if num_steps:
+            bw.addEntries(chrom, 0, values=rng.gamma(1.0, 1.0, num_steps).astype(np.float64), span=step, step=step)
+    bw.close()
+
+def write_bigwigs(outdir, chrom_sizes, organs, step=1000, seed=0):
+    '''Function to write the generic and organ-specific signal bigWigs, named as the feature extractors expect
+    Returns:
+        dnase_sig_path, chip_sig_path, organsp_dnase_sig_path (Path): bigWig directories
+    '''
+    rng = np.random.default_rng(seed)
+    paths = {name: Path(outdir) / name for name in ['generic_dnase_sig', 'chip_sig', 'organsp_dnase_sig']}
+    for path in paths.values():
+        path.mkdir(parents=True, exist_ok=True)
+    for feature in DNASE_SIGNAL_FEATURES:
+        write_bigwig(paths['generic_dnase_sig'] / f'{feature}.bw', chrom_sizes, step, rng)
+    for feature in CHIP_SIGNAL_FEATURES:
+        write_bigwig(paths['chip_sig'] / f'{feature}.bw', chrom_sizes, step, rng)
+    for organ in organs:
+        for feature in ORGANSP_SIGNAL_FEATURES:
+            write_bigwig(paths['organsp_dnase_sig'] / f'{feature}_{organ}.bw', chrom_sizes, step, rng)
+    return paths['generic_dnase_sig'], paths['chip_sig'], paths['organsp_dnase_sig']
+
+def write_sei_outputs(variants, vcf_path, sei_outdir, sei_model_dir, num_targets=SEI_TARGETS, seed=0):
+    '''Function to write Sei-style predictions and the model files read by run_seq_class.py
+    The ref and alt predictions are float32 (num_variants, num_targets) datasets, with row labels in the layout of
+    the Sei pipeline, under sei_outdir/chromatin-profiles-hdf5.
+    '''
+    rng = np.random.default_rng(seed)
+    prefix = '.'.join(Path(vcf_path).name.split('.')[:-1])
+    profile_dir = Path(sei_outdir) / 'chromatin-profiles-hdf5'
+    profile_dir.mkdir(parents=True, exist_ok=True)
+
+    labels = variants[['chrom', 'end', 'id', 'ref', 'alt']].rename(columns={'end': 'pos'})
+    labels['strand'] = '+'
+    labels['ref_match'] = True
+    labels['contains_unk'] = False
+    labels[LABEL_COLUMNS].to_csv(profile_dir / f'{prefix}_row_labels.txt', sep='\t', index=False)
+
+    with h5py.File(profile_dir / f'{prefix}.ref_predictions.h5', 'w') as ref_fh, \
+            h5py.File(profile_dir / f'{prefix}.alt_predictions.h5', 'w') as alt_fh:
+        ref_dset = ref_fh.create_dataset('data', (len(variants), num_targets), dtype=np.float32)
+        alt_dset = alt_fh.create_dataset('data', (len(variants), num_targets), dtype=np.float32)
+        for start in range(0, len(variants), HDF5_CHUNK_ROWS):
+            stop = min(start + HDF5_CHUNK_ROWS, len(variants))
+            ref = rng.beta(0.5, 5.0, (stop - start, num_targets)).astype(np.float32)
+            ref_dset[start:stop] = ref
+            alt_dset[start:stop] = np.clip(ref + rng.normal(0, 0.01, ref.shape), 1e-6, 1).astype(np.float32)
+
+    sei_model_dir = Path(sei_model_dir)
+    sei_model_dir.mkdir(parents=True, exist_ok=True)
+    with open(sei_model_dir / 'seqclass.names', 'w') as f:
+        f.writelines(f'SC{i}\n' for i in range(SEI_SEQCLASSES))
+    np.save(sei_model_dir / 'projvec_targets.npy', rng.random((SEI_SEQCLASSES, num_targets)))
+    np.save(sei_model_dir / 'histone_inds.npy', np.sort(rng.choice(num_targets, num_targets // 10, replace=False)))
+
+def get_feature_columns():
+    '''Returns: generic_columns, organsp_columns (list of str): model features of the generic and organ-specific tables'''
+    generic_columns = GENERIC_COLUMNS + DNASE_SIGNAL_FEATURES + CHIP_SIGNAL_FEATURES \
+        + [f'SC{i}' for i in range(NUM_SEQCLASSES)] + ['max_abs_diff']
+    total_num_dict = {feature: {} for feature in TOTAL_NUM_FEATURES}
+    organsp_table = get_organ_sp_table([], [], np.zeros((0, len(COUNT_FEATURES)), dtype=np.int64), '', total_num_dict)
+    organsp_columns = list(organsp_table.columns[2:]) + [f'{feature}_organSp' for feature in ORGANSP_SIGNAL_FEATURES]
+    return generic_columns, organsp_columns
+
+def make_model(columns, stacked, rng, num_rows=2000):
+    '''Function to fit a toy model on random features, with the structure of the TLand models
+    (column selection, imputation and scaling, and a stack of linear and nearest centroid classifiers for TLand)
+    '''
+    X = pd.DataFrame(rng.random((num_rows, len(columns))), columns=columns)
+    y = (X.to_numpy() @ rng.normal(size=len(columns)) + rng.normal(size=num_rows) > 0).astype(int)
+
+    def branch(cols, classifier):
+        return Pipeline([('select', ColumnSelector(cols=tuple(cols))), ('impute', SimpleImputer()),
+                         ('scale', StandardScaler()), ('classifier', classifier)])
+
+    if not stacked:
+        return branch(columns, LogisticRegression(max_iter=1000)).fit(X, y)
+    half = len(columns) // 2
+    return StackingClassifier(
+        [('linear', branch(columns, LogisticRegression(max_iter=1000))),
+         ('centroid', branch(columns[:half], NearestCentroidWithProb()))],
+        final_estimator=LogisticRegression(), cv=3).fit(X, y)
+
+def write_models(models_path, seed=0):
+    '''Function to pickle toy TLand and TLand lightest models reading the feature columns of the pipeline'''
+    rng = np.random.default_rng(seed)
+    generic_columns, organsp_columns = get_feature_columns()
+    models_path = Path(models_path)
+    models_path.mkdir(parents=True, exist_ok=True)
+    for filename, stacked in [('TLand_organSp.pickle', True), ('TLand_organSp_lightest.pickle', False)]:
+        with open(models_path / filename, 'wb') as f:
+            pickle.dump(make_model(generic_columns + organsp_columns, stacked, rng), f)
+
+def make_inputs(outdir, num_variants, organ_mapping, organs, peaks_per_variant=20, sei_targets=SEI_TARGETS, bigwig_step=1000, seed=0):
+    '''Function to write a full set of synthetic pipeline inputs
+    Args:
+        outdir (Path): output directory
+        num_variants (int): number of variants (multi-allelic duplicates are dropped, so slightly fewer are written)
+        organ_mapping (dict): organ name with underscores -> organ name with spaces, of every organ peaks are annotated with
+        organs (list of str): organ names (with underscores) of the organ-specific bigWigs
+        peaks_per_variant (float): mean number of RegDB peaks per variant position
+        sei_targets (int): number of chromatin profiles of the Sei predictions
+        bigwig_step (int): resolution of the bigWig signals, in bp
+    Returns:
+        inputs (dict): input name -> path, also written to outdir/inputs.json
+    '''
+    outdir = Path(outdir)
+    outdir.mkdir(parents=True, exist_ok=True)
+
+    variants, chrom_sizes = make_variants(num_variants, seed)
+    inputs = {'vcf': outdir / 'input.vcf', 'regdb_jsonl': outdir / 'regdb_query_output.jsonl',
+              'sei_output': outdir / 'sei_output', 'sei_model': outdir / 'sei_model', 'models': outdir / 'models'}
+    write_vcf(variants, inputs['vcf'])
+    write_regdb_jsonl(variants, inputs['regdb_jsonl'], list(organ_mapping.values()), peaks_per_variant, seed)
+    inputs['dnase_sig'], inputs['chip_sig'], inputs['organsp_dnase_sig'] = write_bigwigs(
+        outdir / 'bigwigs', chrom_sizes, [organ_mapping[organ] for organ in organs], bigwig_step, seed)
+    write_sei_outputs(variants, inputs['vcf'], inputs['sei_output'], inputs['sei_model'], sei_targets, seed)
+    write_models(inputs['models'], seed)
+
+    inputs = {name: str(path) for name, path in inputs.items()}
+    inputs['variants'] = len(variants)
+    with open(outdir / 'inputs.json', 'w') as f:
+        json.dump(inputs, f, indent=2)
+    return inputs
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Write synthetic inputs for the feature and prediction scripts.")
+    parser.add_argument('--outdir', type=str, required=True, help='Output directory')
+    parser.add_argument('--variants', type=int, required=True, help='Number of variants')
+    parser.add_argument('--organs', type=str, nargs='+', default=['brain', 'heart'], help='Organ names (with underscores) of the organ-specific bigWigs')
+    parser.add_argument('--organ_mapping_json', type=str, default='resources/organ_list_underscore_mapping.json', help='Path to file mapping organ names with underscores to organ names with spaces')
+    parser.add_argument('--peaks_per_variant', type=float, default=20, help='Mean number of RegDB peaks per variant position')
+    parser.add_argument('--sei_targets', type=int, default=SEI_TARGETS, help='Number of chromatin profiles of the Sei predictions')
+    parser.add_argument('--bigwig_step', type=int, default=1000, help='Resolution of the bigWig signals, in bp')
+    parser.add_argument('--seed', type=int, default=0, help='Random seed')
+    args = parser.parse_args()
+
+    with open(args.organ_mapping_json) as f:
+        organ_mapping = json.load(f)
+    inputs = make_inputs(args.outdir, args.variants, organ_mapping, args.organs, args.peaks_per_variant,
+                         args.sei_targets, args.bigwig_step, args.seed)
+    print(f'Wrote synthetic inputs for {inputs["variants"]} variants to {args.outdir}')
@@ -0,0 +1,128 @@
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from itertools import groupby
+
+import numpy as np
+import pandas as pd
+import pyBigWig
+
+# Positions closer than MAX_GAP bp are read with a single bigWig values() call, spanning at most MAX_SPAN bp
+MAX_GAP = 2000
+MAX_SPAN = 500000
+
+# bigWig handles held by each worker process, keyed by path
+_open_bigwigs = {}
+
+def read_block(bw, chrom, start, stop):
+    '''Function to read per-base values of a 0-based, half-open interval from an open bigWig (NaN past the end of
+    the chromosome, or for a chromosome the bigWig does not have)'''
+    values = np.full(stop - start, np.nan)
+    stop_in_chrom = min(stop, bw.chroms(chrom) or 0)
+    if stop_in_chrom > start:
+        if pyBigWig.numpy:
+            values[:stop_in_chrom - start] = bw.values(chrom, start, stop_in_chrom, numpy=True)
+        else:
+            values[:stop_in_chrom - start] = bw.values(chrom, start, stop_in_chrom)
+    return values
+
+def read_blocks(path, blocks):
+    '''Worker function to read the variant values of several blocks from a bigWig kept open by the worker
+    Args:
+        path (str): bigWig path
+        blocks (list): (chrom, start, stop, offsets) of each block
+    Returns:
+        values (list of np.array): values at the block offsets
+    '''
+    if path not in _open_bigwigs:
+        _open_bigwigs[path] = pyBigWig.open(path)
+    bw = _open_bigwigs[path]
+    return [read_block(bw, chrom, start, stop)[offsets] for chrom, start, stop, offsets in blocks]
+
+class SignalLookup:
+    '''Sorted, block-grouped layout of variant positions, shared by every bigWig read for the same variants
+
+    Args:
+        chroms (list-like of str): variant chromosomes
+        ends (list-like of int): 1-based variant positions
+        max_gap (int): largest distance between neighbouring positions read in the same block
+        max_span (int): largest span of a block
+    '''
+
+    def __init__(self, chroms, ends, max_gap=MAX_GAP, max_span=MAX_SPAN):
+        chrom_codes, chrom_names = pd.factorize(pd.Series(chroms))
+        ends = np.asarray(ends, dtype=np.int64)
+        self.num_variants = len(ends)
+        self.blocks = [] # (chrom, start, stop, variant indices, offsets into the block)
+        if self.num_variants == 0:
+            return
+
+        order = np.lexsort((ends, chrom_codes))
+        codes = chrom_codes[order]
+        pos = ends[order]
+
+        new_block = np.ones(self.num_variants, dtype=bool)
+        new_block[1:] = (np.diff(codes) != 0) | (np.diff(pos) > max_gap)
+        run_start = np.flatnonzero(new_block)
+        span_id = (pos - pos[run_start][np.cumsum(new_block) - 1]) // max_span
+        new_block[1:] |= span_id[1:] != span_id[:-1]
+
+        block_starts = np.flatnonzero(new_block)
+        block_stops = np.append(block_starts[1:], self.num_variants)
+        for first, last in zip(block_starts, block_stops):
+            self.blocks.append((
+                chrom_names[codes[first]],
+                int(pos[first]) - 1,
+                int(pos[last - 1]),
+                order[first:last],
+                pos[first:last] - pos[first]))
+
+    def bases(self):
+        '''Returns: bases (int): number of bigWig bases read per track'''
+        return sum(stop - start for _, start, stop, _, _ in self.blocks)
+
+    def values(self, bw, decimals=4):
+        '''Function to look up the signal at every variant position
+        Args:
+            bw (pyBigWig): open bigWig file
+            decimals (int): number of decimals the signal is rounded to
+        Returns:
+            signal (np.array): signal values in the original variant order (NaN where the bigWig has no data)
+        '''
+        signal = np.full(self.num_variants, np.nan)
+        for chrom, start, stop, idx, offsets in self.blocks:
+            signal[idx] = read_block(bw, chrom, start, stop)[offsets]
+        return np.round(signal, decimals)
+
+def get_signal_tracks(signal_lookup, bigwig_paths, pool=None, decimals=4):
+    '''Function to look up several bigWig tracks at the same variants
+    Args:
+        signal_lookup (SignalLookup): layout of the variant positions
+        bigwig_paths (dict): feature name -> bigWig path
+        pool (ProcessPoolExecutor): worker pool the tracks are split across by file and chromosome (None reads them in this process)
+        decimals (int): number of decimals the signal is rounded to
+    Returns:
+        signals (dict): feature name -> signal values in the original variant order
+    '''
+    if pool is None:
+        signals = {}
+        for name, path in bigwig_paths.items():
+            bw = pyBigWig.open(str(path))
+            signals[name] = signal_lookup.values(bw, decimals)
+            bw.close()
+        return signals
+
+    signals = {name: np.full(signal_lookup.num_variants, np.nan) for name in bigwig_paths}
+    futures = {}
+    for _, chrom_blocks in groupby(signal_lookup.blocks, key=lambda block: block[0]):
+        chrom_blocks = list(chrom_blocks)
+        for name, path in bigwig_paths.items():
+            future = pool.submit(read_blocks, str(path), [(chrom, start, stop, offsets) for chrom, start, stop, _, offsets in chrom_blocks])
+            futures[future] = (name, [idx for _, _, _, idx, _ in chrom_blocks])
+    for future in as_completed(futures):
+        name, idx_list = futures.pop(future)
+        for idx, values in zip(idx_list, future.result()):
+            signals[name][idx] = values
+    return {name: np.round(values, decimals) for name, values in signals.items()}
+
+def signal_pool(threads):
+    '''Returns: pool (ProcessPoolExecutor): worker pool for get_signal_tracks, or None for a single thread'''
+    return ProcessPoolExecutor(max_workers=threads) if threads > 1 else None
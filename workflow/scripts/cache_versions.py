@@ -0,0 +1,33 @@
+from pathlib import Path
+import hashlib
+import os
+
+def resource_version(*paths):
+    '''Function to hash the names, sizes and modification times of the files at paths (directories are listed one level deep)
+    Returns:
+        version (str): short hash
+    '''
+    digest = hashlib.sha1()
+    for path in paths:
+        path = str(path)
+        files = sorted(os.path.join(path, f) for f in os.listdir(path)) if os.path.isdir(path) else [path]
+        for f in files:
+            if os.path.isfile(f):
+                stat = os.stat(f)
+                digest.update(f"{os.path.basename(f)}:{stat.st_size}:{stat.st_mtime_ns}\n".encode())
+    return digest.hexdigest()[:16]
+
+def get_feature_version(dnase_sig_path, chip_sig_path, organsp_dnase_sig_path, total_num_path, sei_model_dir, regdb_version=''):
+    '''Returns: feature_version (str): version of the resources the variant cache features are computed from, and of
+    the RegulomeDB data they are queried from (its configured version, as the data is not read from files)'''
+    version = resource_version(dnase_sig_path, chip_sig_path, organsp_dnase_sig_path, total_num_path, sei_model_dir)
+    if not regdb_version:
+        return version
+    return hashlib.sha1(f'{version}:{regdb_version}'.encode()).hexdigest()[:16]
+
+def get_score_version(feature_version, models_path):
+    '''Returns: score_version (str): version of the resources and models the variant cache scores are computed from
+    Only the pickled models are versioned, so converting them with convert_models.py keeps the cached scores.
+    '''
+    model_files = sorted(Path(models_path).glob('*.pickle'))
+    return hashlib.sha1((feature_version + resource_version(*model_files)).encode()).hexdigest()[:16]
@@ -0,0 +1,104 @@
+from datetime import datetime
+from pathlib import Path
+import argparse
+import json
+
+import numpy as np
+from scipy.optimize import nnls
+
+from resource_model import MEM_FEATURES
+
+# Features that can be fitted from the stage metrics (each stage lists those its memory depends on in 'fit');
+# the per-thread memory is set by hand in the calibration file
+FITTED_FEATURES = ['variants', 'jsonl_mb', 'organs']
+
+# Fewest jobs, and fewest distinct variant counts among them, a stage is refitted from
+MIN_RECORDS = 3
+MIN_SCALES = 2
+
+def read_records(metrics_dirs):
+    '''Function to read the stage metrics under some directories (e.g. base_dir, or a benchmark workdir)
+    The RegulomeDB query output size of a job is taken from the index_regdb_query metrics of the same unit.
+    Returns:
+        records (list of dict): stage, peak_rss_mb, cpu_s, variants, jsonl_mb and organs of each job
+    '''
+    records = []
+    for metrics_dir in metrics_dirs:
+        for unit_metrics in sorted(set(path.parent for path in Path(metrics_dir).rglob('metrics/*.json'))):
+            stage_records = []
+            for path in sorted(unit_metrics.glob('*.json')):
+                with open(path) as f:
+                    stage_records.append(json.load(f))
+            jsonl_bytes = [record['counters']['jsonl_bytes_read'] for record in stage_records
+                           if record['stage'] == 'index_regdb_query' and 'jsonl_bytes_read' in record['counters']]
+            for record in stage_records:
+                variants = record['counters'].get('variants')
+                if not variants:
+                    continue
+                records.append({'stage': record['stage'], 'peak_rss_mb': record['peak_rss_mb'], 'cpu_s': record['cpu_s'],
+                                'variants': variants, 'jsonl_mb': jsonl_bytes[0] / 1024**2 if jsonl_bytes else None,
+                                'organs': record['counters'].get('organs', 1)})
+    return records
+
+def fit_mem_mb(records, features):
+    '''Function to fit non-negative memory coefficients of a stage to the peak RSS of its jobs
+    Features missing from a job's metrics, or with the same value in every job, are left out of the fit.
+    Returns:
+        coefficients (dict): 'intercept' and MB per unit of each fitted feature
+    '''
+    features = [feature for feature in features
+                if all(record[feature] is not None for record in records) and len({record[feature] for record in records}) > 1]
+    X = np.array([[1.0] + [record[feature] for feature in features] for record in records])
+    y = np.array([record['peak_rss_mb'] for record in records])
+    scale = np.abs(X).max(axis=0) # nnls is better conditioned on columns of similar size
+    scale[scale == 0] = 1
+    coef, _ = nnls(X / scale, y)
+    coef /= scale
+    return dict(zip(['intercept'] + features, coef.round(6).tolist()))
+
+def calibrate(calibration, records, stages=None):
+    '''Function to refit the calibration of every stage (or of `stages`) with enough jobs
+    Returns:
+        calibration (dict): updated calibration
+        refitted (list of str): refitted stages
+    '''
+    refitted = []
+    jsonl_ratios = [record['jsonl_mb'] / record['variants'] for record in records
+                    if record['stage'] == 'index_regdb_query' and record['jsonl_mb']]
+    if jsonl_ratios:
+        calibration['jsonl_mb_per_variant'] = round(float(np.median(jsonl_ratios)), 6)
+    for stage, model in calibration['stages'].items():
+        stage_records = [record for record in records if record['stage'] == stage]
+        if stages is not None and stage not in stages:
+            continue
+        if len(stage_records) < MIN_RECORDS or len({record['variants'] for record in stage_records}) < MIN_SCALES:
+            continue
+        mem_mb = fit_mem_mb(stage_records, model['fit'])
+        model['mem_mb'] = {feature: mem_mb.get(feature, 0.0) if feature in mem_mb or feature in FITTED_FEATURES else model['mem_mb'].get(feature, 0.0)
+                           for feature in ['intercept'] + MEM_FEATURES}
+        if 'variants_per_thread' in model:
+            throughput = np.median([record['variants'] / record['cpu_s'] for record in stage_records if record['cpu_s'] > 0])
+            model['variants_per_thread'] = int(throughput * calibration['target_thread_seconds'])
+        refitted.append(stage)
+    calibration['calibrated'] = {'date': datetime.now().isoformat(timespec='seconds'), 'jobs': len(records)}
+    return calibration, refitted
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Refit the memory and thread model of the workflow rules from stage metrics.")
+    parser.add_argument('--metrics_dirs', type=str, nargs='+', required=True, help='Directories searched for */metrics/*.json stage metrics (base directories of runs, or benchmark workdirs)')
+    parser.add_argument('--calibration', type=str, default='resources/resource_model.json', help='Calibration file to update')
+    parser.add_argument('--stages', type=str, nargs='+', help='Stages to refit (all stages with enough jobs by default)')
+    args = parser.parse_args()
+
+    records = read_records(args.metrics_dirs)
+    with open(args.calibration) as f:
+        calibration = json.load(f)
+    calibration, refitted = calibrate(calibration, records, args.stages)
+    for stage in refitted:
+        print(f"{stage}: {calibration['stages'][stage]}")
+    print(f'Refitted {len(refitted)} stages from {len(records)} jobs')
+
+    tmp = f'{args.calibration}.tmp'
+    with open(tmp, 'w') as f:
+        json.dump(calibration, f, indent=2)
+    Path(tmp).replace(args.calibration)
@@ -0,0 +1,76 @@
+from pathlib import Path
+import json
+import os
+import shutil
+import threading
+
+import numpy as np
+
+from cache_versions import resource_version
+
+MANIFEST_FILE = 'manifest.json'
+
+def get_fingerprint(input_paths, **settings):
+    '''Returns: fingerprint (dict): version of the input files (names, sizes and modification times) and the settings chunks depend on'''
+    return {'inputs': resource_version(*input_paths), **settings}
+
+class ChunkCheckpoint:
+    '''Chunk-granular partial outputs of a stage, so that a rerun after a failure only redoes the unfinished chunks
+
+    Each chunk is written to its own file in the checkpoint directory, then recorded in a manifest along with the
+    fingerprint of the stage's inputs and settings. A checkpoint left by a run with another fingerprint is
+    discarded. Chunks may be finished by several threads at once.
+
+    Args:
+        checkpoint_dir (str): checkpoint directory of the stage
+        fingerprint (dict): JSON-serializable fingerprint from get_fingerprint
+    '''
+
+    def __init__(self, checkpoint_dir, fingerprint):
+        self.checkpoint_dir = Path(checkpoint_dir)
+        self.fingerprint = json.loads(json.dumps(fingerprint)) # as read back from the manifest
+        self.lock = threading.Lock()
+        manifest = None
+        if (self.checkpoint_dir / MANIFEST_FILE).exists():
+            with open(self.checkpoint_dir / MANIFEST_FILE) as f:
+                manifest = json.load(f)
+        if manifest is None or manifest['fingerprint'] != self.fingerprint:
+            shutil.rmtree(self.checkpoint_dir, ignore_errors=True)
+            manifest = {'fingerprint': self.fingerprint, 'chunks': {}}
+        self.checkpoint_dir.mkdir(parents=True, exist_ok=True)
+        self.chunks = manifest['chunks']
+        self.resumed = len(self.chunks)
+        if self.resumed:
+            print(f'Resuming from {self.resumed} finished chunks in {self.checkpoint_dir}')
+
+    def done(self, chunk):
+        return str(chunk) in self.chunks
+
+    def path(self, chunk, suffix):
+        '''Returns: path (Path): file of a chunk'''
+        return self.checkpoint_dir / f'chunk-{chunk}{suffix}'
+
+    def commit(self, chunk, **info):
+        '''Function to record a chunk whose file is completely written'''
+        with self.lock:
+            self.chunks[str(chunk)] = info
+            tmp = self.checkpoint_dir / f'.{MANIFEST_FILE}.tmp'
+            with open(tmp, 'w') as f:
+                json.dump({'fingerprint': self.fingerprint, 'chunks': self.chunks}, f)
+            os.replace(tmp, self.checkpoint_dir / MANIFEST_FILE)
+
+    def save_arrays(self, chunk, **arrays):
+        '''Function to write the arrays of a chunk and record it'''
+        tmp = self.path(chunk, '.tmp.npz')
+        np.savez(tmp, **arrays)
+        os.replace(tmp, self.path(chunk, '.npz'))
+        self.commit(chunk, rows=len(next(iter(arrays.values()))))
+
+    def load_arrays(self, chunk):
+        '''Returns: arrays (dict): arrays saved for a chunk'''
+        with np.load(self.path(chunk, '.npz')) as npz:
+            return {name: npz[name] for name in npz.files}
+
+    def remove(self):
+        '''Function to delete the checkpoint once the stage output is complete'''
+        shutil.rmtree(self.checkpoint_dir, ignore_errors=True)
@@ -0,0 +1,32 @@
+from pathlib import Path
+import argparse
+import os
+import pickle
+import time
+
+import joblib
+
+def convert_model(pickle_path):
+    '''Function to store a pickled model as an uncompressed joblib file next to it, whose arrays can be memory-mapped
+    Args:
+        pickle_path (Path): pickled model
+    Returns:
+        joblib_path (Path): converted model
+    '''
+    with pickle_path.open(mode='rb') as f:
+        model = pickle.load(f)
+    joblib_path = pickle_path.with_suffix('.joblib')
+    tmp = joblib_path.with_name(f'.{joblib_path.name}.tmp')
+    joblib.dump(model, tmp)
+    os.replace(tmp, joblib_path) # predict jobs never load a partially written model
+    return joblib_path
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Convert the pickled TLand models to memory-mappable joblib files, used by predict.py when present.")
+    parser.add_argument('--models_path', type=str, required=True, help='Path to directory containing model files')
+    args = parser.parse_args()
+
+    for pickle_path in sorted(Path(args.models_path).glob('*.pickle')):
+        start = time.time()
+        joblib_path = convert_model(pickle_path)
+        print(f'Converted {pickle_path.name} to {joblib_path.name} in {time.time() - start:.2f} seconds')
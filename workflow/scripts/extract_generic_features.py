@@ -1,76 +1,281 @@
 from pathlib import Path
-import json
 import argparse
+import os
+import tempfile
 
-import pandas as pd
 import numpy as np
-import pyBigWig
+import pandas as pd
+import pyarrow as pa
+import pyarrow.dataset as ds
+import pyarrow.parquet as pq
+
+from bigwig_signal import SignalLookup, get_signal_tracks, signal_pool
+from chunk_checkpoint import ChunkCheckpoint, get_fingerprint
+from feature_schema import CHROM_TYPE, KEY_COLUMN, VARIANT_JOIN_KEY, has_sei_features, position_key, to_generic_schema, with_position_key
+from gather_predictions import gather_parquet
+from regdb_store import GENERIC_COLUMNS, VARIANTS_FILE, read_variants
+from stage_metrics import StageMetrics
+from variant_cache import VariantCache
+
+# Quantile-normalized signal tracks, read from {feature}.bw
+DNASE_SIGNAL_FEATURES = ['DNase_var','DNase_quantile95','DNase_quantile1','DNase_quantile2','DNase_quantile3']
+CHIP_SIGNAL_FEATURES = ['ChIP_var','ChIP_quantile95','ChIP_quantile1','ChIP_quantile2','ChIP_quantile3']
+
+# Sei feature columns that are not sequence class scores
+SEI_LABEL_COLUMNS = ['seqclass_max_absdiff', 'ref_match', 'contains_unk', 'chrom', 'pos', 'id', 'ref', 'alt', 'strand']
+
+def read_vcf_blocks(input_vcf, block_rows=0):
+    '''Function to read the variants of a VCF-like file in blocks
+    Yields:
+        block (pd.DataFrame): 'chrom', 'end', 'id', 'ref', 'alt' of up to block_rows variants (all variants if 0)
+    '''
+    reader = pd.read_csv(input_vcf, sep='\t', usecols=[0,1,2,3,4], names=['chrom','end','id','ref','alt'],
+                         dtype={'chrom': str, 'id': str, 'ref': str, 'alt': str}, chunksize=block_rows or None)
+    if not block_rows:
+        yield reader
+        return
+    for block in reader:
+        yield block.reset_index(drop=True)
 
-def get_generic_features(input_json):
-    '''Function to output RegDB generic features from a json object
+def sort_vcf_blocks(input_vcf, block_rows, scratch_dir):
+    '''Function to split the variants of a VCF-like file into blocks of block_rows consecutive position keys
+    The keys are read in a first pass. If the file is not sorted by key, its variants are distributed in a second
+    pass to one file per block, along with their row in the file, so that each block overlaps a single position
+    range of the RegDB store and Sei features whatever the order of the file. Memory grows by 16 bytes per variant.
     Args:
-        input_json(json): a json object contains RegDB features
+        input_vcf (str): VCF-like file
+        block_rows (int): variants per block
+        scratch_dir (str): directory for the block files
+    Returns:
+        block_files (list of str): TSV files of the blocks in key order, None if the file is sorted by key (its
+            blocks in file order then already are)
+    '''
+    reader = pd.read_csv(input_vcf, sep='\t', usecols=[0,1], names=['chrom','end'], dtype={'chrom': str}, chunksize=block_rows)
+    keys = np.concatenate([position_key(block['chrom'], block['end']) for block in reader] or [np.empty(0, dtype=np.int64)])
+    if np.all(keys[1:] >= keys[:-1]):
+        return None
+    ranks = np.empty(len(keys), dtype=np.int64)
+    ranks[np.argsort(keys, kind='stable')] = np.arange(len(keys))
+    del keys
+    block_files = [os.path.join(scratch_dir, f'block-{i}.tsv') for i in range(-(-len(ranks) // block_rows))]
+    start = 0
+    for block in read_vcf_blocks(input_vcf, block_rows):
+        block['row'] = np.arange(start, start + len(block))
+        for i, rows in block.groupby(ranks[start:start + len(block)] // block_rows):
+            rows.to_csv(block_files[i], sep='\t', header=False, index=False, mode='a')
+        start += len(block)
+    return block_files
+
+def read_block_file(block_file):
+    '''Returns: block (pd.DataFrame): 'chrom', 'end', 'id', 'ref', 'alt' and 'row' in the input of a block written by sort_vcf_blocks'''
+    return pd.read_csv(block_file, sep='\t', names=['chrom','end','id','ref','alt','row'],
+                       dtype={'chrom': str, 'id': str, 'ref': str, 'alt': str})
+
+def write_in_input_order(part_files, outfile, block_rows):
+    '''Function to write the feature blocks of sorted variants in the order of the input, block_rows rows at a time
+    Each part holds the rows of a block sorted by their 'row' in the input, so the output is a merge of the parts
+    that keeps one batch of each part in memory, and is written as one row group per block_rows rows.
+    Args:
+        part_files (list of Path): Parquet files of the blocks, with a 'row' column
+        outfile (str): output file path
+        block_rows (int): rows per row group of the output
+    '''
+    parts = [pq.ParquetFile(part_file) for part_file in part_files]
+    schema = parts[0].schema_arrow
+    schema = schema.remove(schema.get_field_index('row'))
+    batches = [part.iter_batches(batch_size=max(block_rows // len(parts), 1024)) for part in parts]
+    pending = [pd.DataFrame() for _ in parts]
+    exhausted = [False] * len(parts)
+    num_rows = sum(part.metadata.num_rows for part in parts)
+    with pq.ParquetWriter(outfile, schema) as writer:
+        for stop in range(block_rows, num_rows + block_rows, block_rows):
+            pieces = []
+            for k in range(len(parts)):
+                while not exhausted[k] and (pending[k].empty or pending[k]['row'].iloc[-1] < stop):
+                    batch = next(batches[k], None)
+                    if batch is None:
+                        exhausted[k] = True
+                    elif pending[k].empty:
+                        pending[k] = batch.to_pandas()
+                    else:
+                        pending[k] = pd.concat([pending[k], batch.to_pandas()], ignore_index=True)
+                taken = int(np.searchsorted(pending[k]['row'].to_numpy(), stop)) if len(pending[k]) else 0
+                pieces.append(pending[k].iloc[:taken])
+                pending[k] = pending[k].iloc[taken:]
+            rows = pd.concat(pieces, ignore_index=True).sort_values('row').drop(columns='row')
+            writer.write_table(pa.Table.from_pandas(rows, schema=schema, preserve_index=False))
+
+def read_position_ranges(dataset, block, pos_column='end', columns=None):
+    '''Function to read the rows of a position-sorted Parquet dataset within the positions of a block, chromosome by chromosome
+    Row groups outside the range of a chromosome are skipped using their statistics, so for blocks of sorted variants
+    each block reads only the row groups it overlaps, as in a merge join.
     Returns:
-        out(list of str): RegDB features ('chrom','end','CHIP','Chromatin_accessibility','PWM','FOOTPRINT','QTL','PWM_matched','FOOTPRINT_matched')
+        rows (pd.DataFrame): rows of the dataset with a position in the range of the block on the same chromosome
     '''
-    out = [input_json['chrom'],input_json['end']]
-    feature_names = ['ChIP','Chromatin_accessibility','PWM','Footprint','QTL','PWM_matched','Footprint_matched',  'IC_matched_max', 'IC_max']
-    out_features = [int(input_json['features'][feature]) for feature in feature_names] #convert to binary values
-    out.extend(out_features)
-    return out
+    ranges = block.groupby('chrom')['end'].agg(['min', 'max'])
+    tables = [dataset.to_table(columns=columns, filter=(ds.field('chrom') == chrom) & (ds.field(pos_column) >= int(start)) & (ds.field(pos_column) <= int(stop)))
+              for chrom, start, stop in ranges.itertuples()]
+    return pa.concat_tables(tables).to_pandas()
+
+def get_sei_means(input_sei):
+    '''Function to compute the mean of each sequence class score in a pass over the Sei features, one row group at a time
+    Returns:
+        means (pd.Series): sequence class -> mean score over the Sei features
+    '''
+    parquet_file = pq.ParquetFile(input_sei)
+    seqclass_names = [name for name in parquet_file.schema_arrow.names if name not in SEI_LABEL_COLUMNS]
+    sums = np.zeros(len(seqclass_names))
+    counts = np.zeros(len(seqclass_names))
+    for batch in parquet_file.iter_batches(columns=seqclass_names):
+        values = np.column_stack([batch.column(i).to_numpy(zero_copy_only=False) for i in range(batch.num_columns)]).astype(np.float64)
+        sums += np.nansum(values, axis=0)
+        counts += np.sum(~np.isnan(values), axis=0)
+    return pd.Series(sums / np.maximum(counts, 1), index=seqclass_names)
+
+def get_output_schema(df):
+    '''Returns: schema (pa.Schema): schema of every block of the streamed output, with nullable RegDB and Sei label features'''
+    schema = pa.Schema.from_pandas(df, preserve_index=False)
+    schema = schema.set(schema.get_field_index('chrom'), pa.field('chrom', CHROM_TYPE))
+    for name in GENERIC_COLUMNS:
+        schema = schema.set(schema.get_field_index(name), pa.field(name, pa.float32()))
+    for name in ['ref_match', 'contains_unk']:
+        schema = schema.set(schema.get_field_index(name), pa.field(name, pa.bool_()))
+    return schema
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(description="Extract generic features for variants.")
     parser.add_argument('--input_vcf', type=str, required=True, help='Path to input VCF file')
-    parser.add_argument('--input_jsonl', type=str, required=True, help='Path to RegDB features JSONL file')
-    parser.add_argument('--input_sei', type=str, required=True, help='Path to SEI features file')
+    parser.add_argument('--regdb_store', type=str, required=True, help='Path to RegDB store directory')
+    parser.add_argument('--input_sei', type=str, required=True, help='Path to SEI sequence class features Parquet file')
     parser.add_argument('--dnase_sig_path', type=str, required=True, help='Path to quantile-normalized DNase signal bigWig files')
     parser.add_argument('--chip_sig_path', type=str, required=True, help='Path to quantile-normalized ChIP signal bigWig files')
+    parser.add_argument('--threads', type=int, default=1, help='Number of worker processes reading the bigWig files')
+    parser.add_argument('--block_rows', type=int, default=0, help='Number of variants processed and written at a time, so that memory does not grow with the input (0 processes all variants at once)')
     parser.add_argument('--out', type=str, required=True, help='Output file path')
+    parser.add_argument('--cache_dir', type=str, help='Optional path to variant cache directory the features are added to')
+    parser.add_argument('--feature_version', type=str, help='Version of the feature resources, for the variant cache')
+    parser.add_argument('--checkpoint_dir', type=str, help='Optional directory for the finished blocks in streaming mode, so that a failed run resumes from its last finished block')
+    parser.add_argument('--metrics', type=str, help='Optional path to the stage metrics JSON file')
     args = parser.parse_args()
+    metrics = StageMetrics('extract_generic', args.metrics)
 
     input_vcf = args.input_vcf
-    input_jsonl = args.input_jsonl
+    regdb_store = args.regdb_store
     input_sei = args.input_sei
     dnase_sig_path = Path(args.dnase_sig_path)
     chip_sig_path = Path(args.chip_sig_path)
     outfile = args.out
+    streaming = args.block_rows > 0
+
+    bigwig_paths = {DNase_sig_feature: dnase_sig_path / f'{DNase_sig_feature}.bw'
+                    for DNase_sig_feature in DNASE_SIGNAL_FEATURES}
+    bigwig_paths.update({ChIP_sig_feature: chip_sig_path / f'{ChIP_sig_feature}.bw'
+                    for ChIP_sig_feature in CHIP_SIGNAL_FEATURES})
+    pool = signal_pool(args.threads)
+    cache = VariantCache(args.cache_dir, args.feature_version) if args.cache_dir else None
+
+    # In streaming mode, blocks of variants are joined with the position ranges they overlap in the position-sorted
+    # RegDB store and Sei features, and missing Sei features are filled with means over the whole Sei features.
+    # Variants not sorted by position are first split into blocks of consecutive positions, and their features are
+    # put back in the order of the input once all blocks are done.
+    block_files = None
+    if streaming:
+        regdb_dataset = ds.dataset(str(Path(regdb_store) / VARIANTS_FILE), format='parquet')
+        sei_dataset = ds.dataset(input_sei, format='parquet')
+        with metrics.phase('sei_means'):
+            sei_means = get_sei_means(input_sei)
+        scratch_dir = tempfile.TemporaryDirectory(prefix='.generic_blocks.', dir=os.path.dirname(os.path.abspath(outfile)))
+        with metrics.phase('sort_variants'):
+            block_files = sort_vcf_blocks(input_vcf, args.block_rows, scratch_dir.name)
+        metrics.count('sorted_blocks', len(block_files or []))
+    writer = None
+
+    # With a checkpoint, or for variants not sorted by position, each block is written to its own file and the
+    # output is assembled once all blocks are done
+    checkpoint = None
+    if streaming and args.checkpoint_dir:
+        fingerprint = get_fingerprint([input_vcf, regdb_store, input_sei, dnase_sig_path, chip_sig_path], block_rows=args.block_rows,
+                                      sorted_blocks=block_files is not None)
+        checkpoint = ChunkCheckpoint(args.checkpoint_dir, fingerprint)
+        metrics.count('resumed_blocks', checkpoint.resumed)
+    part_files = []
+
+    blocks = read_vcf_blocks(input_vcf, args.block_rows) if block_files is None else map(read_block_file, block_files)
+    for i, df_all in enumerate(blocks):
+        if checkpoint is not None:
+            part_files.append(checkpoint.path(i, '.parquet'))
+            if checkpoint.done(i):
+                continue
+        elif block_files is not None:
+            part_files.append(Path(scratch_dir.name) / f'part-{i}.parquet')
+        df_all = with_position_key(df_all)
+        metrics.count('variants', len(df_all))
+        metrics.count('blocks', 1)
+
+        ### GET GENERIC REGDB QUERY FEATURES
+        with metrics.phase('regdb_features'):
+            if streaming:
+                regdb_features = read_position_ranges(regdb_dataset, df_all, columns=['chrom', 'end'] + GENERIC_COLUMNS)
+            else:
+                regdb_features = read_variants(regdb_store)[['chrom', 'end'] + GENERIC_COLUMNS]
+            regdb_features = with_position_key(regdb_features).drop(columns=['chrom', 'end'])
+            df_all = pd.merge(df_all, regdb_features, on=KEY_COLUMN, how='left')
+
+        ### GENERIC DNASE AND CHIP SIGNALS
+        with metrics.phase('signal_tracks'):
+            signal_lookup = SignalLookup(df_all['chrom'], df_all['end'])
+            for sig_feature, signal in get_signal_tracks(signal_lookup, bigwig_paths, pool).items():
+                df_all[sig_feature] = signal
+        metrics.count('bigwig_bases_read', len(bigwig_paths) * signal_lookup.bases())
+
+        ### SEI SEQUENCE CLASSES
+        with metrics.phase('sei_features'):
+            sei_features = read_position_ranges(sei_dataset, df_all, 'pos') if streaming else pd.read_parquet(input_sei)
+            sei_features.rename(columns={'pos':'end'}, inplace=True)
+            sei_features.drop(['seqclass_max_absdiff', 'strand', 'id'], axis=1, inplace=True)
+            sei_features = with_position_key(sei_features).drop(columns=['chrom', 'end'])
+
+            df_all = df_all.merge(sei_features, how='left', on=VARIANT_JOIN_KEY)
+            has_sei = has_sei_features(df_all)
+            df_all.iloc[:, -40:] = df_all.iloc[:, -40:].fillna(sei_means if streaming else df_all.iloc[:, -40:].mean())
+            df_all['max_abs_diff'] = df_all.iloc[:, -40:].abs().max(axis=1)
+            df_all = to_generic_schema(df_all)
+
+        # Save as parquet, one row group per block in streaming mode
+        with metrics.phase('write'):
+            # Only variants with Sei features are cached: the means filled in for the others depend on the run
+            if cache is not None:
+                cache.put_generic(df_all[has_sei].drop(columns='row', errors='ignore'))
+            if part_files:
+                if 'row' in df_all:
+                    df_all = df_all.sort_values('row')
+                tmp = part_files[i].with_name(f'{part_files[i].name}.tmp')
+                pq.write_table(pa.Table.from_pandas(df_all, schema=get_output_schema(df_all), preserve_index=False), tmp)
+                os.replace(tmp, part_files[i])
+                if checkpoint is not None:
+                    checkpoint.commit(i, rows=len(df_all))
+            elif streaming:
+                if writer is None:
+                    writer = pq.ParquetWriter(outfile, get_output_schema(df_all))
+                writer.write_table(pa.Table.from_pandas(df_all, schema=writer.schema, preserve_index=False))
+            else:
+                df_all.to_parquet(outfile, index=False)
+        metrics.count('rows_written', len(df_all))
 
-    ### READ IN VARIANTS
-    df_all = pd.read_csv(input_vcf, sep='\t', usecols=[0,1,2,3,4], names=['chrom','end','id','ref','alt'])
-        
-    ### GET GENERIC REGDB QUERY FEATURES
-    RegDB_generic_features = []
-    with open(input_jsonl) as f:
-        for line in f:
-            if line != '\n': # json.loads isn't happy if it encounters an empty line
-                var_json = json.loads(line.strip())
-                RegDB_generic_features.append(get_generic_features(var_json))
-    # Chromatin accessibility renamed to DNASE bc model only recognizes DNASE
-    df_all = pd.merge(df_all, pd.DataFrame(RegDB_generic_features,columns = ['chrom','end','CHIP','DNASE','PWM','FOOTPRINT','EQTL_2','PWM_matched','FOOTPRINT_matched','IC_matched_max', 'IC_max']).drop_duplicates(), 
-                    left_on=['chrom', 'end'], right_on=['chrom', 'end'], how='left')
-    
-    ### GENERIC DNASE SIGNALS
-    for DNase_sig_feature in ['DNase_var','DNase_quantile95','DNase_quantile1','DNase_quantile2','DNase_quantile3']:
-        bw = pyBigWig.open(str(dnase_sig_path / f'{DNase_sig_feature}.bw'))
-        df_all[DNase_sig_feature] = [np.round(np.array(bw.values(chrom,end-1,end))[0],4) for chrom,end in zip(df_all['chrom'],df_all['end'])] 
-        bw.close()
-
-    ### GENERIC CHIP SIGNALS
-    for ChIP_sig_feature in ['ChIP_var','ChIP_quantile95','ChIP_quantile1','ChIP_quantile2','ChIP_quantile3']:
-        bw = pyBigWig.open(str(chip_sig_path / f'{ChIP_sig_feature}.bw'))
-        df_all[ChIP_sig_feature] = [np.round(np.array(bw.values(chrom,end-1,end))[0],4) for chrom,end in zip(df_all['chrom'],df_all['end'])] 
-        bw.close()
-    
-    ### SEI SEQUENCE CLASSES
-    sei_features = pd.read_csv(input_sei, sep='\t')
-    sei_features.rename(columns={'pos':'end'}, inplace=True)
-    sei_features.drop(['seqclass_max_absdiff', 'strand', 'id'], axis=1, inplace=True)
-
-    df_all = df_all.merge(sei_features, how='left', left_on=['chrom', 'end', 'ref', 'alt'], 
-                    right_on=['chrom', 'end', 'ref', 'alt'])
-    df_all.iloc[:, -40:] = df_all.iloc[:, -40:].fillna(df_all.iloc[:, -40:].mean())
-    df_all['max_abs_diff'] = df_all.iloc[:, -40:].abs().max(axis=1)
-
-    # Save as parquet
-    df_all.to_parquet(outfile, index=False)
\ No newline at end of file
+    if writer is not None:
+        writer.close()
+    if part_files:
+        with metrics.phase('write'):
+            if block_files is None:
+                gather_parquet(part_files, outfile)
+            else:
+                write_in_input_order(part_files, outfile, args.block_rows)
+    if checkpoint is not None:
+        checkpoint.remove()
+    if streaming:
+        scratch_dir.cleanup()
+    if pool is not None:
+        pool.shutdown()
+    metrics.count('bigwig_tracks', len(bigwig_paths))
+    metrics.count('sei_bytes', os.path.getsize(input_sei))
+    metrics.write()
@@ -1,202 +1,145 @@
 from pathlib import Path
 import argparse
 import json
-from collections import defaultdict
+import os
 
-import numpy as np
 import pandas as pd
-import pyBigWig
 
-def get_organ_sp_RegDB_features(var_json, organ):
-    '''Function to output RegDB organ specific features from a json object of a variant
+from bigwig_signal import SignalLookup, get_signal_tracks, signal_pool
+from chunk_checkpoint import ChunkCheckpoint, get_fingerprint
+from feature_schema import to_organsp_schema
+from regdb_store import COUNT_FEATURES, HISTONE_LIST, read_variants, read_peaks, split_peaks_by_organ, get_organ_sp_counts
+from stage_metrics import StageMetrics
+from variant_cache import VariantCache
+
+TOTAL_NUM_FEATURES = ['DNASE', 'TF', 'CTCF', 'H3K27ac', 'H3K36me3', 'H3K4me1', 'H3K4me3', 'H3K27me3']
+ORGANSP_SIGNAL_FEATURES = ['DNase_var','DNase_quantile95','DNase_quantile1','DNase_quantile2','DNase_quantile3']
+
+def read_total_num(total_num_path):
+    '''Returns: total_num_dict (dict): feature -> organ -> total number of organ-specific annotations'''
+    total_num_dict = {}
+    for feature in TOTAL_NUM_FEATURES:
+        total_num_dict[feature] = dict(pd.read_csv(Path(total_num_path) / f'{feature}_totalNum_organ_hg38.txt', sep='\t', header=None).values)
+    return total_num_dict
+
+def get_organ_sp_bigwig_paths(organsp_dnase_sig_path, organ):
+    '''Returns: bigwig_paths (dict): organ-specific signal feature name -> bigWig path of the organ'''
+    return {f'{DNase_sig_feature}_organSp': Path(organsp_dnase_sig_path) / f'{DNase_sig_feature}_{organ}.bw'
+            for DNase_sig_feature in ORGANSP_SIGNAL_FEATURES}
+
+def get_organ_sp_table(chroms, ends, counts, organ, total_num_dict, pseudo_count=2):
+    '''Function to assemble the organ specific feature table of one organ
     Args:
-        var_json(json): a json object contains RegDB features & peaks information
-        organ (str): biosample organ name (e.g. ['bodily fluid','blood','brain'])
+        chroms (list of str): variant chromosomes
+        ends (list of int): variant positions
+        counts (np.array): (num variants, len(COUNT_FEATURES)) RegDB feature counts for the organ
+        organ (str): biosample organ name with spaces
+        total_num_dict (dict): feature -> organ -> total number of organ-specific annotations
+        pseudo_count (int): denominator used for organs without a total number
     Returns:
-        feature_values (list): values for 'chrom','end','DNASE','FOOTPRINT', 'ChIP-seq', 'unique targets', 'unique biosamples ChIP', 'unique biosamples DNase'
+        organSp_df (pd.DataFrame): organ specific features, in the column order expected by the models
     '''
-    method_names = ['DNase-seq', 'footprints', 'ChIP-seq']
-    results = defaultdict(int) #keys: method_names; default value is 0
-    unique_targets = []
-    unique_biosamples = []
-    unique_biosamples_dnase = []
-    for exp in var_json['peaks']:
-        try:    
-            if exp['method'] in method_names:
-                try:
-                    if exp['method'] == 'ChIP-seq' and exp['targets'][0].startswith('POLR'): #not counting POLR ChIP-seq
-                        continue
-                except IndexError: #some json does not have an empty 'targets', and we still count it
-                    exp['targets'] = ['NA']
-                if organ in exp['organ_slims']:
-                    results[exp['method']] += 1
-                    if exp['method'] == 'ChIP-seq':
-                        unique_targets.append(exp['targets'][0])
-                        unique_biosamples.append(exp['biosample_term_name'])
-                    if exp['method'] == 'DNase-seq':
-                        unique_biosamples_dnase.append(exp['biosample_term_name'])
-        except KeyError:
-            continue
-    feature_values = [var_json['chrom'],var_json['end']]
-    feature_values.append(results['DNase-seq'])
-    feature_values.append(results['footprints'])
-    feature_values.append(results['ChIP-seq'])
-    feature_values.append(len(set(unique_targets))) #unique count TFs in ChIP
-    feature_values.append(len(set(unique_biosamples))) #unique count biosamples in ChIP
-    feature_values.append(len(set(unique_biosamples_dnase))) #unique count biosamples in DNase
-    return feature_values
-
-def get_organ_sp_RegDB_features_ctcf(var_json, organ):
-    '''Function to output RegDB organ specific ctcf features from a json object of a variant
-    Args:
-        var_json(json): a json object contains RegDB features & peaks information
-        organ (str): biosample organ name (e.g. ['bodily fluid','blood','brain'])
-    Returns:
-        feature_values (list): values for 'chrom','end','CTCF','unique biosamples ChIP'
-    '''
-    method_names = ['ChIP-seq']
-    results = defaultdict(int) #keys: method_names; default value is 0
-    unique_biosamples = []
-    for exp in var_json['peaks']:
+    organSp_df = pd.DataFrame(counts, columns=COUNT_FEATURES)
+    organSp_df.insert(0, 'chrom', chroms)
+    organSp_df.insert(1, 'end', ends)
+
+    def perc(feature, count_column):
         try:
-            if exp['method'] in method_names:
-                try:
-                    if exp['method'] == 'ChIP-seq' and exp['targets'][0].startswith('CTCF'):
-                        if organ in exp['organ_slims']:
-                            results['CTCF'] += 1
-                            unique_biosamples.append(exp['biosample_term_name'])
-                except IndexError:
-                    continue
+            return organSp_df[count_column] / total_num_dict[feature][organ]
         except KeyError:
-            continue
-    feature_values = [var_json['chrom'],var_json['end']]
-    feature_values.append(results['CTCF'])
-    feature_values.append(len(set(unique_biosamples))) #unique count biosamples in CTCF
-    return feature_values
-
-def get_organ_sp_features_histone(var_json, organ):
-    histone_list = ['H3K27ac','H3K36me3','H3K4me1','H3K4me3','H3K27me3']
-    results = defaultdict(int) #keys: histone mark; default value is 0
-    for exp in var_json['peaks']:
-        try:    
-            if exp['method'] == 'Histone ChIP-seq':
-                if organ in exp['organ_slims']:
-                    results[exp['target_label']] += 1
-        except KeyError:
-            continue
-    feature_values = [var_json['chrom'],var_json['end']]
-    for histone in histone_list:
-        feature_values.append(results[histone])
-    return feature_values
+            return organSp_df[count_column] / pseudo_count
+
+    organSp_df.insert(8, 'CHIP_organSp_perc', perc('TF', 'CHIP_organSp'))
+    organSp_df.insert(9, 'DNASE_organSp_perc', perc('DNASE', 'DNASE_organSp'))
+    organSp_df.insert(12, 'CTCF_organSp_perc', perc('CTCF', 'CTCF_organSp'))
+    for histone in HISTONE_LIST:
+        organSp_df[f'{histone}_organSp_perc'] = perc(histone, f'{histone}_organSp')
+    return organSp_df
 
 if __name__=="__main__":
 
     parser = argparse.ArgumentParser(description="Extract organ-specific features for variants.")
-    parser.add_argument('--input_jsonl', type=str, required=True, help='Path to RegDB features JSONL file')
-    parser.add_argument("--organ", help="Organ name", type=str) 
+    parser.add_argument('--regdb_store', type=str, required=True, help='Path to RegDB store directory')
+    parser.add_argument("--organs", help="Organ names (with underscores)", type=str, nargs='+', required=True)
     parser.add_argument('--organsp_dnase_sig_path', type=str, required=True, help='Path to quantile-normalized organ-specific DNase signal bigWig files')
     parser.add_argument('--total_num_path', type=str, required=True, help='Path to files containing total number of organ-specific annotations for a given feature')
     parser.add_argument('--organ_mapping_json', type=str, required=True, help='Path to file mapping organ names with underscores to organ names with spaces')
-    parser.add_argument('--out', type=str, required=True, help='Output file path')
+    parser.add_argument('--threads', type=int, default=1, help='Number of worker processes reading the bigWig files')
+    parser.add_argument('--outdir', type=str, required=True, help='Output directory, one {organ}_features.parquet is written per organ')
+    parser.add_argument('--cache_dir', type=str, help='Optional path to variant cache directory the features are added to')
+    parser.add_argument('--feature_version', type=str, help='Version of the feature resources, for the variant cache')
+    parser.add_argument('--checkpoint_dir', type=str, help='Optional directory for the finished organs, so that a failed run resumes from its last finished organ')
+    parser.add_argument('--metrics', type=str, help='Optional path to the stage metrics JSON file')
     args = parser.parse_args()
+    metrics = StageMetrics('extract_organsp', args.metrics)
 
-    input_jsonl = args.input_jsonl
+    regdb_store = args.regdb_store
     organsp_dnase_sig_path = Path(args.organsp_dnase_sig_path)
     total_num_path = Path(args.total_num_path)
-    outfile = args.out
+    outdir = Path(args.outdir)
 
-    # Get organ name with spaces since that is how they are labeled in RegDB JSON and bigwig filenames
+    # Get organ names with spaces since that is how they are labeled in RegDB JSON and bigwig filenames
     with open(args.organ_mapping_json, "r") as f:
         organ_mapping = json.load(f)
-    organ = organ_mapping[args.organ]
-
-    total_num_dict={}
-    for feature in ['DNASE', 'TF', 'CTCF', 'H3K27ac', 'H3K36me3', 'H3K4me1', 'H3K4me3', 'H3K27me3']:
-        total_num_dict[feature] = dict(pd.read_csv(total_num_path / f'{feature}_totalNum_organ_hg38.txt', sep='\t', header=None).values)
-
-    pseudo_count = 2
-
-    ### DNase, footprint, and ChIP features
-    regDB_organSp_features = []
-    with open(input_jsonl) as f:
-        print(f'Getting DNase, footprint, and ChIP feature counts for {organ} from RegDB query...')
-        for line in f:
-            if line != '\n':
-                var_json = json.loads(line.strip())
-                var_features = get_organ_sp_RegDB_features(var_json, organ)
-                regDB_organSp_features.append(var_features)
-
-    organSp_df = pd.DataFrame(regDB_organSp_features, columns = [
-        'chrom','end', 'DNASE_organSp', 'FOOTPRINT_organSp', 'CHIP_organSp', 
-        'CHIP_organSp_uniq', 'CHIP_organSp_biosample_uniq', 'DNASE_organSp_biosample_uniq'])
-    try:
-        organSp_df['CHIP_organSp_perc'] = organSp_df['CHIP_organSp'] / total_num_dict['TF'][organ]
-    except KeyError:
-        organSp_df['CHIP_organSp_perc'] = organSp_df['CHIP_organSp'] / pseudo_count
-    try:
-        organSp_df['DNASE_organSp_perc'] = organSp_df['DNASE_organSp'] / total_num_dict['DNASE'][organ]
-    except KeyError:
-        organSp_df['DNASE_organSp_perc'] = organSp_df['DNASE_organSp'] / pseudo_count
-
-    ### CTCF ChIP features
-    regDB_organSp_features_ctcf = []
-    with open(input_jsonl) as f:
-        print(f'Getting CTCF feature counts for {organ} from RegDB query...')
-        for line in f:
-            if line != '\n':
-                var_json = json.loads(line.strip())
-                var_features = get_organ_sp_RegDB_features_ctcf(var_json, organ)
-                regDB_organSp_features_ctcf.append(var_features)
-
-    organSp_df = organSp_df.merge(pd.DataFrame(regDB_organSp_features_ctcf, columns = ['chrom','end','CTCF_organSp','CTCF_organSp_biosample_uniq']), on=['chrom', 'end'], how='inner')
-    
-    try:
-        organSp_df['CTCF_organSp_perc'] = organSp_df['CTCF_organSp'] / total_num_dict['CTCF'][organ]
-    except:
-        organSp_df['CTCF_organSp_perc'] = organSp_df['CTCF_organSp'] / pseudo_count
-
-    ### Histone ChIP features
-    regDB_organSp_features_histone = []
-    with open(input_jsonl) as f:
-        print(f'Getting histone feature counts for {organ} from RegDB query...')
-        for line in f:
-            if line != '\n':
-                var_json = json.loads(line.strip())
-                var_features = get_organ_sp_features_histone(var_json, organ)
-                regDB_organSp_features_histone.append(var_features)
-        
-    organSp_df = organSp_df.merge(pd.DataFrame(regDB_organSp_features_histone, columns = [
-        'chrom','end','H3K27ac_organSp','H3K36me3_organSp','H3K4me1_organSp','H3K4me3_organSp','H3K27me3_organSp']))
-    
-    try:
-        organSp_df['H3K27ac_organSp_perc'] = organSp_df['H3K27ac_organSp'] / total_num_dict['H3K27ac'][organ]
-    except KeyError:
-        organSp_df['H3K27ac_organSp_perc'] = organSp_df['H3K27ac_organSp'] / pseudo_count
-    
-    try:
-        organSp_df['H3K36me3_organSp_perc'] = organSp_df['H3K36me3_organSp'] / total_num_dict['H3K36me3'][organ]
-    except KeyError:
-        organSp_df['H3K36me3_organSp_perc'] = organSp_df['H3K36me3_organSp'] / pseudo_count
-    
-    try:
-        organSp_df['H3K4me1_organSp_perc'] = organSp_df['H3K4me1_organSp'] / total_num_dict['H3K4me1'][organ]
-    except KeyError:
-        organSp_df['H3K4me1_organSp_perc'] = organSp_df['H3K4me1_organSp'] / pseudo_count    
-    
-    try:
-        organSp_df['H3K4me3_organSp_perc'] = organSp_df['H3K4me3_organSp'] / total_num_dict['H3K4me3'][organ]
-    except KeyError:
-        organSp_df['H3K4me3_organSp_perc'] = organSp_df['H3K4me3_organSp'] / pseudo_count
-    
-    try:
-        organSp_df['H3K27me3_organSp_perc'] = organSp_df['H3K27me3_organSp'] / total_num_dict['H3K27me3'][organ]
-    except KeyError:
-        organSp_df['H3K27me3_organSp_perc'] = organSp_df['H3K27me3_organSp'] / pseudo_count
-    
-    ### Signal features
-    for DNase_sig_feature in ['DNase_var','DNase_quantile95','DNase_quantile1','DNase_quantile2','DNase_quantile3']:
-        bw = pyBigWig.open(str(organsp_dnase_sig_path / f'{DNase_sig_feature}_{organ}.bw'))
-        organSp_df[f'{DNase_sig_feature}_organSp'] = [np.round(np.array(bw.values(chrom,end-1,end))[0],4) for chrom,end in zip(organSp_df['chrom'],organSp_df['end'])] 
-        bw.close()
-
-    organSp_df.drop_duplicates(subset=['chrom', 'end']).to_parquet(outfile, index=None)
\ No newline at end of file
+    organs = {organ_arg: organ_mapping[organ_arg] for organ_arg in args.organs}
+    organ_set = set(organs.values())
+
+    total_num_dict = read_total_num(total_num_path)
+
+    ### DNase, footprint, ChIP, CTCF and histone features from the RegDB store
+    with metrics.phase('read_store'):
+        variants = read_variants(regdb_store)
+        peaks, vocab = read_peaks(regdb_store)
+        organ_rows = split_peaks_by_organ(peaks, vocab, organ_set)
+    metrics.count('variants', len(variants))
+    metrics.count('peak_rows', len(peaks['var_idx']))
+    metrics.count('organs', len(organs))
+    signal_lookup = SignalLookup(variants['chrom'], variants['end'])
+    pool = signal_pool(args.threads)
+    cache = VariantCache(args.cache_dir, args.feature_version) if args.cache_dir else None
+
+    # With a checkpoint, the feature table of each organ is written to the checkpoint directory and moved to the
+    # output directory once all organs are done
+    checkpoint = None
+    if args.checkpoint_dir:
+        fingerprint = get_fingerprint([regdb_store, organsp_dnase_sig_path, total_num_path, args.organ_mapping_json])
+        checkpoint = ChunkCheckpoint(args.checkpoint_dir, fingerprint)
+        metrics.count('resumed_organs', len([organ_arg for organ_arg in organs if checkpoint.done(organ_arg)]))
+
+    outdir.mkdir(parents=True, exist_ok=True)
+    for organ_arg, organ in organs.items():
+        if checkpoint is not None and checkpoint.done(organ_arg):
+            continue
+        print(f'Getting features for {organ}...')
+        with metrics.phase('regdb_counts'):
+            counts = get_organ_sp_counts(peaks, vocab, organ_rows[organ], len(variants))
+            organSp_df = get_organ_sp_table(variants['chrom'], variants['end'], counts, organ, total_num_dict)
+
+        ### Signal features
+        with metrics.phase('signal_tracks'):
+            bigwig_paths = get_organ_sp_bigwig_paths(organsp_dnase_sig_path, organ)
+            for sig_feature, signal in get_signal_tracks(signal_lookup, bigwig_paths, pool).items():
+                organSp_df[sig_feature] = signal
+            organSp_df = to_organsp_schema(organSp_df)
+        metrics.count('bigwig_tracks', len(bigwig_paths))
+        metrics.count('bigwig_bases_read', len(bigwig_paths) * signal_lookup.bases())
+
+        with metrics.phase('write'):
+            if checkpoint is not None:
+                tmp = checkpoint.path(organ_arg, '.tmp.parquet')
+                organSp_df.to_parquet(tmp, index=None)
+                os.replace(tmp, checkpoint.path(organ_arg, '.parquet'))
+                checkpoint.commit(organ_arg, rows=len(organSp_df))
+            else:
+                organSp_df.to_parquet(outdir / f'{organ_arg}_features.parquet', index=None)
+            if cache is not None:
+                cache.put_organsp(organ_arg, organSp_df)
+        metrics.count('rows_written', len(organSp_df))
+
+    if checkpoint is not None:
+        for organ_arg in organs:
+            os.replace(checkpoint.path(organ_arg, '.parquet'), outdir / f'{organ_arg}_features.parquet')
+        checkpoint.remove()
+    if pool is not None:
+        pool.shutdown()
+    metrics.write()
@@ -0,0 +1,89 @@
+import zlib
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+
+from regdb_store import COUNT_FEATURES, GENERIC_COLUMNS, HISTONE_LIST
+
+# Integer position key shared by the feature tables of every stage: the chromosome code in the high 32 bits and
+# the position in the low 32 bits. Position-level joins run on it alone, variant-level joins on it with ref and alt.
+KEY_COLUMN = 'pos_key'
+VARIANT_JOIN_KEY = [KEY_COLUMN, 'ref', 'alt']
+
+# Codes of the primary assembly chromosomes; other contigs get a code from a hash of their name above these
+CHROM_CODES = {**{str(i): i for i in range(1, 23)}, 'X': 23, 'Y': 24, 'M': 25, 'MT': 25}
+CONTIG_CODE_BASE = 32
+
+# Compact column types of the feature tables. RegDB flags are float32 rather than int8 since variants missing from
+# the RegulomeDB query output have no value.
+ORGANSP_SIGNAL_FEATURES = ['DNase_var_organSp','DNase_quantile95_organSp','DNase_quantile1_organSp','DNase_quantile2_organSp','DNase_quantile3_organSp']
+PERC_FEATURES = ['CHIP_organSp_perc', 'DNASE_organSp_perc', 'CTCF_organSp_perc'] + [f'{histone}_organSp_perc' for histone in HISTONE_LIST]
+CHROM_TYPE = pa.dictionary(pa.int32(), pa.string())
+
+# Sei label column of the generic feature tables, left missing for variants without Sei features (whose sequence
+# class scores are filled with the means of the run)
+SEI_LABEL = 'ref_match'
+
+def chrom_code(chrom):
+    '''Returns: code (int): code of a chromosome name, with or without the 'chr' prefix'''
+    name = chrom[3:] if chrom.startswith('chr') else chrom
+    if name in CHROM_CODES:
+        return CHROM_CODES[name]
+    return CONTIG_CODE_BASE + zlib.crc32(name.encode()) % (2**31 - CONTIG_CODE_BASE)
+
+def position_key(chroms, ends):
+    '''Function to compute the integer position key of variants
+    Args:
+        chroms (array-like of str): variant chromosomes
+        ends (array-like of int): variant positions (below 2**32)
+    Returns:
+        keys (np.array): int64 position keys
+    '''
+    codes, names = pd.factorize(pd.Series(chroms).astype(str))
+    name_codes = np.array([chrom_code(name) for name in names], dtype=np.int64)
+    return (name_codes[codes] << 32) | np.asarray(ends, dtype=np.int64)
+
+def with_position_key(df):
+    '''Function to add the position key as the first column of a table with 'chrom' and 'end', if it is missing
+    Tables written before the key was introduced (e.g. older variant cache parts) get it computed on the fly.
+    Returns:
+        df (pd.DataFrame): the table, with KEY_COLUMN
+    '''
+    if KEY_COLUMN in df.columns and not df[KEY_COLUMN].isna().any():
+        return df
+    df = df.drop(columns=KEY_COLUMN, errors='ignore')
+    df.insert(0, KEY_COLUMN, position_key(df['chrom'], df['end']))
+    return df
+
+def has_sei_features(df):
+    '''Returns: has_sei (np.array): whether each row of a generic feature table has Sei features'''
+    return df[SEI_LABEL].notna().to_numpy()
+
+def to_compact_ints(values):
+    '''Returns: values (np.array): integer counts as int16, or int32 if they do not fit'''
+    values = np.asarray(values)
+    dtype = np.int16 if values.size == 0 or values.max() <= np.iinfo(np.int16).max else np.int32
+    return values.astype(dtype)
+
+def to_generic_schema(df):
+    '''Function to convert a generic feature table to the compact schema: categorical chromosomes, float32
+    RegDB flags, signals and Sei scores (every float column)
+    Returns:
+        df (pd.DataFrame): converted table
+    '''
+    df = with_position_key(df)
+    float_columns = GENERIC_COLUMNS + [column for column in df.columns if column not in GENERIC_COLUMNS and df[column].dtype == np.float64]
+    return df.astype({'chrom': 'category', **{column: np.float32 for column in float_columns}})
+
+def to_organsp_schema(df):
+    '''Function to convert an organ specific feature table to the compact schema: categorical chromosomes,
+    int16 counts (int32 if too large), float32 fractions and signals
+    Returns:
+        df (pd.DataFrame): converted table
+    '''
+    df = with_position_key(df)
+    for column in COUNT_FEATURES:
+        df[column] = to_compact_ints(df[column])
+    float_columns = [column for column in PERC_FEATURES + ORGANSP_SIGNAL_FEATURES if column in df.columns]
+    return df.astype({'chrom': 'category', **{column: np.float32 for column in float_columns}})
@@ -0,0 +1,53 @@
+from pathlib import Path
+import argparse
+import gzip
+import shutil
+
+import pyarrow.parquet as pq
+
+def gather_tsv(shard_files, outfile):
+    '''Function to concatenate gzipped TSV score files, keeping the header of the first one
+    Args:
+        shard_files (list of Path): per-shard score files, in shard order
+        outfile (Path): output file path
+    '''
+    with gzip.open(outfile, 'wb') as out:
+        for i, shard_file in enumerate(shard_files):
+            with gzip.open(shard_file, 'rb') as f:
+                header = f.readline()
+                if i == 0:
+                    out.write(header)
+                shutil.copyfileobj(f, out)
+
+def gather_parquet(shard_files, outfile):
+    '''Function to concatenate wide Parquet score files row group by row group, keeping the file metadata of the first one
+    Args:
+        shard_files (list of Path): per-shard score files, in shard order
+        outfile (Path): output file path
+    '''
+    schema = pq.read_schema(shard_files[0])
+    with pq.ParquetWriter(outfile, schema, compression='zstd') as writer:
+        for shard_file in shard_files:
+            parquet_file = pq.ParquetFile(shard_file)
+            for i in range(parquet_file.num_row_groups):
+                writer.write_table(parquet_file.read_row_group(i).cast(schema))
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Concatenate the TLand scores of the shards of a run.")
+    parser.add_argument('--shard_dirs', type=str, nargs='+', required=True, help='Prediction directories of the shards, in shard order')
+    parser.add_argument('--outdir', type=str, required=True, help='Output directory')
+    parser.add_argument('--out_format', type=str, choices=['tsv', 'parquet'], default='tsv', help='Format of the score files')
+    args = parser.parse_args()
+
+    shard_dirs = [Path(shard_dir) for shard_dir in args.shard_dirs]
+    outdir = Path(args.outdir)
+    outdir.mkdir(parents=True, exist_ok=True)
+
+    pattern = 'TLand_scores.parquet' if args.out_format == 'parquet' else 'TLand_scores.*.tsv.gz'
+    for name in sorted(path.name for path in shard_dirs[0].glob(pattern)):
+        shard_files = [shard_dir / name for shard_dir in shard_dirs]
+        if args.out_format == 'parquet':
+            gather_parquet(shard_files, outdir / name)
+        else:
+            gather_tsv(shard_files, outdir / name)
+        print(f'Gathered {name} from {len(shard_files)} shards')
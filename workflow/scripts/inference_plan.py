@@ -0,0 +1,248 @@
+import numpy as np
+from sklearn.ensemble import StackingClassifier
+from sklearn.impute import SimpleImputer
+from sklearn.linear_model import LogisticRegression, RidgeClassifier, RidgeClassifierCV
+from sklearn.pipeline import Pipeline
+from sklearn.preprocessing import StandardScaler
+from mlxtend.feature_selection import ColumnSelector
+
+from tland_utility import DummyClassifierReturnOriginal, NearestCentroidWithProb, RidgeClassifierMultiClassWithProb
+
+# Rows scored per batch by an inference plan
+BATCH_ROWS = 65536
+
+# Rows scored by both the plan and the sklearn model before a plan is used, and the largest allowed difference
+# (later rows are checked batch by batch for values the plan can't score, see InferencePlan)
+CHECK_ROWS = 1000
+CHECK_ATOL = 1e-4
+
+class UnsupportedModel(Exception):
+    pass
+
+class Select:
+    '''Column selection'''
+    def __init__(self, idx):
+        self.idx = np.asarray(idx, dtype=np.int64)
+    def __call__(self, X):
+        return X[:, self.idx]
+
+class Chain:
+    '''Steps applied one after another'''
+    def __init__(self, steps):
+        self.steps = steps
+    def __call__(self, X):
+        for step in self.steps:
+            X = step(X)
+        return X
+
+class Stack:
+    '''Concatenated outputs of branches applied to the same input, keeping the columns of each branch from `first`'''
+    def __init__(self, branches, first, passthrough=False):
+        self.branches = branches
+        self.first = first
+        self.passthrough = passthrough
+    def __call__(self, X):
+        outputs = [branch(X)[:, first:] for branch, first in zip(self.branches, self.first)]
+        if self.passthrough:
+            outputs.append(X)
+        return np.hstack(outputs)
+
+class Affine:
+    '''Linear layer X @ W + b'''
+    def __init__(self, W, b):
+        self.W = np.ascontiguousarray(W, dtype=np.float32)
+        self.b = np.asarray(b, dtype=np.float32)
+    def __call__(self, X):
+        out = X @ self.W
+        out += self.b
+        return out
+
+class Scale:
+    '''Per-column standardization (X - mean) / scale'''
+    def __init__(self, mean, scale):
+        self.mean = np.asarray(mean, dtype=np.float32)
+        self.scale = np.asarray(scale, dtype=np.float32)
+    def __call__(self, X):
+        return (X - self.mean) / self.scale
+
+class Impute:
+    '''Per-column replacement of missing values'''
+    def __init__(self, fill):
+        self.fill = np.asarray(fill, dtype=np.float32)
+    def __call__(self, X):
+        return np.where(np.isnan(X), self.fill, X)
+
+class Complement:
+    '''[1 - X, X], as DummyClassifierReturnOriginal.predict_proba'''
+    def __call__(self, X):
+        return np.hstack([1 - X, X])
+
+class Distances:
+    '''Euclidean distances to centroids'''
+    def __init__(self, centroids):
+        self.centroids = np.ascontiguousarray(centroids, dtype=np.float32)
+        self.sq_norms = np.einsum('ij,ij->i', self.centroids, self.centroids)
+    def __call__(self, X):
+        sq = np.einsum('ij,ij->i', X, X)[:, None] - 2 * (X @ self.centroids.T) + self.sq_norms
+        return np.sqrt(np.maximum(sq, 0))
+
+class Softmax:
+    '''Row-wise softmax, as sklearn.utils.extmath.softmax'''
+    def __call__(self, X):
+        X = np.exp(X - X.max(axis=1, keepdims=True))
+        X /= X.sum(axis=1, keepdims=True)
+        return X
+
+class Compiler:
+    '''Flattens a fitted model into a plan of the steps above
+
+    The plan input holds the columns of the model's input DataFrame read by root-level column selections (all
+    columns if the model reads the whole frame); every other step works on the outputs of earlier steps.
+    '''
+
+    def __init__(self, columns):
+        self.columns = list(columns)
+        self.root_selects = []
+
+    def select(self, cols, root):
+        if cols is None:
+            idx = np.arange(len(self.columns)) if root else None
+        elif all(isinstance(col, str) for col in cols):
+            if not root:
+                raise UnsupportedModel('Column names can only be selected from the input DataFrame')
+            idx = [self.columns.index(col) for col in cols]
+        elif all(isinstance(col, int) for col in cols):
+            idx = list(cols)
+        else:
+            raise UnsupportedModel(f'Unsupported column selection {cols}')
+        if idx is None:
+            return Chain([])
+        node = Select(idx)
+        if root:
+            self.root_selects.append(node)
+        return node
+
+    def linear(self, estimator, method):
+        '''Plan of a linear classifier's decision_function or predict_proba'''
+        coef = np.atleast_2d(np.asarray(estimator.coef_, dtype=np.float64))
+        intercept = np.ravel(estimator.intercept_)
+        if method == 'decision_function':
+            return Affine(coef.T, intercept)
+        if isinstance(estimator, RidgeClassifierMultiClassWithProb) and coef.shape[0] > 1:
+            return Chain([Affine(coef.T, intercept), Softmax()])
+        if coef.shape[0] != 1 or isinstance(estimator, RidgeClassifierMultiClassWithProb):
+            raise UnsupportedModel(f'Unsupported {type(estimator).__name__} with {coef.shape[0]} decision functions')
+        w = coef[0]
+        if isinstance(estimator, LogisticRegression):
+            # [1 - expit(d), expit(d)] == softmax([0, d])
+            return Chain([Affine(np.c_[np.zeros_like(w), w], [0, intercept[0]]), Softmax()])
+        # Ridge*WithProb: softmax([-d, d])
+        return Chain([Affine(np.c_[-w, w], [-intercept[0], intercept[0]]), Softmax()])
+
+    def compile(self, model, method='predict_proba', root=True):
+        '''Returns: plan (callable): the model's `method` as a function of a float32 matrix'''
+        if isinstance(model, Pipeline):
+            steps = [step for _, step in model.steps if step is not None and step != 'passthrough']
+            plan = []
+            for i, step in enumerate(steps):
+                last = i == len(steps) - 1
+                plan.append(self.compile(step, method if last else 'transform', root and i == 0))
+            return Chain(plan)
+        if isinstance(model, StackingClassifier):
+            estimators = [(est, meth) for est, meth in zip(model.estimators_, model.stack_method_) if est != 'drop']
+            binary = len(model.classes_) == 2
+            if model.passthrough and root:
+                raise UnsupportedModel('Passthrough of the input DataFrame is not supported')
+            stack = Stack([self.compile(est, meth, root) for est, meth in estimators],
+                          [1 if meth == 'predict_proba' and binary else 0 for _, meth in estimators],
+                          model.passthrough)
+            return Chain([stack, self.compile(model.final_estimator_, method, False)])
+        if isinstance(model, ColumnSelector):
+            return self.select(model.cols, root)
+        if root:
+            plan = self.compile(model, method, False)
+            return Chain([self.select(None, True), plan])
+        if isinstance(model, DummyClassifierReturnOriginal):
+            return Complement() if method == 'predict_proba' else Chain([])
+        if isinstance(model, StandardScaler) and method == 'transform':
+            mean = model.mean_ if model.mean_ is not None else 0
+            scale = model.scale_ if model.scale_ is not None else 1
+            return Scale(mean, scale)
+        if isinstance(model, SimpleImputer) and method == 'transform':
+            if model.add_indicator or np.isnan(model.statistics_).any():
+                raise UnsupportedModel('Unsupported SimpleImputer settings')
+            return Impute(model.statistics_)
+        if isinstance(model, (RidgeClassifier, RidgeClassifierCV, LogisticRegression)) and method in ('predict_proba', 'decision_function'):
+            if method == 'predict_proba' and not hasattr(model, 'predict_proba'):
+                raise UnsupportedModel(f'{type(model).__name__} has no predict_proba')
+            return self.linear(model, method)
+        if isinstance(model, NearestCentroidWithProb) and method == 'predict_proba':
+            if getattr(model, 'metric', 'euclidean') != 'euclidean':
+                raise UnsupportedModel(f'Unsupported NearestCentroid metric {model.metric}')
+            return Chain([Distances(model.centroids_), Softmax()])
+        raise UnsupportedModel(f'Unsupported step {type(model).__name__}.{method}')
+
+class InferencePlan:
+    '''Compiled predict_proba of a fitted model, run on a float32 matrix in fixed-size batches
+
+    Batches with infinite inputs, or whose compiled probabilities are not all finite (e.g. missing values the model
+    does not impute), are run through the sklearn model instead, which scores or rejects them as it would without
+    the plan.
+
+    Args:
+        model: fitted model (Pipeline, StackingClassifier and the estimators of tland_utility)
+        columns (list of str): columns of the DataFrames the model is applied to
+    '''
+
+    def __init__(self, model, columns):
+        compiler = Compiler(columns)
+        self.model = model
+        self.plan = compiler.compile(model)
+        used = sorted({int(i) for node in compiler.root_selects for i in node.idx})
+        position = {column: i for i, column in enumerate(used)}
+        for node in compiler.root_selects:
+            node.idx = np.array([position[int(i)] for i in node.idx], dtype=np.int64)
+        self.input_columns = used
+
+    def predict_proba(self, df, batch_rows=BATCH_ROWS):
+        X = df.iloc[:, self.input_columns].to_numpy(dtype=np.float32)
+        out = None
+        for start in range(0, len(X), batch_rows):
+            batch = X[start:start + batch_rows]
+            proba = None if np.isinf(batch).any() else self.plan(batch)
+            if proba is None or not np.isfinite(proba).all():
+                proba = self.model.predict_proba(df.iloc[start:start + batch_rows])
+            if out is None:
+                out = np.empty((len(X), proba.shape[1]), dtype=np.float32)
+            out[start:start + len(proba)] = proba
+        return out if out is not None else np.empty((0, 2), dtype=np.float32)
+
+# Plans of the models used in this process, keyed by model and input columns (None if the model runs through sklearn)
+_plans = {}
+
+def get_inference_plan(model, df):
+    '''Function to compile a model for the columns of df, checked against the sklearn model on the first rows of df
+    Returns:
+        plan (InferencePlan): compiled model, or None if the model can't be compiled or doesn't match sklearn
+    '''
+    key = (id(model), tuple(df.columns))
+    if key not in _plans:
+        try:
+            plan = InferencePlan(model, df.columns)
+            sample = df.iloc[:CHECK_ROWS]
+            diff = np.abs(plan.predict_proba(sample) - model.predict_proba(sample)).max() if len(sample) else 0
+            if not diff <= CHECK_ATOL:
+                raise UnsupportedModel(f'Compiled model differs from sklearn by {diff:.2g}')
+        except (UnsupportedModel, ValueError, TypeError) as e:
+            print(f'Using sklearn inference for {type(model).__name__}: {e}')
+            plan = None
+        _plans[key] = plan
+    return _plans[key]
+
+def predict_proba(model, df):
+    '''Function to run a model's predict_proba, through its compiled plan when it has one
+    Returns:
+        proba (np.array): (len(df), n_classes) probabilities
+    '''
+    plan = get_inference_plan(model, df)
+    return plan.predict_proba(df) if plan is not None else model.predict_proba(df)
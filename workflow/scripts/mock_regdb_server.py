@@ -0,0 +1,53 @@
+import argparse
+import json
+
+from regdb_server import QueryServer
+from regdb_store import GENERIC_FEATURES
+
+def read_records(jsonl_paths):
+    '''Function to index RegDB query output records by position, keeping the first record of each position
+    Returns:
+        records (dict): (chrom, end) -> JSONL record
+    '''
+    records = {}
+    for jsonl_path in jsonl_paths:
+        with open(jsonl_path) as f:
+            for line in f:
+                if line.strip():
+                    var_json = json.loads(line)
+                    records.setdefault((var_json['chrom'], int(var_json['end'])), line.strip())
+    return records
+
+def empty_record(chrom, end):
+    return json.dumps({'chrom': chrom, 'end': end, 'features': {feature: False for feature in GENERIC_FEATURES}, 'peaks': []})
+
+def answer_bed(records, bed):
+    '''Returns: payload (bytes): indexed record of each position of the BED lines (an empty record if unknown)'''
+    lines = []
+    for bed_line in bed.splitlines():
+        if bed_line.strip():
+            chrom, _, end = bed_line.split('\t')[:3]
+            lines.append(records.get((chrom, int(end))) or empty_record(chrom, int(end)))
+    return ''.join(line + '\n' for line in lines).encode()
+
+def make_server(jsonl_paths, host='127.0.0.1', port=0, fail_rate=0.0):
+    '''Function to create a local stand-in for the RegulomeDB query service (port 0 picks a free port)
+    Returns:
+        server (QueryServer): server, not yet serving; its URL is http://{host}:{server.server_port}/
+    '''
+    records = read_records(jsonl_paths)
+    server = QueryServer((host, port), lambda bed: answer_bed(records, bed), fail_rate)
+    server.records = records
+    return server
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Serve RegDB query output files as a local stand-in for the RegulomeDB query service.")
+    parser.add_argument('--jsonl', type=str, nargs='+', required=True, help='RegDB query output JSONL files to serve')
+    parser.add_argument('--host', type=str, default='127.0.0.1', help='Host to listen on')
+    parser.add_argument('--port', type=int, default=8001, help='Port to listen on')
+    parser.add_argument('--fail_rate', type=float, default=0.0, help='Fraction of requests answered with status 503, to exercise client retries')
+    args = parser.parse_args()
+
+    server = make_server(args.jsonl, args.host, args.port, args.fail_rate)
+    print(f'Serving {len(server.records)} positions on http://{args.host}:{server.server_port}/')
+    server.serve_forever()
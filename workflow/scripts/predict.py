@@ -5,48 +5,169 @@ import time
 import argparse
 from collections import defaultdict
 
+import joblib
+import numpy as np
 import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
 
-def predict(organ, generic_features, organsp_features, gt_100_tf_chip, model_ls):
-    
-    pred_dict = defaultdict(defaultdict(list).copy)
-    df_all = pd.read_parquet(generic_features)
+from feature_schema import KEY_COLUMN, VARIANT_JOIN_KEY, has_sei_features, with_position_key
+from inference_plan import predict_proba
+from score_index import ScoreIndex
+from stage_metrics import StageMetrics
+from variant_cache import VARIANT_KEY, POSITION_KEY, VariantCache, read_vcf_keys
+
+# Organs with greater than 100 TF-ChIP experiments (Use TLand for these, TLand-lightest for everything else)
+GT_100_TF_CHIP = ["epithelium",
+                    "blood",
+                    "bodily fluid",
+                    "exocrine gland",
+                    "endocrine gland",
+                    "liver",
+                    "lung",
+                    "kidney",
+                    "mammary gland",
+                    "brain",
+                    "connective tissue",
+                    "skin of body",
+                    "uterus"]
+
+def predict(organ, df_generic, organsp_df, gt_100_tf_chip, model_ls, compiled=True):
 
-    organsp_df = pd.read_parquet(organsp_features)
+    pred_dict = defaultdict(defaultdict(list).copy)
 
-    df_all = pd.merge(df_all, 
-                organsp_df.drop_duplicates(subset=['chrom', 'end']), 
-                on=['chrom', 'end'], how='left')
+    # join on the integer position key, dropped afterwards so that the model input keeps its column layout
+    organsp_df = with_position_key(organsp_df).drop(columns=['chrom', 'end']).drop_duplicates(subset=KEY_COLUMN)
+    df_all = pd.merge(with_position_key(df_generic), organsp_df, on=KEY_COLUMN, how='left').drop(columns=KEY_COLUMN)
 
-    # make prediction
-    if organ in gt_100_tf_chip:
-        pred_dict[organ][model_ls[0][0]].append(model_ls[0][1].predict_proba(df_all)[:, 1]) # TLand
-    else:
-        pred_dict[organ][model_ls[1][0]].append(model_ls[1][1].predict_proba(df_all)[:, 1]) # TLand lightest
+    # make prediction, through the compiled inference plan of the model unless disabled
+    model_name, model = model_ls[0] if organ in gt_100_tf_chip else model_ls[1] # TLand or TLand lightest
+    proba = predict_proba(model, df_all) if compiled else model.predict_proba(df_all)
+    pred_dict[organ][model_name].append(proba[:, 1])
 
     return df_all, pred_dict
 
+def predict_with_cache(organ_arg, organ, keys_df, df_generic, organsp_df, cache, gt_100_tf_chip, model_ls, compiled=True):
+    '''Function to score the variants of an organ without a cached score, and add the new scores to the cache
+    Args:
+        organ_arg (str): organ name with underscores, as used by the cache
+        organ (str): organ name with spaces
+        keys_df (pd.DataFrame): position key, 'chrom', 'end', 'id', 'ref', 'alt' of all variants of the run
+        df_generic (pd.DataFrame): newly computed generic features (None if no features were computed)
+        organsp_df (pd.DataFrame): newly computed organ-specific features (None if no features were computed)
+        cache (VariantCache): variant cache holding the features of the remaining variants
+    Returns:
+        scores (np.array): scores in keys_df row order (only those of variants with Sei features are cached)
+    '''
+    model_name = model_ls[0][0] if organ in gt_100_tf_chip else model_ls[1][0]
+    keys_df = with_position_key(keys_df)
+    cached = cache.get_scores(organ_arg, keys_df).reindex(columns=VARIANT_JOIN_KEY + ['score', 'model'])
+    scored = keys_df[[KEY_COLUMN] + VARIANT_KEY].merge(cached, on=VARIANT_JOIN_KEY, how='left')
+    need_keys = scored.loc[scored['score'].isna(), [KEY_COLUMN] + VARIANT_KEY].drop_duplicates()
+    if need_keys.empty:
+        return scored['score'].to_numpy()
+
+    # Newly computed features take precedence over cached ones
+    generic_sources = [df for df in [df_generic, cache.get_generic(need_keys)] if df is not None and not df.empty]
+    organsp_sources = [df for df in [organsp_df, cache.get_organsp(organ_arg, need_keys[[KEY_COLUMN] + POSITION_KEY])] if df is not None and not df.empty]
+    if not generic_sources or not organsp_sources:
+        raise RuntimeError(f'No features found for {len(need_keys)} variants without a cached {organ} score')
+    generic = pd.concat([with_position_key(df) for df in generic_sources], ignore_index=True).drop_duplicates(subset=VARIANT_JOIN_KEY)
+    generic = need_keys[VARIANT_JOIN_KEY].merge(generic, on=VARIANT_JOIN_KEY, how='left')[generic.columns]
+    organsp = pd.concat(organsp_sources, ignore_index=True)
+
+    _, pred_dict = predict(organ, generic, organsp, gt_100_tf_chip, model_ls, compiled)
+    new_scores = need_keys.assign(score=pred_dict[organ][model_name][0], model=model_name)
+    # Only scores of variants with Sei features are cached: the others depend on the means filled in by the run
+    cache.put_scores(organ_arg, new_scores[has_sei_features(generic)])
+
+    scores = pd.concat([cached.dropna(subset=['score']), new_scores[VARIANT_JOIN_KEY + ['score', 'model']]], ignore_index=True)
+    scored = keys_df[VARIANT_JOIN_KEY].merge(scores, on=VARIANT_JOIN_KEY, how='left')
+    return scored['score'].to_numpy()
+
+def lookup_scores(keys_df, scored_df, scores):
+    '''Function to look up the scores of variants among the scores of other, possibly reordered, rows
+    Args:
+        keys_df (pd.DataFrame): VARIANT_KEY of the variants
+        scored_df (pd.DataFrame): VARIANT_KEY of the scored rows
+        scores (np.array): scores in scored_df row order
+    Returns:
+        scores (np.array): scores in keys_df row order, NaN for variants without a scored row
+    '''
+    scored = with_position_key(scored_df)[VARIANT_JOIN_KEY].assign(score=scores).drop_duplicates(subset=VARIANT_JOIN_KEY)
+    return with_position_key(keys_df)[VARIANT_JOIN_KEY].merge(scored, on=VARIANT_JOIN_KEY, how='left')['score'].to_numpy()
+
+def load_model(path):
+    '''Function to load a pickled model, or its memory-mapped joblib conversion (see convert_models.py) if up to date
+    Memory-mapped arrays are read-only and shared by every process loading the same model on a node.
+    '''
+    joblib_path = path.with_suffix('.joblib')
+    if joblib_path.exists() and joblib_path.stat().st_mtime >= path.stat().st_mtime:
+        return joblib.load(joblib_path, mmap_mode='r')
+    if joblib_path.exists():
+        print(f'{joblib_path.name} is older than {path.name}, loading the pickle instead')
+    with path.open(mode='rb') as f:
+        return pickle.load(f)
+
+def load_models(models_path, organs, gt_100_tf_chip=GT_100_TF_CHIP):
+    '''Function to load each model once, and only if one of the organs uses it
+    Args:
+        models_path (Path): directory containing the pickled models
+        organs (iterable of str): organ names with spaces
+    Returns:
+        model_ls (list): [name, model] of TLand and TLand lightest (model is None if unused)
+    '''
+    model_ls = [['TLand', None], ['TLand_lightest', None]]
+    if any(organ in gt_100_tf_chip for organ in organs):
+        model_ls[0][1] = load_model(models_path / 'TLand_organSp.pickle')
+    if any(organ not in gt_100_tf_chip for organ in organs):
+        model_ls[1][1] = load_model(models_path / 'TLand_organSp_lightest.pickle')
+    return model_ls
+
+def write_wide_scores(keys_df, scores, models, outfile):
+    '''Function to write the scores of several organs to one Parquet file
+    Args:
+        keys_df (pd.DataFrame): 'chrom', 'pos', 'ref', 'alt' of the scored variants
+        scores (dict): organ (with underscores) -> scores in keys_df row order
+        models (dict): organ (with underscores) -> name of the model used, stored in the file metadata
+        outfile (Path): output file path
+    '''
+    wide_df = keys_df.reset_index(drop=True)
+    for organ_arg, organ_scores in scores.items():
+        wide_df[organ_arg] = np.asarray(organ_scores, dtype=np.float32)
+    table = pa.Table.from_pandas(wide_df, preserve_index=False)
+    table = table.replace_schema_metadata({**(table.schema.metadata or {}), b'tland_models': json.dumps(models).encode()})
+    pq.write_table(table, outfile, compression='zstd')
+
 if __name__ == '__main__':
     parser = argparse.ArgumentParser()
-    parser.add_argument("--generic_features", help="Path to generic features file", type=str) 
-    parser.add_argument("--organsp_features", help="Path to organ-specific features file", type=str)
-    parser.add_argument("--organ", help="Organ name", type=str)
+    parser.add_argument("--generic_features", help="Path to generic features file (may be omitted with --cache_dir if every variant is cached)", type=str)
+    parser.add_argument("--organsp_dir", help="Path to directory containing {organ}_features.parquet organ-specific features files", type=str)
+    parser.add_argument("--organs", help="Organ names (with underscores)", type=str, nargs='+')
     parser.add_argument('--organ_mapping_json', type=str, required=True, help='Path to file mapping organ names with underscores to organ names with spaces')
     parser.add_argument("--organ_list", help="List of organs TLand can make predictions for", type=str)
     parser.add_argument("--models_path", help="Path to directory containing model files", type=str)
-    parser.add_argument("--out", help="Output file path", type=str)
+    parser.add_argument("--outdir", help="Output directory", type=str)
+    parser.add_argument("--out_format", help="'tsv' writes one TLand_scores.{organ}.tsv.gz per organ, 'parquet' one wide TLand_scores.parquet with a score column per organ", type=str, choices=['tsv', 'parquet'], default='tsv')
+    parser.add_argument("--input_vcf", help="Path to input VCF file, scored in full when using the variant cache", type=str)
+    parser.add_argument("--cache_dir", help="Path to variant cache directory (scores are computed only for variants without a cached score)", type=str)
+    parser.add_argument("--feature_version", help="Version of the feature resources, for the variant cache", type=str)
+    parser.add_argument("--score_version", help="Version of the feature resources and models, for the variant cache and the score index", type=str)
+    parser.add_argument("--score_index", help="Path to a precomputed score index; only variants missing from it are scored from features", type=str)
+    parser.add_argument("--sklearn_inference", help="Score with the models' sklearn predict_proba instead of their compiled inference plans", action='store_true')
+    parser.add_argument("--metrics", help="Optional path to the stage metrics JSON file", type=str)
     args = parser.parse_args()
+    metrics = StageMetrics('predict', args.metrics)
 
-    generic_features = Path(args.generic_features)
-    organsp_features = args.organsp_features
+    organsp_dir = Path(args.organsp_dir)
     organ_list = args.organ_list
     models_path = Path(args.models_path)
-    outfile = args.out
+    outdir = Path(args.outdir)
 
-    # Get organ name with spaces since that is how they are labeled in RegDB JSON and bigwig filenames
+    # Get organ names with spaces since that is how they are labeled in RegDB JSON and bigwig filenames
     with open(args.organ_mapping_json, "r") as f:
         organ_mapping = json.load(f)
-    organ = organ_mapping[args.organ]
+    organs = {organ_arg: organ_mapping[organ_arg] for organ_arg in args.organs}
 
     organ_ls = []
     with Path(organ_list).open() as file:
@@ -55,44 +176,77 @@ if __name__ == '__main__':
             organ_ls.append(line)
     allowed_organ_args = organ_ls.copy()
     allowed_organ_args.append("all")
-    
-    if organ not in allowed_organ_args:
-        print(f"Error: Argument {organ} is not valid. Must be one of {allowed_organ_args}.")
-        exit(1)
-
-    tland_path = models_path / 'TLand_organSp.pickle'
-    tland_lightest_path = models_path / 'TLand_organSp_lightest.pickle'
-    model_ls = [['TLand', pickle.load(tland_path.open(mode='rb'))], 
-            ['TLand_lightest', pickle.load(tland_lightest_path.open(mode='rb'))]]
-    
-
-    # Organs with greater than 100 TF-ChIP experiments (Use TLand for these, TLand-lightest for everything else)
-    gt_100_tf_chip = ["epithelium",
-                        "blood",
-                        "bodily fluid",
-                        "exocrine gland",
-                        "endocrine gland",
-                        "liver",
-                        "lung",
-                        "kidney",
-                        "mammary gland",
-                        "brain",
-                        "connective tissue",
-                        "skin of body",
-                        "uterus"]
+
+    for organ in organs.values():
+        if organ not in allowed_organ_args:
+            print(f"Error: Argument {organ} is not valid. Must be one of {allowed_organ_args}.")
+            exit(1)
+
+    gt_100_tf_chip = GT_100_TF_CHIP
 
     start = time.time()
-    print(f'Predicting TLand scores for {organ}...')
-    
-    df_all, pred_dict = predict(organ, generic_features, organsp_features, gt_100_tf_chip, model_ls)
-    output_df = df_all[['chrom', 'end', 'ref', 'alt']].copy()
-    if organ in gt_100_tf_chip:
-        output_df[organ+"_"+model_ls[0][0]] = pred_dict[organ][model_ls[0][0]][0]
-    else:
-        output_df[organ+"_"+model_ls[1][0]] = pred_dict[organ][model_ls[1][0]][0]
-
-    output_df.rename(columns={'end': 'pos'}, inplace=True)
-    output_df.to_csv(outfile, sep='\t', index=None, compression='gzip')
+
+    with metrics.phase('load_models'):
+        model_ls = load_models(models_path, organs.values(), gt_100_tf_chip)
+    print(f'Loaded models in {time.time() - start:.2f} seconds')
+
+    with metrics.phase('read_features'):
+        cache = VariantCache(args.cache_dir, args.feature_version, args.score_version) if args.cache_dir else None
+        score_index = ScoreIndex(args.score_index, args.score_version) if args.score_index else None
+        df_generic = pd.read_parquet(args.generic_features) if args.generic_features else None
+        if cache is not None or score_index is not None:
+            keys_df = read_vcf_keys(args.input_vcf)
+        else:
+            keys_df = with_position_key(df_generic)[[KEY_COLUMN, 'chrom', 'end', 'id', 'ref', 'alt']].astype({'chrom': str})
+    index_scores = None
+    if score_index is not None:
+        with metrics.phase('read_score_index'):
+            index_scores = score_index.get_scores(keys_df, list(organs))
+    metrics.count('variants', len(keys_df))
+    metrics.count('organs', len(organs))
+    metrics.count('computed_feature_rows', len(df_generic) if df_generic is not None else 0)
+    outdir.mkdir(parents=True, exist_ok=True)
+
+    scores = {}
+    models = {}
+    for organ_arg, organ in organs.items():
+        print(f'Predicting TLand scores for {organ}...')
+
+        model_name = model_ls[0][0] if organ in gt_100_tf_chip else model_ls[1][0]
+        organsp_features = organsp_dir / f'{organ_arg}_features.parquet'
+        with metrics.phase('predict'):
+            # Scores from the score index, then from the variant cache or the features of the remaining variants
+            organ_scores = index_scores[organ_arg].to_numpy(dtype=np.float64) if index_scores is not None else np.full(len(keys_df), np.nan)
+            missing = np.isnan(organ_scores)
+            if cache is not None and missing.any():
+                organsp_df = pd.read_parquet(organsp_features) if df_generic is not None else None
+                organ_scores[missing] = predict_with_cache(organ_arg, organ, keys_df[missing], df_generic, organsp_df, cache, gt_100_tf_chip, model_ls, not args.sklearn_inference)
+            elif missing.any():
+                _, pred_dict = predict(organ, df_generic, pd.read_parquet(organsp_features), gt_100_tf_chip, model_ls, not args.sklearn_inference)
+                if score_index is None:
+                    organ_scores = pred_dict[organ][model_name][0]
+                else: # features were computed for the variants missing from the index only
+                    organ_scores[missing] = lookup_scores(keys_df[missing], df_generic, pred_dict[organ][model_name][0])
+        metrics.count('index_scores', int((~missing).sum()))
+
+        if args.out_format == 'parquet':
+            scores[organ_arg] = organ_scores
+            models[organ_arg] = model_name
+            continue
+
+        with metrics.phase('write'):
+            output_df = keys_df[['chrom', 'end', 'ref', 'alt']].copy()
+            output_df[organ+"_"+model_name] = organ_scores
+
+            output_df.rename(columns={'end': 'pos'}, inplace=True)
+            output_df.to_csv(outdir / f'TLand_scores.{organ_arg}.tsv.gz', sep='\t', index=None, compression='gzip')
+        metrics.count('rows_written', len(output_df))
+
+    if args.out_format == 'parquet':
+        with metrics.phase('write'):
+            write_wide_scores(keys_df[['chrom', 'end', 'ref', 'alt']].rename(columns={'end': 'pos'}), scores, models, outdir / 'TLand_scores.parquet')
+        metrics.count('rows_written', len(keys_df))
 
     elapsed = time.time() - start
     print(f'Total time: {elapsed:.2f} seconds')
+    metrics.write()
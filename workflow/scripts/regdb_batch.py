@@ -0,0 +1,124 @@
+from pathlib import Path
+import argparse
+import json
+import re
+
+import numpy as np
+import pandas as pd
+
+from feature_schema import position_key
+
+# Leading chromosome and position of a query output record, as written by utils.regulome_search_TLand;
+# records in another layout are parsed in full
+RECORD_PREFIX = re.compile(rb'^\{"chrom": "([^"]+)", "end": (\d+)[,}]')
+
+def read_bed_positions(bed_file):
+    '''Returns: positions (pd.DataFrame): 'chrom', 'start', 'end' of a BED file of query positions'''
+    return pd.read_csv(bed_file, sep='\t', header=None, usecols=[0, 1, 2], names=['chrom', 'start', 'end'],
+                       dtype={'chrom': str, 'start': np.int64, 'end': np.int64})
+
+def merge_positions(bed_files, outdir, shards=1):
+    '''Function to union the query positions of several units into de-duplicated, position-sorted shards
+    Args:
+        bed_files (list of str): reg_query_input.bed files of the units
+        outdir (Path): output directory, for positions.{i}.bed
+        shards (int): number of shards, each holding a contiguous range of positions
+    Returns:
+        total (int): number of positions over all units
+        unique (int): number of distinct positions
+    '''
+    beds = [read_bed_positions(bed_file) for bed_file in bed_files]
+    positions = pd.concat(beds, ignore_index=True)
+    total = len(positions)
+    positions = positions.drop_duplicates().sort_values(['chrom', 'start', 'end'])
+    outdir.mkdir(parents=True, exist_ok=True)
+    for i, shard in enumerate(np.array_split(np.arange(len(positions)), shards)):
+        positions.iloc[shard].to_csv(outdir / f'positions.{i}.bed', sep='\t', header=False, index=False)
+    return total, len(positions)
+
+def record_keys(lines):
+    '''Returns: keys (np.array): position key of each query output record'''
+    chroms = []
+    ends = []
+    for line in lines:
+        match = RECORD_PREFIX.match(line)
+        if match:
+            chroms.append(match.group(1).decode())
+            ends.append(int(match.group(2)))
+        else:
+            record = json.loads(line)
+            chroms.append(record['chrom'])
+            ends.append(int(record['end']))
+    return position_key(chroms, ends)
+
+def iter_line_blocks(jsonl_files, block_lines):
+    '''Yields: lines (list of bytes): up to block_lines records of the query output files, in order'''
+    for jsonl_file in jsonl_files:
+        with open(jsonl_file, 'rb') as f:
+            lines = []
+            for line in f:
+                if line.strip():
+                    lines.append(line)
+                if len(lines) == block_lines:
+                    yield lines
+                    lines = []
+            if lines:
+                yield lines
+
+def split_query_output(jsonl_files, bed_files, out_files, block_lines=100000):
+    '''Function to split the output of batched queries into the query output of each unit
+    Records are read in blocks; each unit's records are appended to its output file in the order of the batched output.
+    Args:
+        jsonl_files (list of str): outputs of the batched queries
+        bed_files (list of str): reg_query_input.bed files of the units
+        out_files (list of str): regdb_query_output.jsonl files of the units, in the order of bed_files
+        block_lines (int): number of records held in memory at a time
+    Returns:
+        records (int): number of records read
+        written (int): number of records written over all units
+    '''
+    unit_keys = []
+    for bed_file in bed_files:
+        positions = read_bed_positions(bed_file)
+        unit_keys.append(np.unique(position_key(positions['chrom'], positions['end'])))
+    for out_file in out_files:
+        open(out_file, 'wb').close()
+
+    records = 0
+    written = 0
+    for lines in iter_line_blocks(jsonl_files, block_lines):
+        keys = record_keys(lines)
+        records += len(lines)
+        for keys_of_unit, out_file in zip(unit_keys, out_files):
+            if not len(keys_of_unit):
+                continue
+            idx = np.minimum(np.searchsorted(keys_of_unit, keys), len(keys_of_unit) - 1)
+            hits = np.flatnonzero(keys_of_unit[idx] == keys)
+            if len(hits):
+                with open(out_file, 'ab') as f:
+                    f.writelines(lines[i] for i in hits)
+                written += len(hits)
+    return records, written
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Batch the RegulomeDB queries of several units: merge their positions, or split the batched query output.")
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    merge = subparsers.add_parser('merge', help='Union and de-duplicate the query positions of the units into position-sorted shards')
+    merge.add_argument('--beds', type=str, nargs='+', required=True, help='reg_query_input.bed files of the units')
+    merge.add_argument('--outdir', type=str, required=True, help='Output directory, for positions.{i}.bed')
+    merge.add_argument('--shards', type=int, default=1, help='Number of batched queries')
+    split = subparsers.add_parser('split', help='Split the batched query output into the query output of each unit')
+    split.add_argument('--jsonl', type=str, nargs='+', required=True, help='Outputs of the batched queries')
+    split.add_argument('--beds', type=str, nargs='+', required=True, help='reg_query_input.bed files of the units')
+    split.add_argument('--out', type=str, nargs='+', required=True, help='regdb_query_output.jsonl files of the units, in the order of --beds')
+    split.add_argument('--block_lines', type=int, default=100000, help='Number of query output records held in memory at a time')
+    args = parser.parse_args()
+
+    if args.command == 'merge':
+        total, unique = merge_positions(args.beds, Path(args.outdir), args.shards)
+        print(f'{unique} distinct positions out of {total} in {len(args.beds)} units, in {args.shards} shards')
+    else:
+        if len(args.beds) != len(args.out):
+            raise ValueError(f'Got {len(args.beds)} BED files but {len(args.out)} output files')
+        records, written = split_query_output(args.jsonl, args.beds, args.out, args.block_lines)
+        print(f'Split {records} query records into {written} records of {len(args.out)} units')
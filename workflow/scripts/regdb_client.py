@@ -0,0 +1,177 @@
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+import argparse
+import http.client
+import threading
+import time
+import urllib.parse
+import urllib.request
+
+from stage_metrics import StageMetrics
+
+def get_bed_lines(chroms, ends):
+    '''Returns: bed (str): BED lines of the variant positions, as written by the prep_input_bed rule'''
+    return ''.join(f'{chrom}\t{int(end) - 1}\t{int(end)}\n' for chrom, end in zip(chroms, ends))
+
+def query_regdb(url, chroms, ends, timeout=60):
+    '''Function to query a RegulomeDB HTTP service for variant positions
+    The service takes BED lines in the request body and answers with the JSONL records written by
+    `utils.regulome_search_TLand --peaks`, one per position.
+    Args:
+        url (str): query endpoint of the service
+        chroms (list-like of str): variant chromosomes
+        ends (list-like of int): 1-based variant positions
+        timeout (float): request timeout in seconds
+    Returns:
+        lines (list of str): JSONL records
+    '''
+    request = urllib.request.Request(url, data=get_bed_lines(chroms, ends).encode(),
+                                     headers={'Content-Type': 'text/plain'}, method='POST')
+    with urllib.request.urlopen(request, timeout=timeout) as response:
+        return response.read().decode().splitlines()
+
+def read_bed_positions(bed_file):
+    '''Returns: positions (list of (str, int)): distinct chromosome and 1-based position of the lines of a BED file, in file order'''
+    positions = {}
+    with open(bed_file) as f:
+        for line in f:
+            if line.strip():
+                fields = line.split('\t')
+                positions.setdefault((fields[0], int(fields[2])))
+    return list(positions)
+
+class RegDBClient:
+    '''Client of a RegulomeDB HTTP query service sending batches of positions concurrently
+
+    Each worker thread keeps a persistent connection to the service. At most `max_in_flight` batches are queued
+    or being sent at a time, and results are returned in batch order, so the client can stream the query output of
+    any number of positions in bounded memory. Failed requests are retried with exponential backoff.
+
+    Args:
+        url (str): query endpoint of the service
+        workers (int): number of concurrent requests (and connections)
+        batch_size (int): positions per request
+        max_in_flight (int): batches submitted but not yet returned (2 * workers if 0)
+        retries (int): retries of a failed request
+        timeout (float): request timeout in seconds
+        backoff (float): seconds before the first retry, doubled for each following one
+    '''
+
+    def __init__(self, url, workers=8, batch_size=500, max_in_flight=0, retries=3, timeout=60, backoff=1.0):
+        parts = urllib.parse.urlsplit(url)
+        self.connection_class = http.client.HTTPSConnection if parts.scheme == 'https' else http.client.HTTPConnection
+        self.host = parts.hostname
+        self.port = parts.port
+        self.path = parts.path or '/'
+        self.batch_size = batch_size
+        self.max_in_flight = max_in_flight or 2 * workers
+        self.retries = retries
+        self.timeout = timeout
+        self.backoff = backoff
+        self.pool = ThreadPoolExecutor(workers)
+        self.local = threading.local()
+        self.lock = threading.Lock()
+        self.retried = 0
+
+    def _connection(self):
+        connection = getattr(self.local, 'connection', None)
+        if connection is None:
+            connection = self.connection_class(self.host, self.port, timeout=self.timeout)
+            self.local.connection = connection
+        return connection
+
+    def _reset(self):
+        connection = getattr(self.local, 'connection', None)
+        if connection is not None:
+            connection.close()
+            self.local.connection = None
+
+    def _post(self, body):
+        '''Function to send one batch of BED lines, retrying on connection errors and non-200 answers
+        Returns:
+            payload (bytes): JSONL records of the batch
+        '''
+        for attempt in range(self.retries + 1):
+            try:
+                connection = self._connection()
+                connection.request('POST', self.path, body=body, headers={'Content-Type': 'text/plain'})
+                response = connection.getresponse()
+                payload = response.read()
+                if response.will_close:
+                    self._reset()
+                if response.status != 200:
+                    raise http.client.HTTPException(f'RegulomeDB query failed with status {response.status}')
+                return payload
+            except (OSError, http.client.HTTPException):
+                self._reset()
+                if attempt == self.retries:
+                    raise
+                with self.lock:
+                    self.retried += 1
+                time.sleep(self.backoff * 2 ** attempt)
+
+    def query_batches(self, positions):
+        '''Function to query positions in batches of batch_size
+        Args:
+            positions (list of (str, int)): chromosome and 1-based position of each variant
+        Yields:
+            payload (bytes): JSONL records of each batch, in batch order
+        '''
+        pending = deque()
+        for start in range(0, len(positions), self.batch_size):
+            batch = positions[start:start + self.batch_size]
+            body = get_bed_lines([chrom for chrom, _ in batch], [end for _, end in batch]).encode()
+            pending.append(self.pool.submit(self._post, body))
+            if len(pending) >= self.max_in_flight:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
+
+    def query(self, chroms, ends):
+        '''Returns: lines (list of str): JSONL records of the positions, as query_regdb'''
+        payloads = self.query_batches(list(zip(chroms, ends)))
+        return [line for payload in payloads for line in payload.decode().splitlines()]
+
+    def close(self):
+        self.pool.shutdown()
+
+def write_query_output(client, positions, out_file):
+    '''Function to query positions and write their JSONL records in the order of the positions, as the query run from gds_dir writes those of a BED file
+    Args:
+        client (RegDBClient): client of the query service
+        positions (list of (str, int)): chromosome and 1-based position of each variant
+        out_file (str): output JSONL file
+    Returns:
+        num_bytes (int): bytes written
+    '''
+    num_bytes = 0
+    with open(out_file, 'wb') as f:
+        for payload in client.query_batches(positions):
+            if payload and not payload.endswith(b'\n'):
+                payload += b'\n'
+            f.write(payload)
+            num_bytes += len(payload)
+    return num_bytes
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Query a RegulomeDB HTTP service for the positions of a BED file, in concurrent batches.")
+    parser.add_argument('--bed', type=str, required=True, help='BED file of the query positions (reg_query_input.bed)')
+    parser.add_argument('--url', type=str, required=True, help='Query endpoint of the RegulomeDB service')
+    parser.add_argument('--out', type=str, required=True, help='Output JSONL file, in the order of the BED file')
+    parser.add_argument('--workers', type=int, default=8, help='Number of concurrent requests')
+    parser.add_argument('--batch_size', type=int, default=500, help='Positions per request')
+    parser.add_argument('--retries', type=int, default=3, help='Retries of a failed request')
+    parser.add_argument('--timeout', type=float, default=300, help='Request timeout in seconds')
+    parser.add_argument('--metrics', type=str, help='Optional path to the stage metrics JSON file')
+    args = parser.parse_args()
+    metrics = StageMetrics('query_variants', args.metrics)
+
+    positions = read_bed_positions(args.bed)
+    metrics.count('variants', len(positions))
+    client = RegDBClient(args.url, args.workers, args.batch_size, retries=args.retries, timeout=args.timeout)
+    with metrics.phase('query'):
+        metrics.count('jsonl_bytes_written', write_query_output(client, positions, args.out))
+    client.close()
+    metrics.count('retries', client.retried)
+    metrics.write()
+    print(f'Queried {len(positions)} positions in {-(-len(positions) // args.batch_size)} batches with {args.workers} workers')
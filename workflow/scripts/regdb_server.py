@@ -0,0 +1,194 @@
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import argparse
+import json
+import os
+import queue
+import random
+import runpy
+import subprocess
+import sys
+import tempfile
+import traceback
+
+class RegDBHandler(BaseHTTPRequestHandler):
+    '''Answers BED lines posted to any path with the JSONL records returned by the server's `query`
+    Connections are kept alive between requests; a fraction `fail_rate` of the requests fail with status 503, and
+    requests whose query fails are answered with status 500 and the error.'''
+
+    protocol_version = 'HTTP/1.1'
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers.get('Content-Length', 0))).decode()
+        if random.random() < self.server.fail_rate:
+            self.send_payload(503, b'', 'text/plain')
+            return
+        try:
+            payload = self.server.query(body)
+        except Exception as e:
+            self.send_payload(500, f'{type(e).__name__}: {e}\n'.encode(), 'text/plain')
+            return
+        self.send_payload(200, payload, 'application/x-ndjson')
+
+    def send_payload(self, status, payload, content_type):
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def log_message(self, format, *args):
+        pass
+
+class QueryServer(ThreadingHTTPServer):
+    '''HTTP server speaking the RegDB query protocol of regdb_client.py over a query function
+
+    Args:
+        address (tuple): host and port to listen on (port 0 picks a free port)
+        query (callable): function taking BED lines (str) and returning their JSONL records (bytes)
+        fail_rate (float): fraction of requests answered with status 503, to exercise client retries
+    '''
+
+    daemon_threads = True
+
+    def __init__(self, address, query, fail_rate=0.0):
+        super().__init__(address, RegDBHandler)
+        self.query = query
+        self.fail_rate = fail_rate
+
+    def server_close(self):
+        super().server_close()
+        if hasattr(self.query, 'close'):
+            self.query.close()
+
+def run_queries(assembly):
+    '''Function to run `utils.regulome_search_TLand --peaks` on one BED file at a time, as `python -m` would from the
+    working directory, for the requests read from stdin: one JSON line with "bed", "out" and "err" file paths each.
+    The module's imports are loaded by the first query and reused by the next ones. Answers one JSON line per request
+    on stdout, with "error" empty if the query succeeded.
+    Args:
+        assembly (str): genome assembly of the positions
+    '''
+    sys.path.insert(0, os.getcwd())
+    answers = os.fdopen(os.dup(1), 'w')
+    for line in sys.stdin:
+        request = json.loads(line)
+        error = ''
+        out_fd = os.open(request['out'], os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+        err_fd = os.open(request['err'], os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+        os.dup2(out_fd, 1)
+        os.dup2(err_fd, 2)
+        try:
+            sys.argv = ['regulome_search_TLand', '-f', request['bed'], '--assembly', assembly, '--peaks']
+            runpy.run_module('utils.regulome_search_TLand', run_name='__main__', alter_sys=True)
+        except SystemExit as e:
+            if e.code:
+                error = f'regulome_search_TLand exited with status {e.code}'
+        except Exception:
+            traceback.print_exc()
+            error = 'regulome_search_TLand failed'
+        finally:
+            sys.stdout.flush()
+            sys.stderr.flush()
+            os.close(out_fd)
+            os.close(err_fd)
+        answers.write(json.dumps({'error': error}) + '\n')
+        answers.flush()
+
+class QueryWorker:
+    '''Persistent process running the queries of one request at a time from the genomic-data-service directory (see
+    run_queries)
+
+    Args:
+        gds_dir (str): genomic-data-service directory
+        assembly (str): genome assembly of the positions
+    '''
+
+    def __init__(self, gds_dir, assembly):
+        code = f'import sys; sys.path.insert(0, {os.path.dirname(os.path.abspath(__file__))!r}); ' \
+               f'from regdb_server import run_queries; run_queries({assembly!r})'
+        self.process = subprocess.Popen([sys.executable, '-c', code], cwd=gds_dir, stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+
+    def alive(self):
+        return self.process.poll() is None
+
+    def query(self, bed):
+        '''Returns: payload (bytes): JSONL records of the BED lines'''
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            request = {name: os.path.join(tmp_dir, name) for name in ['bed', 'out', 'err']}
+            with open(request['bed'], 'w') as f:
+                f.write(bed)
+            try:
+                self.process.stdin.write((json.dumps(request) + '\n').encode())
+                self.process.stdin.flush()
+            except BrokenPipeError:
+                pass
+            answer = self.process.stdout.readline()
+            error = json.loads(answer)['error'] if answer else f'query worker exited with status {self.process.wait()}'
+            if error:
+                with open(request['err'], errors='replace') as f:
+                    raise RuntimeError(f'{error}: {f.read()[-2000:]}')
+            with open(request['out'], 'rb') as f:
+                return f.read()
+
+    def close(self):
+        self.process.stdin.close()
+        self.process.wait()
+
+class RegulomeSearch:
+    '''Query function running `utils.regulome_search_TLand --peaks` from the genomic-data-service directory, as the
+    workflow does without `regdb_url`, on the BED lines of each request. Queries run in persistent worker processes,
+    started on first use and replaced if they exit, so the interpreter starts and the module's imports are paid
+    once per worker rather than once per request.
+
+    Args:
+        gds_dir (str): genomic-data-service directory
+        assembly (str): genome assembly of the positions
+        max_queries (int): worker processes, i.e. queries run at a time; further requests wait for one to finish
+    '''
+
+    def __init__(self, gds_dir, assembly='GRCh38', max_queries=4):
+        self.gds_dir = gds_dir
+        self.assembly = assembly
+        self.workers = queue.LifoQueue()
+        for _ in range(max_queries):
+            self.workers.put(None)
+        self.started = 0
+
+    def __call__(self, bed):
+        worker = self.workers.get()
+        try:
+            if worker is None or not worker.alive():
+                worker = QueryWorker(self.gds_dir, self.assembly)
+                self.started += 1
+            return worker.query(bed)
+        finally:
+            self.workers.put(worker)
+
+    def close(self):
+        '''Function to stop the worker processes, once no query is running'''
+        while not self.workers.empty():
+            worker = self.workers.get()
+            if worker is not None:
+                worker.close()
+
+def make_server(gds_dir, host='127.0.0.1', port=0, max_queries=4, fail_rate=0.0):
+    '''Function to create the RegDB query service of a genomic-data-service directory (port 0 picks a free port)
+    Returns:
+        server (QueryServer): server, not yet serving; its URL is http://{host}:{server.server_port}/
+    '''
+    return QueryServer((host, port), RegulomeSearch(gds_dir, max_queries=max_queries), fail_rate)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Serve RegulomeDB queries of a local genomic-data-service over HTTP, for regdb_url.")
+    parser.add_argument('--gds_dir', type=str, required=True, help='Directory from which utils.regulome_search_TLand must be run')
+    parser.add_argument('--host', type=str, default='127.0.0.1', help='Host to listen on')
+    parser.add_argument('--port', type=int, default=8001, help='Port to listen on')
+    parser.add_argument('--max_queries', type=int, default=4, help='Queries run at a time')
+    args = parser.parse_args()
+
+    server = make_server(args.gds_dir, args.host, args.port, args.max_queries)
+    print(f'Serving RegulomeDB queries from {args.gds_dir} on http://{args.host}:{server.server_port}/')
+    try:
+        server.serve_forever()
+    finally:
+        server.server_close()
@@ -0,0 +1,249 @@
+from pathlib import Path
+import argparse
+import json
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+
+from stage_metrics import StageMetrics
+
+# Files of a RegDB store directory
+VARIANTS_FILE = 'variants.parquet'
+PEAKS_FILE = 'peaks.arrow'
+VOCAB_FILE = 'vocab.json'
+
+# The variants file is sorted by position, in row groups small enough to read position ranges of it cheaply
+VARIANTS_ROW_GROUP_ROWS = 65536
+
+# RegDB generic feature names and the names the models expect for them
+# (Chromatin accessibility renamed to DNASE bc model only recognizes DNASE)
+GENERIC_FEATURES = ['ChIP','Chromatin_accessibility','PWM','Footprint','QTL','PWM_matched','Footprint_matched','IC_matched_max','IC_max']
+GENERIC_COLUMNS = ['CHIP','DNASE','PWM','FOOTPRINT','EQTL_2','PWM_matched','FOOTPRINT_matched','IC_matched_max','IC_max']
+
+HISTONE_LIST = ['H3K27ac','H3K36me3','H3K4me1','H3K4me3','H3K27me3']
+
+# Organ specific count features, in output column order
+COUNT_FEATURES = ['DNASE_organSp', 'FOOTPRINT_organSp', 'CHIP_organSp',
+    'CHIP_organSp_uniq', 'CHIP_organSp_biosample_uniq', 'DNASE_organSp_biosample_uniq',
+    'CTCF_organSp', 'CTCF_organSp_biosample_uniq'] + [f'{histone}_organSp' for histone in HISTONE_LIST]
+
+# One row per (peak, organ slim); string fields are integer codes into the store vocabulary, -1 if missing
+CODED_COLUMNS = ['organ', 'method', 'target', 'biosample', 'target_label']
+PEAKS_SCHEMA = pa.schema([
+    ('var_idx', pa.int32()),
+    ('organ', pa.int16()),
+    ('method', pa.int16()),
+    ('target', pa.int32()),
+    ('biosample', pa.int32()),
+    ('target_label', pa.int16())])
+
+def get_generic_features(input_json):
+    '''Function to output RegDB generic features from a json object
+    Args:
+        input_json(json): a json object contains RegDB features
+    Returns:
+        out(list of str): RegDB features ('chrom','end','CHIP','Chromatin_accessibility','PWM','FOOTPRINT','QTL','PWM_matched','FOOTPRINT_matched')
+    '''
+    out = [input_json['chrom'],input_json['end']]
+    out_features = [int(input_json['features'][feature]) for feature in GENERIC_FEATURES] #convert to binary values
+    out.extend(out_features)
+    return out
+
+class PeakWriter:
+    '''Integer-codes RegDB peaks and appends them to an Arrow IPC file in record batches'''
+
+    def __init__(self, path, batch_rows=1_000_000):
+        self.writer = pa.ipc.new_file(str(path), PEAKS_SCHEMA)
+        self.batch_rows = batch_rows
+        self.vocab = {column: {} for column in CODED_COLUMNS}
+        self.rows = {name: [] for name in PEAKS_SCHEMA.names}
+        self.num_rows = 0
+
+    def code(self, column, value):
+        if value is None:
+            return -1
+        return self.vocab[column].setdefault(value, len(self.vocab[column]))
+
+    def add(self, var_idx, exp):
+        '''Add the rows of one peak; peaks without a method or organ slims can never be counted and are dropped'''
+        try:
+            method = exp['method']
+            organ_slims = exp['organ_slims']
+        except KeyError:
+            return
+        target = None
+        if 'targets' in exp:
+            target = exp['targets'][0] if exp['targets'] else 'NA' #some json have an empty 'targets', and we still count it
+        codes = (self.code('method', method), self.code('target', target),
+                 self.code('biosample', exp.get('biosample_term_name')), self.code('target_label', exp.get('target_label')))
+        for organ in set(organ_slims):
+            self.rows['var_idx'].append(var_idx)
+            self.rows['organ'].append(self.code('organ', organ))
+            for name, code in zip(['method', 'target', 'biosample', 'target_label'], codes):
+                self.rows[name].append(code)
+        if len(self.rows['var_idx']) >= self.batch_rows:
+            self.flush()
+
+    def flush(self):
+        if self.rows['var_idx']:
+            self.num_rows += len(self.rows['var_idx'])
+            self.writer.write_batch(pa.record_batch(
+                [pa.array(self.rows[field.name], type=field.type) for field in PEAKS_SCHEMA], schema=PEAKS_SCHEMA))
+            self.rows = {name: [] for name in PEAKS_SCHEMA.names}
+
+    def close(self):
+        '''Returns: vocab (dict): coded column -> list of values, indexed by code'''
+        self.flush()
+        self.writer.close()
+        return {column: list(values) for column, values in self.vocab.items()}
+
+def write_store(lines, outdir):
+    '''Function to flatten RegDB query output records into a store directory, keeping the first record of each position
+    Args:
+        lines (iterable of str): RegDB query output JSONL lines
+        outdir (Path): store directory
+    Returns:
+        num_variants (int): number of positions in the store
+        num_peak_rows (int): number of rows of the peak table
+    '''
+    outdir.mkdir(parents=True, exist_ok=True)
+    peak_writer = PeakWriter(outdir / PEAKS_FILE)
+    generic_features = []
+    seen = set()
+    for line in lines:
+        if line.strip(): # json.loads isn't happy if it encounters an empty line
+            var_json = json.loads(line.strip())
+            if (var_json['chrom'], var_json['end']) in seen:
+                continue
+            seen.add((var_json['chrom'], var_json['end']))
+            for exp in var_json['peaks']:
+                peak_writer.add(len(generic_features), exp)
+            generic_features.append(get_generic_features(var_json))
+    vocab = peak_writer.close()
+    with open(outdir / VOCAB_FILE, 'w') as f:
+        json.dump(vocab, f)
+    variants = pd.DataFrame(generic_features, columns=['chrom', 'end'] + GENERIC_COLUMNS)
+    variants.insert(0, 'var_idx', np.arange(len(variants), dtype=np.int32))
+    variants.sort_values(['chrom', 'end'], kind='stable').to_parquet(
+        outdir / VARIANTS_FILE, index=False, row_group_size=VARIANTS_ROW_GROUP_ROWS)
+    return len(generic_features), peak_writer.num_rows
+
+def build_store(input_jsonl, outdir):
+    '''Function to flatten a RegDB query output file into a store directory (see write_store)'''
+    with open(input_jsonl) as f:
+        return write_store(f, outdir)
+
+def read_variants(store_dir):
+    '''Returns: variants (pd.DataFrame): 'chrom', 'end' and generic RegDB features, indexed by variant index'''
+    variants = pd.read_parquet(Path(store_dir) / VARIANTS_FILE)
+    if 'var_idx' in variants: # stores written since the variants file is sorted by position
+        variants = variants.sort_values('var_idx').drop(columns='var_idx').reset_index(drop=True)
+    return variants
+
+def read_peaks(store_dir):
+    '''Function to memory-map the peak table of a store
+    The columns of a table written as a single record batch are views of the mapped file. Tables of several record
+    batches (more than PeakWriter.batch_rows rows) are concatenated into one in-memory array per column.
+    Returns:
+        peaks (dict): column -> np.array of integer codes
+        vocab (dict): coded column -> list of values
+    '''
+    source = pa.memory_map(str(Path(store_dir) / PEAKS_FILE)) # stays open for the lifetime of the arrays
+    reader = pa.ipc.open_file(source)
+    batches = [reader.get_batch(i) for i in range(reader.num_record_batches)]
+    peaks = {}
+    for i, field in enumerate(reader.schema):
+        columns = [batch.column(i).to_numpy(zero_copy_only=True) for batch in batches]
+        if len(columns) == 1:
+            peaks[field.name] = columns[0]
+        else:
+            peaks[field.name] = np.concatenate(columns) if columns else np.empty(0, dtype=field.type.to_pandas_dtype())
+    with open(Path(store_dir) / VOCAB_FILE) as f:
+        vocab = json.load(f)
+    return peaks, vocab
+
+def split_peaks_by_organ(peaks, vocab, organs):
+    '''Function to find the peak rows of each organ
+    Args:
+        peaks (dict): peak table from read_peaks
+        vocab (dict): store vocabulary from read_peaks
+        organs (iterable of str): biosample organ names
+    Returns:
+        organ_rows (dict): organ -> np.array of peak row indices (empty for organs without peaks)
+    '''
+    order = np.argsort(peaks['organ'], kind='stable')
+    bounds = np.searchsorted(peaks['organ'][order], np.arange(len(vocab['organ']) + 1))
+    organ_codes = {organ: code for code, organ in enumerate(vocab['organ'])}
+    organ_rows = {}
+    for organ in organs:
+        code = organ_codes.get(organ)
+        organ_rows[organ] = order[bounds[code]:bounds[code + 1]] if code is not None else order[:0]
+    return organ_rows
+
+def get_organ_sp_counts(peaks, vocab, rows, num_variants):
+    '''Function to count RegDB organ specific features from the peak rows of one organ
+    Args:
+        peaks (dict): peak table from read_peaks
+        vocab (dict): store vocabulary from read_peaks
+        rows (np.array): peak row indices of the organ (from split_peaks_by_organ)
+        num_variants (int): number of variants in the store
+    Returns:
+        counts (np.array): (num_variants, len(COUNT_FEATURES)) feature values
+    '''
+    var_idx = peaks['var_idx'][rows]
+    method = peaks['method'][rows]
+    target = peaks['target'][rows]
+    biosample = peaks['biosample'][rows]
+    target_label = peaks['target_label'][rows]
+
+    def code_of(column, value):
+        return vocab[column].index(value) if value in vocab[column] else -2
+
+    def target_startswith(prefix):
+        lookup = np.array([t.startswith(prefix) for t in vocab['target']] + [False]) # code -1 (no 'targets') maps to False
+        return lookup[target]
+
+    def count(mask):
+        return np.bincount(var_idx[mask], minlength=num_variants)
+
+    def count_unique(mask, values, num_values):
+        mask = mask & (values >= 0)
+        keys = np.unique(var_idx[mask].astype(np.int64) * num_values + values[mask])
+        return np.bincount(keys // num_values, minlength=num_variants)
+
+    dnase = method == code_of('method', 'DNase-seq')
+    chip = method == code_of('method', 'ChIP-seq')
+    chip_counted = chip & (target >= 0) & ~target_startswith('POLR') #not counting POLR ChIP-seq
+    ctcf = chip & target_startswith('CTCF')
+    histone = method == code_of('method', 'Histone ChIP-seq')
+    num_targets = max(len(vocab['target']), 1)
+    num_biosamples = max(len(vocab['biosample']), 1)
+
+    counts = [
+        count(dnase),
+        count(method == code_of('method', 'footprints')),
+        count(chip_counted),
+        count_unique(chip_counted, target, num_targets), #unique count TFs in ChIP
+        count_unique(chip_counted, biosample, num_biosamples), #unique count biosamples in ChIP
+        count_unique(dnase, biosample, num_biosamples), #unique count biosamples in DNase
+        count(ctcf),
+        count_unique(ctcf, biosample, num_biosamples)] #unique count biosamples in CTCF
+    counts.extend(count(histone & (target_label == code_of('target_label', h))) for h in HISTONE_LIST)
+    return np.stack(counts, axis=1).astype(np.int64)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Flatten a RegDB query output into an integer-coded columnar store.")
+    parser.add_argument('--input_jsonl', type=str, required=True, help='Path to RegDB features JSONL file')
+    parser.add_argument('--outdir', type=str, required=True, help='Output store directory')
+    parser.add_argument('--metrics', type=str, help='Optional path to the stage metrics JSON file')
+    args = parser.parse_args()
+    metrics = StageMetrics('index_regdb_query', args.metrics)
+
+    with metrics.phase('build_store'):
+        num_variants, num_peak_rows = build_store(args.input_jsonl, Path(args.outdir))
+    print(f'Wrote RegDB store for {num_variants} variants to {args.outdir}')
+    metrics.count('jsonl_bytes_read', Path(args.input_jsonl).stat().st_size)
+    metrics.count('variants', num_variants)
+    metrics.count('rows_written', num_peak_rows)
+    metrics.write()
@@ -0,0 +1,56 @@
+import json
+import math
+
+# Size features the memory of a job is modelled on, besides a constant term
+MEM_FEATURES = ['variants', 'jsonl_mb', 'organs', 'threads']
+
+class ResourceModel:
+    '''Calibrated estimates of the memory and threads of each workflow stage, from the size of its input
+
+    The memory of a stage is a linear function of the number of variants, the size of the RegulomeDB query output
+    (in MB), the number of organs and the number of threads of the job, times a safety margin. Threads are added
+    for every `variants_per_thread` variants, up to the configured maximum of the stage. The coefficients are read
+    from a calibration file refreshed by calibrate_resources.py.
+
+    Args:
+        calibration (dict): content of the calibration file
+    '''
+
+    def __init__(self, calibration):
+        self.calibration = calibration
+        self.stages = calibration['stages']
+
+    @classmethod
+    def load(cls, path):
+        with open(path) as f:
+            return cls(json.load(f))
+
+    def jsonl_mb(self, variants):
+        '''Returns: jsonl_mb (float): expected size of the RegulomeDB query output of `variants` variants'''
+        return variants * self.calibration['jsonl_mb_per_variant']
+
+    def threads(self, stage, variants, max_threads):
+        '''Returns: threads (int): threads of a job of `stage` on `variants` variants'''
+        variants_per_thread = self.stages[stage].get('variants_per_thread')
+        if not variants_per_thread:
+            return max_threads
+        return max(1, min(max_threads, math.ceil(variants / variants_per_thread)))
+
+    def mem_mb(self, stage, variants, jsonl_mb=None, organs=1, threads=1, attempt=1):
+        '''Function to estimate the memory of a job, growing with each retry of a failed job
+        Args:
+            stage (str): stage name, as in the stage metrics
+            variants (int): number of variants of the job
+            jsonl_mb (float): size of the RegulomeDB query output (estimated from `variants` if None)
+            organs (int): number of organs of the job
+            threads (int): threads of the job
+            attempt (int): Snakemake attempt number of the job
+        Returns:
+            mem_mb (int): memory in MB, rounded up to a multiple of 100
+        '''
+        coefficients = self.stages[stage]['mem_mb']
+        size = {'variants': variants, 'jsonl_mb': self.jsonl_mb(variants) if jsonl_mb is None else jsonl_mb,
+                'organs': organs, 'threads': threads}
+        mem_mb = coefficients['intercept'] + sum(coefficients.get(feature, 0) * size[feature] for feature in MEM_FEATURES)
+        mem_mb = max(mem_mb * self.calibration['margin'], self.calibration['min_mem_mb']) * attempt
+        return int(math.ceil(mem_mb / 100) * 100)
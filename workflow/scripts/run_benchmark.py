@@ -0,0 +1,166 @@
+from pathlib import Path
+import argparse
+import json
+import os
+import subprocess
+import sys
+import time
+
+from benchmark_inputs import make_inputs
+
+SCRIPTS_DIR = Path(__file__).resolve().parent
+RESOURCES_DIR = SCRIPTS_DIR.parents[1] / 'resources'
+
+# Stages timed by the benchmark, in the order they run
+STAGES = ['index_regdb_query', 'run_seq_class', 'extract_generic', 'extract_organsp', 'predict']
+
+def get_stage_commands(inputs, workdir, organs, threads):
+    '''Function to build the command line of each stage, as run by the workflow rules
+    Returns:
+        commands (dict): stage -> (command, metrics JSON path)
+    '''
+    work = Path(workdir)
+    metrics = {stage: work / 'metrics' / f'{stage}.json' for stage in STAGES}
+    python = [sys.executable]
+    commands = {
+        'index_regdb_query': python + [
+            str(SCRIPTS_DIR / 'regdb_store.py'),
+            '--input_jsonl', inputs['regdb_jsonl'],
+            '--outdir', str(work / 'regdb_store')],
+        'run_seq_class': python + [
+            str(SCRIPTS_DIR / 'run_seq_class.py'),
+            '-s', inputs['sei_output'], '-i', inputs['vcf'], '-m', inputs['sei_model'],
+            '-o', str(work / 'sei_features.parquet'),
+            '--threads', str(threads)],
+        'extract_generic': python + [
+            str(SCRIPTS_DIR / 'extract_generic_features.py'),
+            '--input_vcf', inputs['vcf'],
+            '--regdb_store', str(work / 'regdb_store'),
+            '--input_sei', str(work / 'sei_features.parquet'),
+            '--dnase_sig_path', inputs['dnase_sig'],
+            '--chip_sig_path', inputs['chip_sig'],
+            '--threads', str(threads),
+            '--out', str(work / 'generic_features.parquet')],
+        'extract_organsp': python + [
+            str(SCRIPTS_DIR / 'extract_organsp_features.py'),
+            '--regdb_store', str(work / 'regdb_store'),
+            '--organs'] + organs + [
+            '--organsp_dnase_sig_path', inputs['organsp_dnase_sig'],
+            '--total_num_path', str(RESOURCES_DIR / 'total_num'),
+            '--organ_mapping_json', str(RESOURCES_DIR / 'organ_list_underscore_mapping.json'),
+            '--threads', str(threads),
+            '--outdir', str(work / 'organsp_features')],
+        'predict': python + [
+            str(SCRIPTS_DIR / 'predict.py'),
+            '--generic_features', str(work / 'generic_features.parquet'),
+            '--input_vcf', inputs['vcf'],
+            '--organsp_dir', str(work / 'organsp_features'),
+            '--organs'] + organs + [
+            '--organ_mapping_json', str(RESOURCES_DIR / 'organ_list_underscore_mapping.json'),
+            '--organ_list', str(RESOURCES_DIR / 'organ_list.txt'),
+            '--models_path', inputs['models'],
+            '--outdir', str(work / 'predictions')]}
+    return {stage: (command + ['--metrics', str(metrics[stage])], metrics[stage]) for stage, command in commands.items()}
+
+def get_inputs(inputs_dir, num_variants, organs, args):
+    '''Function to reuse the synthetic inputs of a scale if they were written with the same settings, or write them'''
+    settings = {'peaks_per_variant': args.peaks_per_variant, 'sei_targets': args.sei_targets,
+                'bigwig_step': args.bigwig_step, 'organs': organs, 'seed': args.seed}
+    settings_path = Path(inputs_dir) / 'settings.json'
+    if settings_path.exists() and (Path(inputs_dir) / 'inputs.json').exists():
+        with open(settings_path) as f:
+            if json.load(f) == settings:
+                with open(Path(inputs_dir) / 'inputs.json') as f:
+                    return json.load(f)
+    with open(RESOURCES_DIR / 'organ_list_underscore_mapping.json') as f:
+        organ_mapping = json.load(f)
+    start = time.time()
+    inputs = make_inputs(inputs_dir, num_variants, organ_mapping, organs, args.peaks_per_variant,
+                         args.sei_targets, args.bigwig_step, args.seed)
+    print(f'Wrote synthetic inputs for {inputs["variants"]} variants in {time.time() - start:.1f} seconds')
+    with open(settings_path, 'w') as f:
+        json.dump(settings, f)
+    return inputs
+
+def run_stage(stage, command, metrics_path, log_path):
+    '''Function to run one stage and read its metrics
+    Returns:
+        result (dict): wall and CPU seconds, peak RSS in MB and counters of the stage
+    '''
+    with open(log_path, 'w') as log:
+        completed = subprocess.run(command, stdout=log, stderr=subprocess.STDOUT, cwd=SCRIPTS_DIR.parents[1])
+    if completed.returncode != 0:
+        raise RuntimeError(f'{stage} failed with exit code {completed.returncode}, see {log_path}')
+    with open(metrics_path) as f:
+        record = json.load(f)
+    return {'wall_s': record['wall_s'], 'cpu_s': record['cpu_s'],
+            'peak_rss_mb': max(record['peak_rss_mb'], record.get('children_peak_rss_mb', 0)),
+            'phases': record['phases'], 'counters': record['counters']}
+
+def compare(results, baseline, tolerance):
+    '''Function to find stages slower than in a baseline benchmark
+    Returns:
+        regressions (list of str): description of each stage and scale whose wall time grew by more than `tolerance`
+    '''
+    regressions = []
+    for scale, stages in results.items():
+        for stage, result in stages.items():
+            previous = baseline.get(scale, {}).get(stage)
+            if previous and result['wall_s'] > previous['wall_s'] * (1 + tolerance):
+                regressions.append(f'{stage} at {scale} variants: {previous["wall_s"]:.2f} s -> {result["wall_s"]:.2f} s')
+    return regressions
+
+def format_results(results):
+    '''Returns: table (str): wall time, throughput and peak memory of each stage and scale'''
+    lines = ['{:>10}  {:<20}{:>10}{:>10}{:>16}{:>14}'.format('variants', 'stage', 'wall (s)', 'CPU (s)', 'variants / s', 'peak RSS (MB)')]
+    for scale, stages in results.items():
+        for stage, result in stages.items():
+            lines.append('{:>10}  {:<20}{:>10.2f}{:>10.2f}{:>16.0f}{:>14.0f}'.format(
+                scale, stage, result['wall_s'], result['cpu_s'], result['variants_per_s'], result['peak_rss_mb']))
+    return '\n'.join(lines)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Time the feature and prediction scripts on synthetic inputs at several scales.")
+    parser.add_argument('--workdir', type=str, required=True, help='Directory for the synthetic inputs and stage outputs')
+    parser.add_argument('--scales', type=int, nargs='+', default=[10000, 100000, 1000000], help='Numbers of variants to benchmark')
+    parser.add_argument('--stages', type=str, nargs='+', default=STAGES, choices=STAGES, help='Stages to time (all by default; earlier stages still run to produce their inputs)')
+    parser.add_argument('--organs', type=str, nargs='+', default=['brain', 'heart'], help='Organ names (with underscores) to extract features and predict for')
+    parser.add_argument('--threads', type=int, default=4, help='Threads of the stages that take --threads')
+    parser.add_argument('--peaks_per_variant', type=float, default=20, help='Mean number of RegDB peaks per variant position')
+    parser.add_argument('--sei_targets', type=int, default=1000, help='Number of chromatin profiles of the synthetic Sei predictions')
+    parser.add_argument('--bigwig_step', type=int, default=1000, help='Resolution of the synthetic bigWig signals, in bp')
+    parser.add_argument('--seed', type=int, default=0, help='Random seed of the synthetic inputs')
+    parser.add_argument('--out', type=str, help='Output benchmark results JSON path (default: workdir/benchmark.json)')
+    parser.add_argument('--baseline', type=str, help='Benchmark results JSON of an earlier version to compare against')
+    parser.add_argument('--tolerance', type=float, default=0.2, help='Largest allowed relative increase in wall time over the baseline')
+    args = parser.parse_args()
+
+    results = {}
+    for num_variants in args.scales:
+        scale_dir = Path(args.workdir) / str(num_variants)
+        inputs = get_inputs(scale_dir / 'inputs', num_variants, args.organs, args)
+        work = scale_dir / 'work'
+        (work / 'logs').mkdir(parents=True, exist_ok=True)
+        results[str(num_variants)] = {}
+        last_stage = max(STAGES.index(stage) for stage in args.stages)
+        for stage in STAGES[:last_stage + 1]:
+            command, metrics_path = get_stage_commands(inputs, work, args.organs, args.threads)[stage]
+            print(f'Running {stage} on {inputs["variants"]} variants...')
+            result = run_stage(stage, command, metrics_path, work / 'logs' / f'{stage}.log')
+            if stage in args.stages:
+                result['variants_per_s'] = inputs['variants'] / result['wall_s'] if result['wall_s'] else 0.0
+                results[str(num_variants)][stage] = result
+
+    print(format_results(results))
+    out = args.out or os.path.join(args.workdir, 'benchmark.json')
+    with open(out, 'w') as f:
+        json.dump(results, f, indent=2)
+    print(f'Wrote benchmark results to {out}')
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            regressions = compare(results, json.load(f), args.tolerance)
+        for regression in regressions:
+            print(f'Regression: {regression}')
+        if regressions:
+            sys.exit(1)
@@ -0,0 +1,94 @@
+import argparse
+import ast
+import importlib
+import json
+import os
+import runpy
+import sys
+import time
+import traceback
+
+def preload_modules(scripts):
+    '''Function to import the modules the scripts import at their top level, so that every job forked from this
+    process finds them loaded (modules that fail to import are left to the jobs to report)
+    Args:
+        scripts (iterable of str): paths to the scripts
+    '''
+    for script in sorted(set(scripts)):
+        with open(script) as f:
+            tree = ast.parse(f.read())
+        for node in tree.body:
+            if isinstance(node, ast.Import):
+                names = [alias.name for alias in node.names]
+            elif isinstance(node, ast.ImportFrom) and not node.level:
+                names = [node.module]
+            else:
+                continue
+            for name in names:
+                try:
+                    importlib.import_module(name)
+                except Exception:
+                    pass
+
+def exit_code(status):
+    '''Returns: code (int): exit code of a child process from its wait status, 128 + signal number if it was killed'''
+    if os.WIFSIGNALED(status):
+        return 128 + os.WTERMSIG(status)
+    return os.WEXITSTATUS(status)
+
+def run_job(script, args, log):
+    '''Function to run a workflow script as its command line would, in a child process forked from this one
+    The child starts with the modules of this process loaded, so only the script itself is executed again, while its
+    CPU time, peak memory and worker processes are its own, as recorded by its stage metrics. Output is redirected at
+    the file descriptor level, so that the output of the script's worker processes goes to its log too.
+    Args:
+        script (str): path to the script
+        args (list of str): command line arguments of the script
+        log (str): log file of the job
+    Returns:
+        code (int): exit code of the job
+    '''
+    sys.stdout.flush()
+    sys.stderr.flush()
+    pid = os.fork()
+    if pid:
+        return exit_code(os.waitpid(pid, 0)[1])
+
+    code = 1
+    try:
+        fd = os.open(log, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+        os.dup2(fd, 1)
+        os.dup2(fd, 2)
+        os.close(fd)
+        sys.argv = [script] + args
+        runpy.run_path(script, run_name='__main__')
+        code = 0
+    except SystemExit as e:
+        if isinstance(e.code, int) or e.code is None:
+            code = e.code or 0
+        else:
+            print(e.code, file=sys.stderr)
+    except BaseException:
+        traceback.print_exc()
+    finally:
+        sys.stdout.flush()
+        sys.stderr.flush()
+        os._exit(code)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Run a bundle of workflow script jobs one after the other, paying interpreter startup and imports once.")
+    parser.add_argument('--jobs', type=str, required=True, help='JSON list of jobs, each with "script", "args" (list of command line arguments) and "log"')
+    args = parser.parse_args()
+
+    jobs = json.loads(args.jobs)
+    start = time.time()
+    preload_modules(job['script'] for job in jobs)
+    print(f'Imported the modules of {len(jobs)} jobs in {time.time() - start:.2f} seconds', flush=True)
+    for i, job in enumerate(jobs):
+        print(f"Running job {i + 1} of {len(jobs)}: {job['script']} (log: {job['log']})", flush=True)
+        start = time.time()
+        code = run_job(job['script'], job['args'], job['log'])
+        if code:
+            print(f"Job {i + 1} failed with exit code {code}, see {job['log']}", flush=True)
+            sys.exit(code)
+        print(f'Finished in {time.time() - start:.2f} seconds', flush=True)
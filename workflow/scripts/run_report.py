@@ -0,0 +1,90 @@
+import argparse
+import json
+import os
+
+# Stages in pipeline order; stages not listed here are reported after them
+STAGE_ORDER = ['query_variants', 'index_regdb_query', 'run_seq_class', 'extract_generic', 'extract_organsp', 'predict']
+
+def read_metrics(metrics_files):
+    '''Function to read the stage metrics JSON files of a run's jobs
+    Files of jobs that did not run (e.g. stages served by the variant cache) are skipped.
+    Args:
+        metrics_files (list of str): metrics files written by the jobs of the run, {unit}/metrics/{stage}.json
+    Returns:
+        records (list of dict): one record per job, with the directory of the unit it belongs to
+    '''
+    records = []
+    for path in metrics_files:
+        if not os.path.exists(path):
+            continue
+        with open(path) as f:
+            record = json.load(f)
+        record['unit_dir'] = os.path.dirname(os.path.dirname(os.path.normpath(path)))
+        records.append(record)
+    return records
+
+def add_phase(total, phase):
+    for key, value in phase.items():
+        if key == 'peak_rss_mb':
+            total[key] = max(total.get(key, 0), value)
+        else:
+            total[key] = total.get(key, 0) + value
+
+def summarize_stages(records):
+    '''Function to combine the records of each stage over its jobs (shards and batches of organs)
+    Times, bytes and counters are summed; peak RSS is the largest of any job.
+    Returns:
+        stages (dict): stage name -> summary
+    '''
+    stages = {}
+    for record in records:
+        stage = stages.setdefault(record['stage'], {'jobs': 0, 'wall_s': 0.0, 'cpu_s': 0.0, 'max_job_wall_s': 0.0,
+                                                    'peak_rss_mb': 0.0, 'phases': {}, 'counters': {}})
+        stage['jobs'] += 1
+        stage['wall_s'] += record['wall_s']
+        stage['cpu_s'] += record['cpu_s']
+        stage['max_job_wall_s'] = max(stage['max_job_wall_s'], record['wall_s'])
+        stage['peak_rss_mb'] = max(stage['peak_rss_mb'], record['peak_rss_mb'], record.get('children_peak_rss_mb', 0))
+        for name, phase in record['phases'].items():
+            add_phase(stage['phases'].setdefault(name, {}), phase)
+        for name, value in record['counters'].items():
+            stage['counters'][name] = stage['counters'].get(name, 0) + value
+    order = {stage: i for i, stage in enumerate(STAGE_ORDER)}
+    return dict(sorted(stages.items(), key=lambda item: (order.get(item[0], len(order)), item[0])))
+
+def format_report(run, stages):
+    '''Returns: table (str): one line per stage and phase, for the log'''
+    total_wall = sum(stage['wall_s'] for stage in stages.values()) or 1.0
+    lines = [f'Run {run}', '{:<32}{:>6}{:>12}{:>12}{:>8}{:>14}'.format('stage / phase', 'jobs', 'wall (s)', 'CPU (s)', 'wall %', 'peak RSS (MB)')]
+    for name, stage in stages.items():
+        lines.append('{:<32}{:>6}{:>12.1f}{:>12.1f}{:>8.1f}{:>14.0f}'.format(
+            name, stage['jobs'], stage['wall_s'], stage['cpu_s'], 100 * stage['wall_s'] / total_wall, stage['peak_rss_mb']))
+        for phase_name, phase in stage['phases'].items():
+            lines.append('{:<32}{:>6}{:>12.1f}{:>12.1f}{:>8.1f}{:>14.0f}'.format(
+                '  ' + phase_name, phase['calls'], phase['wall_s'], phase['cpu_s'], 100 * phase['wall_s'] / total_wall, phase['peak_rss_mb']))
+        for counter, value in stage['counters'].items():
+            lines.append(f'    {counter}: {value}')
+    return '\n'.join(lines)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Combine the stage metrics of a run into a run report')
+    parser.add_argument('--run', type=str, required=True, help='Run name')
+    parser.add_argument('--metrics_files', type=str, nargs='+', required=True, help='Metrics files of the run\'s jobs, from the job layout of the workflow (missing files are skipped)')
+    parser.add_argument('--out', type=str, required=True, help='Output run report JSON path')
+    args = parser.parse_args()
+
+    records = read_metrics(args.metrics_files)
+    stages = summarize_stages(records)
+    report = {
+        'run': args.run,
+        'unit_dirs': sorted({record['unit_dir'] for record in records}),
+        'jobs': len(records),
+        'wall_s': sum(stage['wall_s'] for stage in stages.values()),
+        'cpu_s': sum(stage['cpu_s'] for stage in stages.values()),
+        'peak_rss_mb': max((stage['peak_rss_mb'] for stage in stages.values()), default=0.0),
+        'stages': stages}
+    print(format_report(args.run, stages))
+
+    os.makedirs(os.path.dirname(os.path.abspath(args.out)), exist_ok=True)
+    with open(args.out, 'w') as f:
+        json.dump(report, f, indent=2)
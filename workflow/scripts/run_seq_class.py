@@ -1,8 +1,25 @@
 import os
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import nullcontext
 import h5py
 import numpy as np
 import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
 import argparse
+from threadpoolctl import threadpool_limits
+
+from chunk_checkpoint import ChunkCheckpoint, get_fingerprint
+from stage_metrics import StageMetrics
+
+# Sei predictions are projected onto the first NUM_SEQCLASSES sequence classes only
+NUM_SEQCLASSES = 40
+
+# Rows per Parquet row group of the output, which is sorted by position so that position ranges can be read cheaply
+ROW_GROUP_ROWS = 65536
+
+LABEL_COLUMNS = ['chrom', 'pos', 'id', 'ref', 'alt', 'strand', 'ref_match', 'contains_unk']
 
 def get_targets(filename):
     targets = []
@@ -12,85 +29,147 @@ def get_targets(filename):
     return targets
 
 
-def get_data(filename):
-    fh = h5py.File(filename, 'r')
-    data = fh["data"][()]
-    fh.close()
-    return data
-
-
 def read_rowlabels_file(rowlabels, use_strand=False):
-    labels = []
-    with open(rowlabels, 'r') as file_handle:
-        for line in file_handle:
-            if 'contains_unk' in line:
-                continue
-            cols = line.strip().split('\t')
-            chrom, pos, id, ref, alt, strand, ref_match, contains_unk = cols
-            if not use_strand:
-                strand = '.'
-            labels.append(
-                (chrom, pos, id, ref, alt, strand,
-                 ref_match, contains_unk))
-    return labels
-
-
-def write_to_tsv(max_abs_diff,
-#                  chromatin_profile_diffs,
-                 sequence_class_projscores,
-                 chromatin_profiles,
-                 seqclass_names,
-                 rowlabels,
-                 output_chromatin_profile_file,
-                 output_sequence_class_file):
-    sorted_sc_abs_diff = np.sort(max_abs_diff)[::-1]
-    sorted_ixs = np.argsort(max_abs_diff)[::-1]
-
-    assert len(sorted_ixs) == sequence_class_projscores.shape[0]
-#     assert len(sorted_ixs) == chromatin_profile_diffs.shape[0]
-    rowlabels = np.array(rowlabels)[sorted_ixs]
-#     chromatin_profile_diffs = chromatin_profile_diffs[sorted_ixs, :]
-    sequence_class_projscores = sequence_class_projscores[sorted_ixs,:]
-#     chromatin_profile_rows = []
-    sequence_class_rows = []
-    for ix, r in enumerate(rowlabels):
-        ref_match = r[-2]
-        contains_unk = r[-1]
-        label = r[:-2]
-#         chromatin_profile_row = np.hstack(
-#             [[sorted_sc_abs_diff[ix], ref_match, contains_unk],
-#              label,
-#              chromatin_profile_diffs[ix, :]]).tolist()
-        sequence_class_row = np.hstack(
-            [[sorted_sc_abs_diff[ix], ref_match, contains_unk],
-             label,
-             sequence_class_projscores[ix, :]]).tolist()
-#         chromatin_profile_rows.append(chromatin_profile_row)
-        sequence_class_rows.append(sequence_class_row)
-
-#     del chromatin_profile_diffs
-    colnames = [
-        'seqclass_max_absdiff', 'ref_match', 'contains_unk',
-        'chrom', 'pos', 'id', 'ref', 'alt', 'strand']
-
-    sc_df = pd.DataFrame(
-        sequence_class_rows, columns=colnames + seqclass_names)
-    check_columns = sc_df.columns.tolist()
-    check_columns.remove('strand')
-    sc_df.drop_duplicates(subset=check_columns, inplace=True)
-    sc_df.to_csv(output_sequence_class_file, sep='\t', index=False)
-
-#    cp_df = pd.DataFrame(
-#        chromatin_profile_rows, columns=colnames + chromatin_profiles)
-#    check_columns = cp_df.columns.tolist()
-#    check_columns.remove('strand')
-#    cp_df.drop_duplicates(subset=check_columns, inplace=True)
-#    if len(cp_df) > 10000:
-#        cp_df.to_csv(
-#            output_chromatin_profile_file, sep='\t', index=False, compression='gzip')
-#    else:
-#        cp_df.to_csv(
-#            output_chromatin_profile_file, sep='\t', index=False)
+    '''Function to read the row labels of the Sei predictions, one row per HDF5 row
+    Returns:
+        labels (pd.DataFrame): LABEL_COLUMNS of each variant
+    '''
+    labels = pd.read_csv(rowlabels, sep='\t', header=None, names=LABEL_COLUMNS, dtype=str, keep_default_na=False)
+    labels = labels[labels['contains_unk'] != 'contains_unk'] # header line
+    labels['pos'] = labels['pos'].astype(np.int64)
+    labels['ref_match'] = labels['ref_match'] == 'True'
+    labels['contains_unk'] = labels['contains_unk'] == 'True'
+    if not use_strand:
+        labels['strand'] = '.'
+    return labels.reset_index(drop=True)
+
+
+def get_projection(clustervfeat, num_seqclasses=NUM_SEQCLASSES):
+    '''Function to precompute the normalized sequence class projection
+    Returns:
+        projection (np.array): (num_targets, num_seqclasses) float32 matrix, so that profiles @ projection are the projection scores
+    '''
+    clustervfeat = clustervfeat[:num_seqclasses]
+    return (clustervfeat / np.linalg.norm(clustervfeat, axis=1)[:, None]).T.astype(np.float32)
+
+
+def get_chunk_rows(num_targets, chunk_bytes):
+    '''Returns: chunk_rows (int): number of variants whose float32 reference and alternative rows fit in chunk_bytes'''
+    return max(1, chunk_bytes // (2 * num_targets * np.dtype(np.float32).itemsize))
+
+
+def read_chunk(dset, start, stop, buffer):
+    '''Function to read rows of a prediction dataset straight into a preallocated float32 buffer, converting from the
+    stored data type on the way
+    Returns:
+        rows (np.array): view of the leading stop - start rows of the buffer
+    '''
+    dset.read_direct(buffer, np.s_[start:stop], np.s_[0:stop - start])
+    return buffer[:stop - start]
+
+
+def get_proj(chromatin_profile_ref, chromatin_profile_alt, histone_inds, projection, diffproj, max_abs_diff):
+    '''Function to compute the sequence class score differences of a chunk (the alt chunk array is overwritten)
+    The histone targets of each profile are rescaled so that ref and alt have the same total histone signal. Only
+    those columns change, so rather than rescaling the profiles, the projection of the rescaled difference is computed
+    as the projection of the unscaled difference plus a correction from the histone columns alone:
+        (alt' - ref') @ P = (alt - ref) @ P + ((s_alt - 1) * alt_h - (s_ref - 1) * ref_h) @ P_h
+    with s the per-variant histone scale, alt_h and ref_h the histone columns and P_h the histone rows of P.
+    Args:
+        diffproj (np.array): output rows of the chunk for the alt - ref projection scores
+        max_abs_diff (np.array): output rows of the chunk for the largest absolute score difference of each variant
+    '''
+    ref_histone_cols = chromatin_profile_ref[:, histone_inds]
+    alt_histone_cols = chromatin_profile_alt[:, histone_inds]
+    ref_histone = ref_histone_cols.sum(axis=1)
+    alt_histone = alt_histone_cols.sum(axis=1)
+    mean_histone = ref_histone*0.5 + alt_histone*0.5
+    alt_histone_cols *= (mean_histone / alt_histone - 1)[:, None]
+    ref_histone_cols *= (mean_histone / ref_histone - 1)[:, None]
+    histone_correction = np.subtract(alt_histone_cols, ref_histone_cols, out=alt_histone_cols)
+
+    # alt projection - ref projection, with a single dense product
+    np.subtract(chromatin_profile_alt, chromatin_profile_ref, out=chromatin_profile_alt)
+    np.dot(chromatin_profile_alt, projection, out=diffproj)
+    diffproj += histone_correction @ projection[histone_inds]
+    np.abs(diffproj).max(axis=1, out=max_abs_diff)
+
+
+def project_chunk(start, chromatin_profile_ref, chromatin_profile_alt, histone_inds, projection, diffproj, max_abs_diff, checkpoint=None):
+    '''Function to project a chunk with get_proj, then save its scores to the checkpoint'''
+    get_proj(chromatin_profile_ref, chromatin_profile_alt, histone_inds, projection, diffproj, max_abs_diff)
+    if checkpoint is not None:
+        checkpoint.save_arrays(start, diffproj=diffproj, max_abs_diff=max_abs_diff)
+
+
+def project_chunks(ref_dset, alt_dset, histone_inds, projection, chunk_bytes, threads=1, checkpoint=None):
+    '''Function to project every chunk of the predictions, reading the next chunk while earlier ones are projected
+    Chunks are read into threads + 1 pairs of preallocated reference and alternative buffers, reused as soon as the
+    chunk they hold is projected, so about (threads + 1) * chunk_bytes of predictions are held in memory. At most
+    `threads` chunks are projected at once, each by a worker thread with a single-threaded BLAS.
+    Args:
+        ref_dset, alt_dset (h5py.Dataset): (num_variants, num_targets) predictions, kept open by the caller
+        histone_inds (np.array): indices of the histone targets
+        projection (np.array): normalized projection from get_projection
+        chunk_bytes (int): approximate memory used by the reference and alternative rows of a chunk
+        threads (int): number of chunks projected in parallel
+        checkpoint (ChunkCheckpoint): optional checkpoint; chunks it holds are loaded instead of projected, and
+            every projected chunk is saved to it
+    Returns:
+        diffproj (np.array): (num_variants, num_seqclasses) alt - ref projection scores
+        max_abs_diff (np.array): largest absolute score difference of each variant
+    '''
+    num_variants, num_targets = ref_dset.shape
+    diffproj = np.empty((num_variants, projection.shape[1]), dtype=np.float32)
+    max_abs_diff = np.empty(num_variants, dtype=np.float32)
+    if checkpoint is not None:
+        for start in checkpoint.chunks:
+            arrays = checkpoint.load_arrays(start)
+            start = int(start)
+            diffproj[start:start + len(arrays['diffproj'])] = arrays['diffproj']
+            max_abs_diff[start:start + len(arrays['diffproj'])] = arrays['max_abs_diff']
+    chunk_rows = get_chunk_rows(num_targets, chunk_bytes)
+    starts = [start for start in range(0, num_variants, chunk_rows) if checkpoint is None or not checkpoint.done(start)]
+    buffer_rows = min(chunk_rows, num_variants)
+    free = deque((np.empty((buffer_rows, num_targets), dtype=np.float32), np.empty((buffer_rows, num_targets), dtype=np.float32))
+                 for _ in range(min(threads + 1, len(starts))))
+    with ThreadPoolExecutor(max_workers=threads) as pool, threadpool_limits(1) if threads > 1 else nullcontext():
+        pending = deque()
+        for start in starts:
+            if not free:
+                future, buffers = pending.popleft()
+                future.result()
+                free.append(buffers)
+            ref_buffer, alt_buffer = free.popleft()
+            stop = min(start + chunk_rows, num_variants)
+            print(f'Projecting variants {start} to {stop} of {num_variants}')
+            chromatin_profile_ref = read_chunk(ref_dset, start, stop, ref_buffer)
+            chromatin_profile_alt = read_chunk(alt_dset, start, stop, alt_buffer)
+            future = pool.submit(project_chunk, start, chromatin_profile_ref, chromatin_profile_alt, histone_inds,
+                                 projection, diffproj[start:stop], max_abs_diff[start:stop], checkpoint)
+            pending.append((future, (ref_buffer, alt_buffer)))
+        for future, _ in pending:
+            future.result()
+    return diffproj, max_abs_diff
+
+
+def get_schema(seqclass_names):
+    return pa.schema(
+        [('seqclass_max_absdiff', pa.float32()), ('ref_match', pa.bool_()), ('contains_unk', pa.bool_()),
+         ('chrom', pa.string()), ('pos', pa.int64()), ('id', pa.string()), ('ref', pa.string()),
+         ('alt', pa.string()), ('strand', pa.string())]
+        + [(name, pa.float32()) for name in seqclass_names])
+
+
+def write_chunk(writer, labels, diffproj, max_abs_diff, seqclass_names):
+    '''Function to append the sequence class scores of a chunk to the output as a row group'''
+    columns = {'seqclass_max_absdiff': max_abs_diff}
+    for column in ['ref_match', 'contains_unk', 'chrom', 'pos', 'id', 'ref', 'alt', 'strand']:
+        columns[column] = labels[column].to_numpy()
+    for i, name in enumerate(seqclass_names):
+        columns[name] = diffproj[:, i]
+    writer.write_table(pa.Table.from_pydict(columns, schema=writer.schema))
+
 
 if __name__ == '__main__':
 
@@ -98,8 +177,13 @@ if __name__ == '__main__':
     parser.add_argument("-s", help="Sei output directory", type=str)
     parser.add_argument("-i", help="Input vcf path", type=str)
     parser.add_argument("-m", help="Sei model dir", type=str)
-    parser.add_argument("-o", help="Output file path", type=str)
+    parser.add_argument("-o", help="Output Parquet file path", type=str)
+    parser.add_argument("--chunk_mb", help="Approximate memory used by the predictions read per chunk, in MB", type=int, default=1024)
+    parser.add_argument("--threads", help="Number of chunks projected in parallel", type=int, default=1)
+    parser.add_argument("--checkpoint_dir", help="Optional directory for the projected chunks, so that a failed run resumes from its last finished chunk", type=str)
+    parser.add_argument("--metrics", help="Optional path to the stage metrics JSON file", type=str)
     args = parser.parse_args()
+    metrics = StageMetrics('run_seq_class', args.metrics)
 
     input_vcf = args.i
     output_file = args.o
@@ -109,75 +193,44 @@ if __name__ == '__main__':
     _, filename = os.path.split(input_vcf)
     filename_prefix = '.'.join(filename.split('.')[:-1])
 
-    chromatin_profiles = get_targets(os.path.join(sei_dir, "target.names"))
-    seqclass_names = get_targets(os.path.join(sei_dir, "seqclass.names"))
+    seqclass_names = get_targets(os.path.join(sei_dir, "seqclass.names"))[:NUM_SEQCLASSES]
 
     profile_pred_dir = os.path.join(results_dir, 'chromatin-profiles-hdf5')
     rowlabels_filename = "{0}_row_labels.txt".format(filename_prefix)
     chromatin_profile_rowlabels = os.path.join(profile_pred_dir, rowlabels_filename)
 
-    clustervfeat = np.load(os.path.join(sei_dir, 'projvec_targets.npy'))
+    # only the rows of the kept sequence classes are read from the projection vectors
+    projection = get_projection(np.load(os.path.join(sei_dir, 'projvec_targets.npy'), mmap_mode='r'))
     histone_inds = np.load(os.path.join(sei_dir, 'histone_inds.npy'))
 
-
-    num_snp = len(read_rowlabels_file(chromatin_profile_rowlabels, use_strand=False))
-
-    # (2097711, 21907) and data type float64
-    def get_data_chunk(filename, i, chunk_size=int(num_snp/100)):
-        fh = h5py.File(filename, 'r')
-        if i < 99:
-            data = fh["data"][chunk_size*i:chunk_size*(i+1), :]
-        else:
-            data = fh["data"][chunk_size*i:, :]
-        fh.close()
-        return data
-
-
-    def get_proj(chromatin_profile_ref, chromatin_profile_alt, histone_inds, clustervfeat):
-        chromatin_profile_ref_adjust = chromatin_profile_ref.copy()
-        chromatin_profile_ref_adjust[:, histone_inds] = \
-            chromatin_profile_ref_adjust[:, histone_inds] * (
-            (np.sum(chromatin_profile_ref[:, histone_inds], axis=1)*0.5 +
-            np.sum(chromatin_profile_alt[:, histone_inds], axis=1)*0.5) /
-            np.sum(chromatin_profile_ref[:, histone_inds], axis=1))[:, None]
-
-        chromatin_profile_alt_adjust = chromatin_profile_alt.copy()
-        chromatin_profile_alt_adjust[:, histone_inds] = \
-            chromatin_profile_alt_adjust[:, histone_inds] * (
-            (np.sum(chromatin_profile_ref[:, histone_inds], axis=1)*0.5 +
-            np.sum(chromatin_profile_alt[:, histone_inds], axis=1)*0.5) /
-            np.sum(chromatin_profile_alt[:, histone_inds], axis=1))[:, None]
-
-        refproj = (np.dot(chromatin_profile_ref_adjust,clustervfeat.T) /
-                np.linalg.norm(clustervfeat,axis=1))
-        altproj = (np.dot(chromatin_profile_alt_adjust,clustervfeat.T) /
-                np.linalg.norm(clustervfeat,axis=1))
-        diffproj = altproj[:,:40] - refproj[:,:40]
-
-        max_abs_diff = np.abs(diffproj).max(axis=1)
-        
-        return diffproj, max_abs_diff
-
-    max_abs_diff_ls = []
-    diffproj_ls = []
-
-    for i in range(100):
-        print(i)
-        chromatin_profile_ref = get_data_chunk(os.path.join(profile_pred_dir,"{0}.ref_predictions.h5".format(filename_prefix)), i=i)
-        chromatin_profile_alt = get_data_chunk(os.path.join(profile_pred_dir,"{0}.alt_predictions.h5".format(filename_prefix)), i=i)
-        
-        diffproj, max_abs_diff = get_proj(chromatin_profile_ref=chromatin_profile_ref, chromatin_profile_alt=chromatin_profile_alt, 
-                                    histone_inds=histone_inds, clustervfeat=clustervfeat)
-        diffproj_ls.append(diffproj)
-        max_abs_diff_ls.append(max_abs_diff)
-
-    diffproj = np.concatenate(diffproj_ls)
-    max_abs_diff = np.concatenate(max_abs_diff_ls)
-
-    write_to_tsv(max_abs_diff,  # max sequence class score
-                diffproj,  # sequence class diffs
-                chromatin_profiles,  # chromatin profile targets
-                seqclass_names,  # sequence class names
-                read_rowlabels_file(chromatin_profile_rowlabels, use_strand=False),
-                os.path.join(results_dir, "chromatin_profile_diffs.tsv"),
-                output_file)
+    with metrics.phase('read_labels'):
+        labels = read_rowlabels_file(chromatin_profile_rowlabels, use_strand=False)
+        # Identical variants have identical predictions, so only their first row is kept
+        keep = ~labels.duplicated().to_numpy()
+    metrics.count('variants', len(labels))
+
+    # (2097711, 21907) and data type float64, read as float32 chunks
+    ref_path = os.path.join(profile_pred_dir, "{0}.ref_predictions.h5".format(filename_prefix))
+    alt_path = os.path.join(profile_pred_dir, "{0}.alt_predictions.h5".format(filename_prefix))
+    with h5py.File(ref_path, 'r') as ref_fh, h5py.File(alt_path, 'r') as alt_fh, metrics.phase('project'):
+        assert ref_fh["data"].shape[0] == len(labels)
+        checkpoint = None
+        if args.checkpoint_dir:
+            chunk_rows = get_chunk_rows(ref_fh["data"].shape[1], args.chunk_mb * 1024**2)
+            fingerprint = get_fingerprint([ref_path, alt_path, chromatin_profile_rowlabels, os.path.join(sei_dir, 'projvec_targets.npy'),
+                                           os.path.join(sei_dir, 'histone_inds.npy')], chunk_rows=chunk_rows)
+            checkpoint = ChunkCheckpoint(args.checkpoint_dir, fingerprint)
+            metrics.count('resumed_chunks', checkpoint.resumed)
+        diffproj, max_abs_diff = project_chunks(ref_fh["data"], alt_fh["data"], histone_inds, projection,
+                                                args.chunk_mb * 1024**2, args.threads, checkpoint)
+        metrics.count('hdf5_bytes_read', 2 * ref_fh["data"].size * ref_fh["data"].dtype.itemsize)
+
+    with pq.ParquetWriter(output_file, get_schema(seqclass_names)) as writer, metrics.phase('write'):
+        rows = labels[keep].sort_values(['chrom', 'pos'], kind='stable').index.to_numpy()
+        for start in range(0, len(rows), ROW_GROUP_ROWS):
+            chunk_rows = rows[start:start + ROW_GROUP_ROWS]
+            write_chunk(writer, labels.iloc[chunk_rows], diffproj[chunk_rows], max_abs_diff[chunk_rows], seqclass_names)
+    metrics.count('rows_written', len(rows))
+    if checkpoint is not None:
+        checkpoint.remove()
+    metrics.write()
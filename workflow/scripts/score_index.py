@@ -0,0 +1,160 @@
+from pathlib import Path
+import argparse
+import json
+import os
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.dataset as ds
+import pyarrow.parquet as pq
+
+from feature_schema import KEY_COLUMN, VARIANT_JOIN_KEY, chrom_code, with_position_key
+
+# A score index directory holds one Parquet file per chromosome, sorted by (position key, ref, alt) in row groups
+# of chunk_rows variants, and an index file with the position key range of every row group
+INDEX_FILE = 'index.json'
+CHUNK_ROWS = 65536
+
+def chrom_file(chrom):
+    return f'scores.{chrom}.parquet'
+
+def write_score_index(score_files, outdir, score_version=None, chunk_rows=CHUNK_ROWS):
+    '''Function to build a score index from wide Parquet score files (see predict.py --out_format parquet)
+    Chromosomes are written one at a time, so memory is bounded by the scores of the largest chromosome. Names of
+    the same chromosome (e.g. 'chr1' and '1') share one file, named after the first of them. Variants scored in
+    several files keep the scores of the last file.
+    Args:
+        score_files (list of str): wide Parquet score files, all with the same organ columns
+        outdir (Path): output directory
+        score_version (str): version of the resources and models the scores were computed with
+        chunk_rows (int): variants per row group, the unit read by lookups
+    Returns:
+        index (dict): content of the index file
+    '''
+    schema = pq.read_schema(score_files[0])
+    organs = [name for name in schema.names if name not in ['chrom', 'pos', 'ref', 'alt']]
+    models = json.loads((schema.metadata or {}).get(b'tland_models', b'{}'))
+    dataset = ds.dataset(score_files, format='parquet')
+    chroms = pd.unique(dataset.to_table(columns=['chrom']).column('chrom').to_pandas().astype(str))
+
+    outdir.mkdir(parents=True, exist_ok=True)
+    index = {'organs': organs, 'models': models, 'score_version': score_version, 'chunk_rows': chunk_rows, 'chroms': {}}
+    names = {}
+    for chrom in chroms:
+        names.setdefault(chrom_code(chrom), []).append(chrom)
+    for chrom_names in names.values():
+        chrom = chrom_names[0]
+        df = dataset.to_table(filter=ds.field('chrom').isin(chrom_names)).to_pandas()
+        df = with_position_key(df.rename(columns={'pos': 'end'}).astype({'chrom': str}))
+        df = df.drop_duplicates(subset=VARIANT_JOIN_KEY, keep='last').sort_values(VARIANT_JOIN_KEY)
+        df = df[VARIANT_JOIN_KEY + organs].reset_index(drop=True)
+        df[organs] = df[organs].astype(np.float32)
+        pq.write_table(pa.Table.from_pandas(df, preserve_index=False), outdir / chrom_file(chrom),
+                       row_group_size=chunk_rows, compression='zstd')
+        keys = df[KEY_COLUMN].to_numpy()
+        starts = np.arange(0, len(df), chunk_rows)
+        ends = np.minimum(starts + chunk_rows, len(df)) - 1
+        index['chroms'][chrom] = {'file': chrom_file(chrom), 'rows': len(df), 'code': int(keys[0] >> 32) if len(df) else None,
+                                  'min_key': keys[starts].tolist(), 'max_key': keys[ends].tolist()}
+        print(f'Indexed {len(df)} variants on {chrom}')
+
+    tmp = outdir / f'.{INDEX_FILE}.tmp'
+    with open(tmp, 'w') as f:
+        json.dump(index, f)
+    os.replace(tmp, outdir / INDEX_FILE) # the index file marks a complete score index
+    return index
+
+class ScoreIndex:
+    '''Precomputed TLand scores of a reference variant set, range-queried by position key
+
+    Lookups read only the row groups whose position key range holds a queried variant.
+
+    Args:
+        index_dir (str): score index directory
+        score_version (str): version the scores are expected to have (not checked if None)
+    '''
+
+    def __init__(self, index_dir, score_version=None):
+        self.index_dir = Path(index_dir)
+        with open(self.index_dir / INDEX_FILE) as f:
+            self.index = json.load(f)
+        self.organs = self.index['organs']
+        self.models = self.index['models']
+        self.chroms = {}
+        for chrom, entry in self.index['chroms'].items():
+            if entry['code'] in self.chroms:
+                raise ValueError(f"Score index {index_dir} has several files for chromosome {chrom} (e.g. 'chr1' and '1'); rebuild it")
+            self.chroms[entry['code']] = entry
+        if score_version and self.index['score_version'] and self.index['score_version'] != score_version:
+            raise ValueError(f"Score index {index_dir} was built with score version {self.index['score_version']}, "
+                             f"not the current {score_version}; rebuild it or remove score_index from the config")
+
+    def get_scores(self, keys_df, organs):
+        '''Function to look up the scores of variants
+        Args:
+            keys_df (pd.DataFrame): 'chrom', 'end', 'ref', 'alt' of the variants
+            organs (list of str): organ names (with underscores)
+        Returns:
+            scores (pd.DataFrame): one column per organ in keys_df row order, NaN for variants or organs not in the index
+        '''
+        keys_df = with_position_key(keys_df)
+        indexed = [organ for organ in organs if organ in self.organs]
+        found = []
+        codes = keys_df[KEY_COLUMN].to_numpy() >> 32
+        for code in np.unique(codes):
+            entry = self.chroms.get(int(code))
+            if entry is None:
+                continue
+            keys = np.unique(keys_df[KEY_COLUMN].to_numpy()[codes == code])
+            max_key = np.array(entry['max_key'], dtype=np.int64)
+            min_key = np.array(entry['min_key'], dtype=np.int64)
+            # row groups are cut every chunk_rows rows, so the alleles of a position may span several of them
+            first = np.searchsorted(max_key, keys, 'left')
+            last = np.searchsorted(min_key, keys, 'right') - 1
+            counts = np.maximum(last - first + 1, 0)
+            offsets = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+            row_groups = np.unique(np.repeat(first, counts) + offsets)
+            if len(row_groups):
+                parquet_file = pq.ParquetFile(self.index_dir / entry['file'])
+                found.append(parquet_file.read_row_groups(row_groups.tolist(), columns=VARIANT_JOIN_KEY + indexed).to_pandas())
+        scores = keys_df[VARIANT_JOIN_KEY]
+        if found:
+            scores = scores.merge(pd.concat(found, ignore_index=True), on=VARIANT_JOIN_KEY, how='left')
+        return scores.reindex(columns=organs).astype(np.float32).reset_index(drop=True)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Build a precomputed TLand score index, or annotate a VCF-like file from one.")
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    build = subparsers.add_parser('build', help='Build a score index from wide Parquet score files')
+    build.add_argument('--score_files', type=str, nargs='+', required=True, help='TLand_scores.parquet files of the reference runs')
+    build.add_argument('--outdir', type=str, required=True, help='Output score index directory')
+    build.add_argument('--score_version', type=str, help='Version of the feature resources and models the scores were computed with')
+    build.add_argument('--chunk_rows', type=int, default=CHUNK_ROWS, help='Variants per row group, the unit read by lookups')
+    annotate = subparsers.add_parser('annotate', help='Look up the scores of the variants of a VCF-like file')
+    annotate.add_argument('--input_vcf', type=str, required=True, help='Path to input VCF file')
+    annotate.add_argument('--score_index', type=str, required=True, help='Path to score index directory')
+    annotate.add_argument('--organs', type=str, nargs='+', help='Organ names (with underscores), all organs of the index by default')
+    annotate.add_argument('--out', type=str, required=True, help='Output wide Parquet score file, with missing scores for variants not in the index')
+    annotate.add_argument('--misses', type=str, help='Optional output VCF file path for the variants missing a score, to run through the workflow')
+    args = parser.parse_args()
+
+    if args.command == 'build':
+        index = write_score_index(args.score_files, Path(args.outdir), args.score_version, args.chunk_rows)
+        print(f"Indexed {sum(entry['rows'] for entry in index['chroms'].values())} variants for {len(index['organs'])} organs")
+    else:
+        score_index = ScoreIndex(args.score_index)
+        organs = args.organs or score_index.organs
+        vcf_df = pd.read_csv(args.input_vcf, sep='\t', header=None, dtype=str, keep_default_na=False)
+        keys_df = pd.DataFrame({'chrom': vcf_df[0], 'end': vcf_df[1].astype(np.int64), 'ref': vcf_df[3], 'alt': vcf_df[4]})
+        scores = score_index.get_scores(keys_df, organs)
+        # same layout as the wide score files of predict.py
+        wide_df = pd.concat([keys_df.rename(columns={'end': 'pos'}), scores], axis=1)
+        table = pa.Table.from_pandas(wide_df, preserve_index=False)
+        models = {organ: score_index.models.get(organ) for organ in organs}
+        table = table.replace_schema_metadata({**(table.schema.metadata or {}), b'tland_models': json.dumps(models).encode()})
+        pq.write_table(table, args.out, compression='zstd')
+        missing = scores.isna().any(axis=1).to_numpy()
+        if args.misses:
+            vcf_df[missing].to_csv(args.misses, sep='\t', header=False, index=False)
+        print(f'{int((~missing).sum())} of {len(keys_df)} variants found in the score index')
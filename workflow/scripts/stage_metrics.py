@@ -0,0 +1,96 @@
+from contextlib import contextmanager
+from datetime import datetime
+import json
+import os
+import resource
+import time
+
+def _read_proc_io():
+    '''Returns: io (dict): bytes read by this process ('rchar': all reads, 'read_bytes': reads from storage), empty if unavailable'''
+    try:
+        with open('/proc/self/io') as f:
+            fields = dict(line.split(':') for line in f)
+        return {'rchar': int(fields['rchar']), 'read_bytes': int(fields['read_bytes'])}
+    except (OSError, KeyError, ValueError):
+        return {}
+
+def _cpu_seconds():
+    '''Returns: cpu (float): user and system CPU time of this process and its reaped worker processes'''
+    cpu = 0.0
+    for who in (resource.RUSAGE_SELF, resource.RUSAGE_CHILDREN):
+        usage = resource.getrusage(who)
+        cpu += usage.ru_utime + usage.ru_stime
+    return cpu
+
+def _peak_rss_mb(who=resource.RUSAGE_SELF):
+    if who == resource.RUSAGE_SELF:
+        # VmHWM starts over at exec, while ru_maxrss keeps the peak of the process that launched this one
+        try:
+            with open('/proc/self/status') as f:
+                for line in f:
+                    if line.startswith('VmHWM:'):
+                        return int(line.split()[1]) / 1024
+        except OSError:
+            pass
+    return resource.getrusage(who).ru_maxrss / 1024 # ru_maxrss is in KB on Linux
+
+class StageMetrics:
+    '''Structured metrics of one pipeline stage, written as JSON for the run report
+
+    Phases record wall and CPU time, bytes read by the process and peak RSS; repeated phases of the same name
+    (e.g. one per organ) are summed. Counters hold variant counts, bytes of inputs and rows written.
+
+    Args:
+        stage (str): stage name
+        path (str): output JSON path (None records nothing to disk)
+    '''
+
+    def __init__(self, stage, path=None):
+        self.path = path
+        self.stage = stage
+        self.started = datetime.now().isoformat(timespec='seconds')
+        self.start_wall = time.perf_counter()
+        self.start_cpu = _cpu_seconds()
+        self.phases = {}
+        self.counters = {}
+
+    @contextmanager
+    def phase(self, name):
+        wall, cpu, io = time.perf_counter(), _cpu_seconds(), _read_proc_io()
+        try:
+            yield
+        finally:
+            phase = self.phases.setdefault(name, {'wall_s': 0.0, 'cpu_s': 0.0, 'calls': 0})
+            phase['wall_s'] += time.perf_counter() - wall
+            phase['cpu_s'] += _cpu_seconds() - cpu
+            phase['calls'] += 1
+            for key, value in _read_proc_io().items():
+                phase[key] = phase.get(key, 0) + value - io[key]
+            phase['peak_rss_mb'] = _peak_rss_mb()
+
+    def count(self, name, value):
+        '''Add value to a counter'''
+        self.counters[name] = self.counters.get(name, 0) + int(value)
+
+    def to_dict(self):
+        return {
+            'stage': self.stage,
+            'started': self.started,
+            'wall_s': time.perf_counter() - self.start_wall,
+            'cpu_s': _cpu_seconds() - self.start_cpu,
+            'peak_rss_mb': _peak_rss_mb(),
+            'children_peak_rss_mb': _peak_rss_mb(resource.RUSAGE_CHILDREN),
+            'phases': self.phases,
+            'counters': self.counters}
+
+    def write(self):
+        '''Write the metrics JSON, and print a one-line summary to the log'''
+        record = self.to_dict()
+        print(f"{self.stage}: {record['wall_s']:.2f} s wall, {record['cpu_s']:.2f} s CPU, {record['peak_rss_mb']:.0f} MB peak RSS")
+        if self.path is None:
+            return
+        os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+        tmp = f'{self.path}.tmp'
+        with open(tmp, 'w') as f:
+            json.dump(record, f, indent=2)
+        os.replace(tmp, self.path)
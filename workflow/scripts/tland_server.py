@@ -0,0 +1,350 @@
+from collections import OrderedDict, defaultdict
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+import argparse
+import json
+import signal
+import sys
+import tempfile
+import threading
+import time
+import traceback
+
+import numpy as np
+import pandas as pd
+import pyBigWig
+
+from bigwig_signal import SignalLookup
+from cache_versions import get_feature_version, get_score_version
+from extract_organsp_features import get_organ_sp_table, get_organ_sp_bigwig_paths, read_total_num
+from feature_schema import KEY_COLUMN, VARIANT_JOIN_KEY, to_organsp_schema, with_position_key
+from predict import GT_100_TF_CHIP, load_models, predict
+from regdb_client import RegDBClient
+from regdb_store import read_variants, read_peaks, split_peaks_by_organ, get_organ_sp_counts, write_store
+from variant_cache import VARIANT_KEY, POSITION_KEY, VariantCache, is_cached
+
+# Status of each variant in the answers: scored for every organ, or missing the cached generic (Sei) features
+# some organ's score needs
+SCORED = 'scored'
+NOT_IN_CACHE = 'unscored: not in cache'
+
+class LRUCache:
+    '''In-memory cache of the most recently used rows, shared by the request threads'''
+
+    def __init__(self, maxsize):
+        self.maxsize = maxsize
+        self.rows = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            row = self.rows.get(key)
+            if row is not None:
+                self.rows.move_to_end(key)
+            return row
+
+    def put(self, key, row):
+        with self.lock:
+            self.rows[key] = row
+            self.rows.move_to_end(key)
+            while len(self.rows) > self.maxsize:
+                self.rows.popitem(last=False)
+
+class CacheWriter:
+    '''Background writer of the rows the request threads add to the variant cache
+
+    Rows are buffered per table and written every `interval` seconds and at close, so that requests never wait for
+    a cache write or the merge of part files it may start.
+
+    Args:
+        cache (VariantCache): variant cache
+        interval (float): seconds between writes
+    '''
+
+    def __init__(self, cache, interval=10.0):
+        self.cache = cache
+        self.interval = interval
+        self.pending = defaultdict(list)
+        self.lock = threading.Lock()
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def put(self, method, organ_arg, df):
+        '''Function to buffer rows for a `put_*` method of the variant cache, called with the organ and the rows'''
+        with self.lock:
+            self.pending[(method, organ_arg)].append(df)
+
+    def flush(self):
+        '''Function to write the buffered rows, one part per table'''
+        with self.lock:
+            pending, self.pending = self.pending, defaultdict(list)
+        for (method, organ_arg), dfs in pending.items():
+            getattr(self.cache, method)(organ_arg, pd.concat(dfs, ignore_index=True))
+
+    def _run(self):
+        while not self.stopped.wait(self.interval):
+            try:
+                self.flush()
+            except Exception:
+                traceback.print_exc()
+
+    def close(self):
+        self.stopped.set()
+        self.thread.join()
+        self.flush()
+
+class TLandScorer:
+    '''Resident TLand scorer, holding the models, the organ-specific bigWig handles and an LRU cache of recent rows
+
+    Variants are scored from, in order: the LRU cache, the variant cache, and otherwise the variant's cached generic
+    features with organ-specific features computed on the fly from a RegulomeDB query and the organ bigWigs. Sei
+    features need the GPU Sei pipeline, so variants without cached generic features are left unscored, with status
+    NOT_IN_CACHE; run the workflow with the same `cache_dir` to add them. Requests are scored concurrently, except
+    for the reads of the shared bigWig handles. New features and scores are added to the variant cache by a
+    background CacheWriter; call close() to write the remaining ones.
+
+    Args:
+        models_path (Path): directory containing the pickled models
+        organ_mapping (dict): organ names with underscores -> organ names with spaces, of the organs served
+        total_num_path (Path): directory of the total number of organ-specific annotations
+        organsp_dnase_sig_path (Path): directory of the organ-specific DNase signal bigWigs
+        cache (VariantCache): variant cache, with feature and score versions
+        regdb_url (str): query endpoint of the RegulomeDB service
+        lru_size (int): number of rows kept in the LRU cache
+        flush_seconds (float): seconds between writes of the new rows to the variant cache
+    '''
+
+    def __init__(self, models_path, organ_mapping, total_num_path, organsp_dnase_sig_path, cache, regdb_url, lru_size=100000, flush_seconds=10.0):
+        self.organ_mapping = organ_mapping
+        self.model_ls = load_models(models_path, organ_mapping.values())
+        self.total_num_dict = read_total_num(total_num_path)
+        self.bigwig_paths = {organ: get_organ_sp_bigwig_paths(organsp_dnase_sig_path, organ) for organ in organ_mapping.values()}
+        self.bigwigs = {str(path): pyBigWig.open(str(path)) for paths in self.bigwig_paths.values() for path in paths.values()}
+        self.cache = cache
+        self.regdb = RegDBClient(regdb_url)
+        self.lru = LRUCache(lru_size)
+        self.lock = threading.Lock() # bigWig handles are not thread-safe
+        self.writer = CacheWriter(cache, flush_seconds)
+
+    def close(self):
+        '''Function to write the buffered rows to the variant cache and close the RegDB connections and bigWig handles'''
+        self.writer.close()
+        self.regdb.close()
+        for bw in self.bigwigs.values():
+            bw.close()
+
+    def model_name(self, organ):
+        return self.model_ls[0][0] if organ in GT_100_TF_CHIP else self.model_ls[1][0]
+
+    def _lookup(self, table, keys_df, key_columns, read_cached):
+        '''Function to fetch rows from the LRU cache, falling back to the variant cache
+        Args:
+            table (tuple): LRU key prefix of the rows
+            keys_df (pd.DataFrame): keys of the rows
+            key_columns (list of str): key columns
+            read_cached (function): reads the rows of a keys DataFrame from the variant cache
+        Returns:
+            rows (pd.DataFrame): rows found, at most one per key
+        '''
+        rows = []
+        misses = []
+        for key in keys_df[key_columns].drop_duplicates().itertuples(index=False, name=None):
+            row = self.lru.get(table + key)
+            if row is not None:
+                rows.append(row)
+            else:
+                misses.append(key)
+        if misses:
+            for row in read_cached(pd.DataFrame(misses, columns=key_columns)).to_dict('records'):
+                self.lru.put(table + tuple(row[column] for column in key_columns), row)
+                rows.append(row)
+        return pd.DataFrame(rows) if rows else keys_df[key_columns].iloc[:0]
+
+    def _compute_organsp(self, positions_df, organ_args):
+        '''Function to compute organ-specific features from a RegulomeDB query and the organ bigWigs
+        Returns:
+            organsp (dict): organ (with underscores) -> organ-specific features of positions_df
+        '''
+        with tempfile.TemporaryDirectory() as store_dir:
+            write_store(self.regdb.query(positions_df['chrom'], positions_df['end']), Path(store_dir))
+            variants = read_variants(store_dir)
+            peaks, vocab = read_peaks(store_dir)
+            organ_rows = split_peaks_by_organ(peaks, vocab, [self.organ_mapping[organ_arg] for organ_arg in organ_args])
+            signal_lookup = SignalLookup(variants['chrom'], variants['end'])
+            organsp = {}
+            for organ_arg in organ_args:
+                organ = self.organ_mapping[organ_arg]
+                counts = get_organ_sp_counts(peaks, vocab, organ_rows[organ], len(variants))
+                organSp_df = get_organ_sp_table(variants['chrom'], variants['end'], counts, organ, self.total_num_dict)
+                for sig_feature, path in self.bigwig_paths[organ].items():
+                    with self.lock:
+                        organSp_df[sig_feature] = signal_lookup.values(self.bigwigs[str(path)])
+                organsp[organ_arg] = to_organsp_schema(organSp_df)
+        return organsp
+
+    def score(self, keys_df, organ_args):
+        '''Function to score variants for several organs
+        Args:
+            keys_df (pd.DataFrame): VARIANT_KEY of the variants
+            organ_args (list of str): organ names (with underscores)
+        Returns:
+            scores (pd.DataFrame): VARIANT_KEY, one score column per organ (NaN for variants without Sei features) and
+                'status', SCORED or NOT_IN_CACHE
+        '''
+        keys_df = with_position_key(keys_df[VARIANT_KEY].drop_duplicates().reset_index(drop=True))
+        scores = keys_df[VARIANT_KEY].copy()
+        scores['status'] = SCORED
+        # Cached scores, and the variants each organ still has to score
+        need = {}
+        for organ_arg in organ_args:
+            cached = self._lookup(('scores', organ_arg), keys_df, VARIANT_KEY,
+                                  lambda df, organ_arg=organ_arg: self.cache.get_scores(organ_arg, df))
+            scored = keys_df.merge(with_position_key(cached.reindex(columns=VARIANT_KEY + ['score'])).drop(columns=['chrom', 'end']), on=VARIANT_JOIN_KEY, how='left')
+            scores[organ_arg] = scored['score'].to_numpy(dtype=float)
+            need[organ_arg] = keys_df[scores[organ_arg].isna()]
+        need_keys = pd.concat(need.values()).drop_duplicates()
+        if need_keys.empty:
+            return scores
+
+        # Generic features (with Sei features) only come from the caches
+        generic = self._lookup(('generic',), need_keys, VARIANT_KEY, self.cache.get_generic)
+        unscored = scores[organ_args].isna().any(axis=1).to_numpy()
+        featured = is_cached(generic if generic.empty else with_position_key(generic), keys_df, VARIANT_KEY)
+        scores.loc[unscored & ~featured, 'status'] = NOT_IN_CACHE
+        if generic.empty:
+            return scores
+
+        # Organ-specific features from the caches, the rest computed with a single RegulomeDB query
+        organsp = {}
+        missing = {}
+        for organ_arg, organ_need in need.items():
+            organ_need = organ_need.merge(with_position_key(generic)[VARIANT_JOIN_KEY], on=VARIANT_JOIN_KEY, how='inner')
+            if organ_need.empty:
+                continue
+            organsp[organ_arg] = self._lookup(('organsp', organ_arg), organ_need, POSITION_KEY,
+                                              lambda df, organ_arg=organ_arg: self.cache.get_organsp(organ_arg, df))
+            found = with_position_key(organsp[organ_arg].reindex(columns=POSITION_KEY))[[KEY_COLUMN]].drop_duplicates()
+            organ_missing = organ_need[[KEY_COLUMN]].merge(found.assign(_found=True), on=KEY_COLUMN, how='left')
+            missing[organ_arg] = organ_need.loc[organ_missing['_found'].isna().to_numpy(), POSITION_KEY]
+        missing = {organ_arg: positions for organ_arg, positions in missing.items() if not positions.empty}
+        if missing:
+            positions = pd.concat(missing.values()).drop_duplicates()
+            for organ_arg, organSp_df in self._compute_organsp(positions, list(missing)).items():
+                self.writer.put('put_organsp', organ_arg, organSp_df)
+                for row in organSp_df.to_dict('records'):
+                    self.lru.put(('organsp', organ_arg, row['chrom'], row['end']), row)
+                organsp[organ_arg] = pd.concat([organsp[organ_arg], organSp_df], ignore_index=True)
+
+        # Score the remaining variants of each organ
+        for organ_arg, organSp_df in organsp.items():
+            organ = self.organ_mapping[organ_arg]
+            model_name = self.model_name(organ)
+            generic = with_position_key(generic)
+            organ_generic = need[organ_arg][VARIANT_JOIN_KEY].merge(generic, on=VARIANT_JOIN_KEY, how='inner')[generic.columns]
+            _, pred_dict = predict(organ, organ_generic, organSp_df, GT_100_TF_CHIP, self.model_ls)
+            new_scores = organ_generic[VARIANT_KEY].assign(score=pred_dict[organ][model_name][0], model=model_name)
+            self.writer.put('put_scores', organ_arg, new_scores)
+            for row in new_scores.to_dict('records'):
+                self.lru.put(('scores', organ_arg) + tuple(row[column] for column in VARIANT_KEY), row)
+            scored = keys_df.merge(with_position_key(new_scores)[VARIANT_JOIN_KEY + ['score']], on=VARIANT_JOIN_KEY, how='left')['score'].to_numpy(dtype=float)
+            scores[organ_arg] = np.where(np.isnan(scored), scores[organ_arg], scored)
+        return scores
+
+class ScoringHandler(BaseHTTPRequestHandler):
+    '''POST /score with {"variants": [{"chrom", "pos", "ref", "alt"}, ...], "organs": [...] (optional, all served organs by default)}
+    answers {"organs": [...], "models": {organ: model}, "scores": [{"chrom", "pos", "ref", "alt", organ: score or null, ..., "status"}, ...]},
+    where "status" is "scored", or "unscored: not in cache" for variants whose generic features are not cached yet.
+    Requests that fail while scoring are answered with status 500 and the error.'''
+
+    def send_json(self, status, body):
+        payload = json.dumps(body, default=lambda value: value.item()).encode() # numpy scalars
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def do_GET(self):
+        if self.path == '/health':
+            self.send_json(200, {'status': 'ok', 'organs': list(self.server.scorer.organ_mapping)})
+        else:
+            self.send_json(404, {'error': f'Unknown path {self.path}'})
+
+    def do_POST(self):
+        if self.path != '/score':
+            self.send_json(404, {'error': f'Unknown path {self.path}'})
+            return
+        scorer = self.server.scorer
+        try:
+            request = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))))
+            keys_df = pd.DataFrame(request['variants'], columns=['chrom', 'pos', 'ref', 'alt']).rename(columns={'pos': 'end'})
+            keys_df['end'] = keys_df['end'].astype(np.int64)
+            organ_args = request.get('organs') or list(scorer.organ_mapping)
+            unknown = [organ_arg for organ_arg in organ_args if organ_arg not in scorer.organ_mapping]
+            if unknown:
+                raise ValueError(f'Organs {unknown} are not served. Must be among {list(scorer.organ_mapping)}.')
+        except (ValueError, KeyError, TypeError) as e:
+            self.send_json(400, {'error': str(e)})
+            return
+
+        start = time.time()
+        try:
+            scores = scorer.score(keys_df, organ_args)
+        except Exception as e:
+            traceback.print_exc()
+            self.send_json(500, {'error': f'{type(e).__name__}: {e}'})
+            return
+        scores = scores.rename(columns={'end': 'pos'}).astype({organ_arg: object for organ_arg in organ_args})
+        scores[organ_args] = scores[organ_args].where(scores[organ_args].notna(), None)
+        self.send_json(200, {
+            'organs': organ_args,
+            'models': {organ_arg: scorer.model_name(scorer.organ_mapping[organ_arg]) for organ_arg in organ_args},
+            'scores': scores.to_dict('records'),
+            'seconds': round(time.time() - start, 4)})
+
+def make_server(scorer, host='127.0.0.1', port=0):
+    '''Returns: server (ThreadingHTTPServer): scoring server, not yet serving (port 0 picks a free port)'''
+    server = ThreadingHTTPServer((host, port), ScoringHandler)
+    server.scorer = scorer
+    return server
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Serve TLand scores for small batches of variants from a resident process.")
+    parser.add_argument('--models_path', type=str, required=True, help='Path to directory containing model files')
+    parser.add_argument('--organ_mapping_json', type=str, required=True, help='Path to file mapping organ names with underscores to organ names with spaces')
+    parser.add_argument('--organs', type=str, nargs='+', help='Organ names (with underscores) to serve (default: all)')
+    parser.add_argument('--total_num_path', type=str, required=True, help='Path to files containing total number of organ-specific annotations for a given feature')
+    parser.add_argument('--organsp_dnase_sig_path', type=str, required=True, help='Path to quantile-normalized organ-specific DNase signal bigWig files')
+    parser.add_argument('--dnase_sig_path', type=str, required=True, help='Path to quantile-normalized DNase signal bigWig files (for the cache version)')
+    parser.add_argument('--chip_sig_path', type=str, required=True, help='Path to quantile-normalized ChIP signal bigWig files (for the cache version)')
+    parser.add_argument('--sei_dir', type=str, required=True, help='Sei directory (for the cache version)')
+    parser.add_argument('--regdb_version', type=str, default='', help='Version of the RegulomeDB data, as set in the config (for the cache version)')
+    parser.add_argument('--cache_dir', type=str, required=True, help='Path to variant cache directory shared with the workflow')
+    parser.add_argument('--regdb_url', type=str, required=True, help='Query endpoint of the RegulomeDB service')
+    parser.add_argument('--lru_size', type=int, default=100000, help='Number of recently used rows kept in memory')
+    parser.add_argument('--flush_seconds', type=float, default=10.0, help='Seconds between writes of new features and scores to the variant cache')
+    parser.add_argument('--host', type=str, default='127.0.0.1', help='Host to listen on')
+    parser.add_argument('--port', type=int, default=8000, help='Port to listen on')
+    args = parser.parse_args()
+
+    start = time.time()
+    with open(args.organ_mapping_json) as f:
+        organ_mapping = json.load(f)
+    if args.organs:
+        organ_mapping = {organ_arg: organ_mapping[organ_arg] for organ_arg in args.organs}
+
+    feature_version = get_feature_version(args.dnase_sig_path, args.chip_sig_path, args.organsp_dnase_sig_path,
+                                          args.total_num_path, str(Path(args.sei_dir) / 'model'), args.regdb_version)
+    cache = VariantCache(args.cache_dir, feature_version, get_score_version(feature_version, args.models_path))
+    scorer = TLandScorer(Path(args.models_path), organ_mapping, Path(args.total_num_path), Path(args.organsp_dnase_sig_path),
+                         cache, args.regdb_url, args.lru_size, args.flush_seconds)
+    server = make_server(scorer, args.host, args.port)
+    print(f'Loaded {len(organ_mapping)} organs in {time.time() - start:.2f} seconds, serving on http://{args.host}:{server.server_port}/score')
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        scorer.close() # buffered rows are written to the variant cache
@@ -0,0 +1,199 @@
+from pathlib import Path
+import argparse
+import fcntl
+import os
+import uuid
+
+import numpy as np
+import pandas as pd
+import pyarrow.dataset as ds
+
+from feature_schema import KEY_COLUMN, with_position_key
+from score_index import ScoreIndex
+
+VARIANT_KEY = ['chrom', 'end', 'ref', 'alt']
+POSITION_KEY = ['chrom', 'end']
+
+# Runs of a tier above which a write merges them into one run of the next tier, and rows per row group of merged runs
+COMPACT_PARTS = 64
+COMPACT_ROW_GROUP_ROWS = 65536
+
+def join_columns(key_columns):
+    '''Returns: columns (list of str): integer position key, plus 'ref' and 'alt' for VARIANT_KEY, that rows of key_columns are joined on'''
+    return [KEY_COLUMN] + [column for column in key_columns if column not in POSITION_KEY]
+
+class VariantCache:
+    '''Persistent cache of generic features, organ-specific features and TLand scores shared across runs
+
+    Rows are appended as Parquet part files, so concurrent jobs never write to the same file; lookups keep
+    the most recently written row of each key. Parts are merged in tiers: each write adds a run of tier 0, and once
+    a tier has more than COMPACT_PARTS runs, they are merged into one run of the next tier, made of one part per
+    chromosome sorted by position. Each row is thus rewritten once per tier, and lookups open a number of files
+    that grows with the logarithm of the table size and skip the row groups outside the positions they look up.
+    Features live under the feature version
+    and scores under the score version, so changing the resources or models starts a new, empty cache.
+
+    Args:
+        cache_dir (str): cache root directory
+        feature_version (str): version of the resources the features are computed from
+        score_version (str): version of the resources and models the scores are computed from (only needed for scores)
+    '''
+
+    def __init__(self, cache_dir, feature_version, score_version=None):
+        self.feature_dir = Path(cache_dir) / 'features' / feature_version
+        self.score_dir = Path(cache_dir) / 'scores' / score_version if score_version else None
+
+    def _parts(self, table_dir, tier=None):
+        '''Returns: parts (list of Path): part files of a table (of a tier only if given), oldest first'''
+        parts = sorted(table_dir.glob('part-*.parquet'), key=os.path.getmtime) if table_dir.is_dir() else []
+        return parts if tier is None else [part for part in parts if part_run(part)[0] == tier]
+
+    def _read(self, table_dir, keys_df, key_columns):
+        '''Function to read the cached rows of keys_df
+        Returns:
+            cached (pd.DataFrame): cached rows, one per key found in the cache (empty if none)
+        '''
+        keys_df = with_position_key(keys_df.reindex(columns=[KEY_COLUMN] + key_columns))
+        on = join_columns(key_columns)
+        for attempt in range(3):
+            try:
+                parts = self._parts(table_dir)
+                if not parts or keys_df.empty:
+                    return keys_df.iloc[:0]
+                dataset = ds.dataset([str(part) for part in parts], format='parquet')
+                cached = dataset.to_table(filter=ds.field('end').isin(np.unique(keys_df['end']).tolist())).to_pandas()
+                break
+            except OSError:
+                if attempt == 2:
+                    raise # parts merged away by a concurrent write are listed again
+        cached = with_position_key(cached).merge(keys_df[on].drop_duplicates(), on=on, how='inner')
+        return cached.drop_duplicates(subset=on, keep='last')
+
+    def _write(self, table_dir, df, key_columns):
+        if df.empty:
+            return
+        table_dir.mkdir(parents=True, exist_ok=True)
+        part = table_dir / f'part-0-{uuid.uuid4().hex}-0.parquet'
+        tmp = table_dir / f'.{part.name}.tmp'
+        df.to_parquet(tmp, index=False)
+        os.replace(tmp, part) # readers never see a partially written part
+        tier = 0
+        while len({part_run(part) for part in self._parts(table_dir, tier)}) > COMPACT_PARTS and self.compact(table_dir, key_columns, tier):
+            tier += 1
+
+    def compact(self, table_dir, key_columns, tier=0):
+        '''Function to merge the runs of a tier of a table into one run of the next tier, made of one part per chromosome
+        sorted by position and keeping the most recent row of each key. Parts written meanwhile keep precedence, as the
+        merged parts take the modification time of the oldest part they replace.
+        Returns:
+            merged (bool): whether the runs were merged, False if there was nothing to merge or another process is
+                merging the table
+        '''
+        with open(table_dir / '.compact.lock', 'w') as lock:
+            try:
+                fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                return False
+            parts = self._parts(table_dir, tier)
+            if len({part_run(part) for part in parts}) < 2:
+                return False
+            mtime_ns = min(part.stat().st_mtime_ns for part in parts)
+            dataset = ds.dataset([str(part) for part in parts], format='parquet')
+            chroms = pd.unique(dataset.to_table(columns=['chrom']).column('chrom').to_pandas().astype(str))
+            on = join_columns(key_columns)
+            run = uuid.uuid4().hex
+            for i, chrom in enumerate(chroms):
+                rows = with_position_key(dataset.to_table(filter=ds.field('chrom') == chrom).to_pandas())
+                rows = rows.drop_duplicates(subset=on, keep='last').sort_values(on).reset_index(drop=True)
+                merged = table_dir / f'part-{tier + 1}-{run}-{i}.parquet'
+                tmp = table_dir / f'.{merged.name}.tmp'
+                rows.to_parquet(tmp, index=False, row_group_size=COMPACT_ROW_GROUP_ROWS)
+                os.utime(tmp, ns=(mtime_ns, mtime_ns))
+                os.replace(tmp, merged)
+            for part in parts:
+                part.unlink()
+        return True
+
+    def get_generic(self, keys_df):
+        return self._read(self.feature_dir / 'generic', keys_df, VARIANT_KEY)
+
+    def put_generic(self, df):
+        self._write(self.feature_dir / 'generic', df, VARIANT_KEY)
+
+    def get_organsp(self, organ, positions_df):
+        return self._read(self.feature_dir / 'organsp' / organ, positions_df, POSITION_KEY)
+
+    def put_organsp(self, organ, df):
+        self._write(self.feature_dir / 'organsp' / organ, df, POSITION_KEY)
+
+    def get_scores(self, organ, keys_df):
+        '''Returns: cached (pd.DataFrame): VARIANT_KEY, 'score' and 'model' of the cached scores of an organ'''
+        return self._read(self.score_dir / organ, keys_df, VARIANT_KEY)
+
+    def put_scores(self, organ, df):
+        self._write(self.score_dir / organ, df, VARIANT_KEY)
+
+def part_run(part):
+    '''Returns: tier (int), run (str): tier and run of a part file, named part-{tier}-{run}-{index}.parquet (parts
+    named part-{uuid}.parquet by earlier versions are runs of tier 0)'''
+    fields = part.stem.split('-')
+    if len(fields) != 4:
+        return 0, fields[-1]
+    return int(fields[1]), fields[2]
+
+def read_vcf_keys(input_vcf):
+    '''Returns: variants (pd.DataFrame): position key, 'chrom', 'end', 'id', 'ref', 'alt' of a VCF-like file'''
+    vcf_df = pd.read_csv(input_vcf, sep='\t', usecols=[0,1,2,3,4], names=['chrom','end','id','ref','alt'], dtype=str, keep_default_na=False)
+    return with_position_key(vcf_df.astype({'end': np.int64}))
+
+def is_cached(cached, keys_df, key_columns):
+    '''Returns: found (np.array): whether each row of keys_df has a row in cached'''
+    if cached.empty:
+        return np.zeros(len(keys_df), dtype=bool)
+    on = join_columns(key_columns)
+    found = with_position_key(keys_df.reindex(columns=[KEY_COLUMN] + key_columns))[on].merge(cached[on].drop_duplicates().assign(_found=True), on=on, how='left')['_found']
+    return np.array(found.fillna(False), dtype=bool)
+
+def get_uncached_mask(cache, keys_df, organs):
+    '''Function to find the variants whose features have to be computed
+    A variant is served from the cache if all its organ scores are cached, or if its generic features are
+    cached and, for every organ without a cached score, the organ-specific features are.
+    Args:
+        cache (VariantCache): variant cache
+        keys_df (pd.DataFrame): variants, with VARIANT_KEY columns
+        organs (list of str): organ names (with underscores)
+    Returns:
+        uncached (np.array): whether each variant has to go through the feature pipeline
+    '''
+    scored = np.ones(len(keys_df), dtype=bool)
+    featured = is_cached(cache.get_generic(keys_df), keys_df, VARIANT_KEY)
+    for organ in organs:
+        organ_scored = is_cached(cache.get_scores(organ, keys_df), keys_df, VARIANT_KEY)
+        organ_featured = is_cached(cache.get_organsp(organ, keys_df[POSITION_KEY]), keys_df, POSITION_KEY)
+        scored &= organ_scored
+        featured &= organ_scored | organ_featured
+    return ~(scored | featured)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Write the variants of a VCF-like file that are not served by the variant cache or the score index.")
+    parser.add_argument('--input_vcf', type=str, required=True, help='Path to input VCF file')
+    parser.add_argument('--organs', type=str, nargs='+', required=True, help='Organ names (with underscores)')
+    parser.add_argument('--cache_dir', type=str, help='Path to variant cache directory')
+    parser.add_argument('--feature_version', type=str, help='Version of the feature resources')
+    parser.add_argument('--score_version', type=str, help='Version of the feature resources and models')
+    parser.add_argument('--score_index', type=str, help='Path to a precomputed score index; variants with a score for every organ are served by it')
+    parser.add_argument('--out', type=str, required=True, help='Output VCF file path for the uncached variants')
+    args = parser.parse_args()
+
+    vcf_df = pd.read_csv(args.input_vcf, sep='\t', header=None, dtype=str, keep_default_na=False)
+    keys_df = pd.DataFrame({'chrom': vcf_df[0], 'end': vcf_df[1].astype(np.int64), 'ref': vcf_df[3], 'alt': vcf_df[4]})
+
+    uncached = np.ones(len(keys_df), dtype=bool)
+    if args.score_index:
+        uncached &= ScoreIndex(args.score_index, args.score_version).get_scores(keys_df, args.organs).isna().any(axis=1).to_numpy()
+        print(f'{int((~uncached).sum())} of {len(vcf_df)} variants are in the score index')
+    if args.cache_dir:
+        cache = VariantCache(args.cache_dir, args.feature_version, args.score_version)
+        uncached[uncached] = get_uncached_mask(cache, keys_df[uncached], args.organs)
+    vcf_df[uncached].to_csv(args.out, sep='\t', header=False, index=False)
+    print(f'{int(uncached.sum())} of {len(vcf_df)} variants are not cached')